@@ -0,0 +1,155 @@
+'''Password hashing and signed session tokens.
+
+Passwords are stored as `scrypt$<n>$<r>$<p>$<salt>$<key>`. Hashing takes tens of milliseconds of CPU on purpose,
+    so it runs in a bounded pool of processes: request threads wait for it without holding the GIL, and a burst
+    of logins can not take all of the CPU from other requests. Passwords stored in plain text by the earlier versions
+    are still accepted and replaced with hashes on successful login.
+
+Login issues a token `<payload>.<signature>`: base64url JSON of the user id, username and expiry time with its
+    HMAC-SHA256 by the server secret. Tokens are verified in memory (in microseconds) without database queries,
+    so they can not be revoked before they expire.
+'''
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, NamedTuple, Optional, Tuple
+
+# about 16 MB of memory and 50 ms of CPU per hash
+scrypt_n, scrypt_r, scrypt_p = 2 ** 14, 8, 1
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def is_hashed(stored: str) -> bool:
+    return stored.startswith('scrypt$')
+
+def hash_password(password: str) -> str:
+    salt = os.urandom(16)
+    key = hashlib.scrypt(password.encode(), salt=salt, n=scrypt_n, r=scrypt_r, p=scrypt_p)
+    return f'scrypt${scrypt_n}${scrypt_r}${scrypt_p}${_b64encode(salt)}${_b64encode(key)}'
+
+def check_password(password: str, stored: str) -> Tuple[bool, bool]:
+    '''Returns if the password matches the stored one and if the stored one has to be hashed again
+        (it is in plain text or hashed with other parameters).
+    '''
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode(), stored.encode()), True
+    _, n, r, p, salt, key = stored.split('$')
+    expected = _b64decode(key)
+    actual = hashlib.scrypt(password.encode(), salt=_b64decode(salt), n=int(n), r=int(r), p=int(p), dklen=len(expected))
+    matches = hmac.compare_digest(actual, expected)
+    return matches, matches and (int(n), int(r), int(p)) != (scrypt_n, scrypt_r, scrypt_p)
+
+def _noop() -> None:
+    pass
+
+class HasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    '''Hashes and checks passwords in a pool of `workers` processes, started in the process which uses it first.
+
+    At most `queue_size` passwords wait for a free process, further ones raise HasherBusy instead of queueing
+        without bound. Methods return futures, so that both threads (`.result()`) and coroutines
+        (`asyncio.wrap_future`) can wait for them.
+    '''
+    def __init__(self, workers: int = 2, queue_size: int = 32):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.hashed = 0
+        self.checked = 0
+        self.rejected = 0
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawned processes do not inherit threads and sockets of the server process
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _submit(self, fn, *args) -> Future:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy(f'{self.workers + self.queue_size} passwords are being hashed already, try again later')
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def start(self) -> None:
+        '''Starts the processes, so that the first logins do not wait for them.'''
+        for future in [self.executor.submit(_noop) for _ in range(self.workers)]:
+            future.result()
+
+    def hash(self, password: str) -> 'Future[str]':
+        with self._lock:
+            self.hashed += 1
+        return self._submit(hash_password, password)
+
+    def check(self, password: str, stored: str) -> 'Future[Tuple[bool, bool]]':
+        with self._lock:
+            self.checked += 1
+        if not is_hashed(stored): # plain text comparison is cheap
+            future: Future = Future()
+            future.set_result(check_password(password, stored))
+            return future
+        return self._submit(check_password, password, stored)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'workers': self.workers, 'queue_size': self.queue_size, 'hashed': self.hashed, 'checked': self.checked,
+                'rejected': self.rejected}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+class TokenUser(NamedTuple):
+    id: int
+    username: str
+
+class TokenSigner:
+    def __init__(self, secret: bytes, ttl: float = 86400.0):
+        self.secret = secret
+        self.ttl = ttl
+
+    def _sign(self, payload: str) -> str:
+        return _b64encode(hmac.new(self.secret, payload.encode(), hashlib.sha256).digest())
+
+    def issue(self, user_id: int, username: str) -> str:
+        payload = _b64encode(json.dumps({'id': user_id, 'user': username, 'exp': int(time.time() + self.ttl)},
+                separators=(',', ':')).encode())
+        return f'{payload}.{self._sign(payload)}'
+
+    def verify(self, token: str) -> Optional[TokenUser]:
+        '''Returns user of the token, None if the token is malformed, forged or expired.'''
+        payload, _, signature = token.partition('.')
+        if not hmac.compare_digest(signature.encode(), self._sign(payload).encode()):
+            return None
+        try:
+            claims = json.loads(_b64decode(payload))
+        except (ValueError, binascii.Error):
+            return None
+        if claims['exp'] < time.time():
+            return None
+        return TokenUser(claims['id'], claims['user'])
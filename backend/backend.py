@@ -1,347 +1,681 @@
-import psycopg2
+import psycopg2, psycopg2.extras
 import argparse
-from flask import Flask, request, Response, jsonify, make_response
-import itertools, traceback
-import json, pandas
-import time
-from typing import Optional, List
-from io import BytesIO
+from flask import Flask, request, Response, jsonify, make_response, g
+import csv
+import time, datetime
+import queue
+import threading
+from typing import Any, Dict, List, Optional, Set, Tuple
+import io
+import os
+
+import partitions
+import queries
+import routes
+import schema
+from auth import HasherBusy, PasswordHasher, TokenSigner
+from cache import Membership, MembershipCache
+from chat import ChatListener
+from lookups import Lookups
+from metrics import TimedCursor, metrics
+from pagination import keyset_direction, keyset_params, keyset_result, page_args, page_limit, search_result
+from pool import ConnectionPool, PoolTimeout
+from replicas import ReplicaSet, replica_conn_string
+from routes import ApiError
+from statements import PreparingConnection, registry as statements
+from serialization import BadCursor, make_etag, stream_json
 
 _version = '2021-01-30'
 
 class Properties:
-    def __init__(self, db_addr: str, db_port: int, db_name: str, db_user: str, db_pass: str, api_port: int):
+    def __init__(self, db_addr: str, db_port: int, db_name: str, db_user: str, db_pass: str, api_port: int,
+            pool_min: int = 1, pool_max: int = 10, pool_timeout: float = 10.0):
         self.db_addr = db_addr
         self.db_port = db_port
         self.db_name = db_name
         self.db_user = db_user
         self.db_pass = db_pass
         self.api_port = api_port
-        self._conn: Optional[psycopg2.extensions.connection] = None
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self.pool_timeout = pool_timeout
+        self._pool: Optional[ConnectionPool] = None
     @property
     def conn_string(self) -> str:
         return f'host={self.db_addr} port={self.db_port} dbname={self.db_name}' \
                 f' user={self.db_user} password={self.db_pass}'
     @property
-    def conn(self):
-        if self._conn is None or self._conn.closed:
-            self._conn = psycopg2.connect(self.conn_string)
-        return self._conn
+    def pool(self) -> ConnectionPool:
+        if self._pool is None:
+            self._pool = ConnectionPool(self.conn_string, self.pool_min, self.pool_max, self.pool_timeout,
+                    connection_factory=PreparingConnection, cursor_factory=TimedCursor)
+        return self._pool
     def close(self):
-        if self._conn is not None:
-            if not self._conn.closed:
-                self._conn.close()
-            self._conn = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
 
 app = Flask(__name__)
 props: Properties
+lookups: Lookups
+memberships = MembershipCache()
+export_batch_size = 1000
+chat_listener: Optional[ChatListener] = None
+sse_keepalive = 15.0
+sse_streams = threading.BoundedSemaphore(16) # every open stream holds a request thread
+replicas: Optional[ReplicaSet] = None
+readonly_routes: Set[str] = set()
+hasher = PasswordHasher()
+tokens = TokenSigner(os.urandom(32))
+require_token = False
+partitions_ahead = 3
+partitions_month: Optional[datetime.date] = None # month the partitions ahead are created from
+checkpoints_month: Optional[datetime.date] = None # latest month the balance checkpoints are created for
+month_lock = threading.Lock()
+month_retry = 60.0 # seconds before `close_month` is tried again, if another worker does it or it fails
+month_tried = float('-inf')
+
+@app.before_request
+def before_request() -> None:
+    g.request_start = time.perf_counter()
+    authenticate()
 
 @app.after_request
 def after_request(response) -> Response:
+    global month_tried
+    if 'request_start' in g: # streamed responses are measured until their body starts to be sent
+        metrics.observe_request(request.url_rule.rule if request.url_rule is not None else 'unmatched', request.method,
+                response.status_code, time.perf_counter() - g.request_start)
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = '*'
-    response.headers['Access-Control-Allow-Headers'] = '*'
+    # the wildcard does not cover Authorization
+    response.headers['Access-Control-Allow-Headers'] = '*, Authorization'
+    response.headers['Access-Control-Expose-Headers'] = 'X-Last-Write'
+    if request.method not in ('GET', 'HEAD') and response.status_code < 400:
+        if replicas is not None:
+            replicas.wrote(sticky_users())
+            response.headers['X-Last-Write'] = replicas.last_write()
+        if (partitions_month != partitions.current_month() or checkpoints_month != routes.checkpoint_month()) and \
+                time.monotonic() - month_tried >= month_retry:
+            month_tried = time.monotonic()
+            threading.Thread(target=close_month, name='month', daemon=True).start()
+    if 'etag' in g and response.status_code in (200, 304):
+        response.set_etag(g.etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
     return response
 
+def readonly(view):
+    '''Marks the route as only reading data, so that it can be served by a replica.'''
+    readonly_routes.add(view.__name__)
+    return view
+
+def body_json() -> Any:
+    return request.get_json(force=True, silent=True) if request.mimetype != 'multipart/form-data' else None
+
+def request_users() -> List[str]:
+    '''Returns users the request is made by or about: `user` of the path, of the parameters and of the JSON body.'''
+    users = []
+    if request.view_args is not None and 'user' in request.view_args:
+        users.append(str(request.view_args['user']))
+    return users + routes.acting_users(request.args, body_json(), request.view_args, path=False)
+
+def sticky_users() -> List[str]:
+    '''Returns users of the request for replica stickiness: the token user is given by its id, whatever way the request
+        names them (so that writes and reads by username and by id match), and is included when the request
+        does not name them (e.g. bulk import).
+    '''
+    users = request_users()
+    user = g.get('user')
+    if user is None:
+        return users
+    return [str(user.id)] + [name for name in users if name not in (user.username, str(user.id))]
+
+def authenticate() -> None:
+    '''Verifies token of the request, see `routes.authenticate`.'''
+    user = routes.authenticate(request.headers.get('Authorization'),
+            routes.acting_users(request.args, body_json(), request.view_args), tokens, require_token)
+    if user is not None:
+        g.user = user
+
+def get_conn() -> psycopg2.extensions.connection:
+    '''Returns database connection of the current request, taking it from the pool on the first call.
+
+    Read-only routes take it from a replica, unless there are no healthy replicas or the user has changed data
+        in the last `replicas.stickiness` seconds (as told by `X-Last-Write` header the client got with the write
+        response and sent back, or remembered by the process).
+    '''
+    if 'conn' not in g:
+        replica = None
+        if replicas is not None and request.endpoint in readonly_routes and \
+                not replicas.is_sticky(sticky_users(), request.headers.get('X-Last-Write')):
+            replica = replicas.getconn()
+        if replica is None:
+            g.conn = props.pool.getconn()
+        else:
+            g.replica, g.conn = replica
+    return g.conn
+
+@app.teardown_request
+def release_conn(_) -> None:
+    conn = g.pop('conn', None)
+    replica = g.pop('replica', None)
+    if conn is not None and replica is not None:
+        replicas.putconn(replica, conn)
+    elif conn is not None:
+        props.pool.putconn(conn)
+
+def find_membership(cur: psycopg2.extensions.cursor, group_id: int, user, cached: bool = True) -> Optional[Membership]:
+    '''Returns membership of the user (given by id or username) in the group, using the memberships cache unless
+        it is not `cached` (rights to change the group are checked against the database, as other workers
+        do not invalidate the cache of this one).
+    '''
+    user = str(user)
+    membership = memberships.get(group_id, user) if cached else None
+    if membership is not None:
+        return membership
+    generation = memberships.generation
+    statements.execute(cur, f'find_membership_{queries.user_variant(user)}', (group_id, user))
+    res = cur.fetchone()
+    if res is None:
+        return None
+    membership = Membership(*res)
+    if 'replica' not in g: # replicas may not have the changes the cache was invalidated for yet
+        memberships.put(group_id, user, membership, generation)
+    return membership
+
+def group_version(cur: psycopg2.extensions.cursor, group_id: int) -> Optional[int]:
+    statements.execute(cur, 'group_version', (group_id,))
+    res = cur.fetchone()
+    return None if res is None else res[0]
+
+def bump_version(cur: psycopg2.extensions.cursor, group_id: int) -> None:
+    statements.execute(cur, 'bump_version', (group_id,))
+
+def not_modified(version) -> Optional[Response]:
+    '''Sets ETag of the response to the hash of data version and request path with parameters.
+
+    Returns 304 response if the client already has this version, None otherwise.
+    '''
+    g.etag = make_etag(version, request.full_path)
+    if request.if_none_match.contains_weak(g.etag):
+        return make_response('', 304)
+    return None
+
+def keyset_page(cur: psycopg2.extensions.cursor, name: str, params: tuple,
+        key_indexes: Tuple[int, int]) -> Tuple[list, Optional[str], Optional[str]]:
+    '''Executes statement `<name>_<first|after|before>` returning one page of rows ordered from the newest to the oldest one.
+
+    Statements are registered with `pagination.keyset_sql`, `key_indexes` are positions of their (time, id) key columns
+        in the result row. Page position is taken from `after` (older rows) or `before` (newer rows) cursors
+        of the request, the size from `limit`. Returns rows and cursors of the next (older) and previous (newer) pages
+        if there are any.
+    '''
+    after, before, limit = page_args(request.args)
+    statements.execute(cur, f'{name}_{keyset_direction(after, before)}', keyset_params(params, after, before, limit))
+    return keyset_result(cur.fetchall(), key_indexes, after, before, limit)
+
 def drop_tables() -> None:
-    tables = ('messages', 'users_groups', 'operations', 'user_group_statuses', 'operation_types', 'groups', 'users')
-    with props.conn.cursor() as cur:
+    tables = ('messages', 'users_groups', 'operations', 'user_group_statuses', 'operation_types', 'groups', 'users', 'schema_version')
+    with props.pool.connection() as conn, conn.cursor() as cur:
         for table in tables:
             cur.execute(f'DROP table {table}')
-        props.conn.commit()
 
 def ensure_tables() -> None:
-    with open('database_init.sql') as f:
-        init: List[str] = f.read().split(';')
-    with props.conn.cursor() as cur:
-        for statement in init:
-            if statement.strip() != '':
-                cur.execute(statement)
-
-        needed_statuses = ('creator', 'admin', 'user', 'pending', 'blocked')
-        cur.execute('SELECT name FROM user_group_statuses')
-        statuses = list(map(lambda x: x[0], cur.fetchall()))
-        for status in needed_statuses:
-            if status not in statuses:
-                cur.execute('INSERT INTO user_group_statuses (name) VALUES (%s)', (status,))
-
-        needed_operation_types = ('income', 'spending')
-        cur.execute('SELECT name FROM operation_types')
-        operation_types = list(map(lambda x: x[0], cur.fetchall()))
-        for op_type in needed_operation_types:
-            if op_type not in operation_types:
-                cur.execute('INSERT INTO operation_types (name) VALUES (%s)', (op_type,))
-        props.conn.commit()
+    global lookups
+    with props.pool.connection() as conn:
+        for migration in schema.migrate(conn):
+            print(f'Applied database migration {migration}')
+        lookups = Lookups.load(conn)
+
+def ensure_partitions(months_ahead: int) -> None:
+    global partitions_month
+    month = partitions.current_month()
+    with props.pool.connection() as conn:
+        for partition in partitions.ensure_partitions(conn, months_ahead):
+            print(f'Created partition {partition}')
+    partitions_month = month
+
+def archive_partitions(before: datetime.date, directory: str) -> None:
+    with props.pool.connection() as conn:
+        archived = partitions.archive_partitions(conn, before, directory)
+    for path, rows in archived:
+        print(f'Archived {rows} rows to {path}')
+    print(f'Archived {len(archived)} partitions older than {before:%Y-%m}')
+
+def warm_up() -> None:
+    '''Prepares the process for requests: opens its connections pool, loads lookups, prepares the registered
+        statements on the pool connections and starts password hashing processes, so that the first requests
+        of a new worker are not slower than others.
+    '''
+    global lookups
+    metrics.worker = str(os.getpid())
+    conns = [props.pool.getconn() for _ in range(max(props.pool_min, 1))]
+    try:
+        lookups = Lookups.load(conns[0])
+        for conn in conns:
+            statements.prepare_all(conn)
+            conn.commit()
+    finally:
+        for conn in conns:
+            props.pool.putconn(conn)
+    hasher.start()
+
+def shut_down() -> None:
+    if chat_listener is not None:
+        chat_listener.stop()
+    if replicas is not None:
+        replicas.close()
+    hasher.close()
+    props.close()
 
 # groups
 
 @app.route('/group/<int:group_id>/', methods = ['GET'])
+@readonly
 def get_group(group_id: int) -> Response:
-    status: Optional[str] = request.args.get('status')
-    with props.conn.cursor() as cur:
-        cur.execute('SELECT g.name, g.creator_id, u.username, g.balance FROM groups g'
-                '   JOIN users u ON u.id = g.creator_id WHERE g.id = %s', (group_id,))
+    with get_conn().cursor() as cur:
+        statements.execute(cur, 'get_group', (group_id,))
         res = cur.fetchone()
         if res is None:
-            return make_response(jsonify({'error': f'group with id={group_id} is not found'}), 404)
-        name, creator_id, creator, balance = res
-        cur.execute('SELECT u.id, u.username, ugs.name FROM users u'
-                '   JOIN users_groups ug ON u.id = ug.user_id'
-                '   JOIN groups g ON g.id = ug.group_id'
-                '   JOIN user_group_statuses ugs on ug.status_id = ugs.id'
-                '   WHERE g.id = %s' + ('' if status is None else ' AND ugs.name = %s'),
-                (group_id,) if status is None else (group_id, status))
-        res = pandas.DataFrame(cur.fetchall(), columns = ('id', 'username', 'status'))
-        return make_response(jsonify({
-            'group': {
-                'id': group_id,
-                'name': name,
-                'creator_id': creator_id,
-                'creator': creator,
-                'balance': balance,
-                'users': list(res.transpose().to_dict().values())
-            }
-        }))
+            raise ApiError(f'group with id={group_id} is not found', 404)
+        response = not_modified(res[-1])
+        if response is not None:
+            return response
+        statement = routes.group_users_statement(group_id, request.args.get('status'), lookups)
+        users = []
+        if statement is not None:
+            statements.execute(cur, *statement)
+            users = cur.fetchall()
+        return make_response(jsonify(routes.group_result(group_id, res[:-1], users, lookups)))
 
 
 @app.route('/group/', methods = ['POST'])
 def add_group() -> Response:
-    body = json.loads(request.data)
-    if not ('name' in body and 'user' in body):
-        raise Exception('Missing one of the (name, user) in request body')
-    id = body['user'].isnumeric()
-    with props.conn.cursor() as cur:
-        cur.execute('INSERT INTO groups (name, creator_id) VALUES (%s, '
-                + ('%s' if id else '(SELECT id FROM users WHERE username = %s)')
-                + ') RETURNING id',
-                (body['name'], body['user']))
-        id = cur.fetchone()[0]
-        cur.execute('INSERT INTO users_groups (user_id, group_id, status_id) VALUES'
-                '   ((SELECT id FROM users where username = %s), %s, (SELECT id from user_group_statuses where name = \'creator\')) RETURNING id',
-                (body['user'], id))
-        props.conn.commit()
+    query, params = routes.new_group(routes.json_body(request.data))
+    with get_conn().cursor() as cur:
+        cur.execute(query, params)
+        id, creator_id = cur.fetchone()
+        cur.execute(queries.add_membership, (creator_id, id, lookups.statuses['creator']))
+        get_conn().commit()
         return make_response(jsonify({'group_id': id, 'user_group_id': cur.fetchone()[0]}))
 
 @app.route('/group/<int:group_id>/', methods = ['DELETE'])
 def delete_group(group_id) -> Response:
-    if not 'user' in request.args:
-        return make_response(jsonify({'error': f'user parameter is missing in request path'}), 400)
-    id = request.args['user'].isnumeric()
-    with props.conn.cursor() as cur:
-        cur.execute('SELECT ugs.name FROM users_groups ug JOIN user_group_statuses ugs on ug.status_id = ugs.id ' +
-                ('WHERE ug.user_id = %s' if id else 'JOIN users u on ug.user_id = u.id WHERE u.name = %s'), (request.args['user'],))
+    user = routes.require_user(request.args)
+    with get_conn().cursor() as cur:
+        routes.require_creator(find_membership(cur, group_id, user, cached=False), lookups)
+        cur.execute(queries.delete_group, (group_id,))
+        get_conn().commit()
+        memberships.invalidate_group(group_id)
+        return make_response(jsonify({'result': f'deleted group with id={group_id}'}))
+
+@app.route('/group/<int:group_id>/page', methods = ['GET'])
+@readonly
+def get_group_page(group_id: int) -> Response:
+    '''Returns everything needed to render the group page: group with its users, the latest operations and chat
+        messages (`limit` of each, with cursors of the next pages), fetched in one query.
+    '''
+    user = routes.require_user(request.args)
+    limit = page_limit(request.args)
+    with get_conn().cursor() as cur:
+        routes.require_member(find_membership(cur, group_id, user), user, group_id)
+        response = not_modified(group_version(cur, group_id))
+        if response is not None:
+            return response
+        statements.execute(cur, 'group_page', {'group_id': group_id, 'limit': limit + 1})
         res = cur.fetchone()
-        if res is None or res[0] != 'creator':
-            return make_response(jsonify({'error': 'user does not have enough right to delete group'}))
-        cur.execute('DELETE FROM groups WHERE id = %s', (id,))
-        props.conn.commit()
-        return make_response(jsonify({'result': f'deleted group with id={id}'}))
+    return make_response(jsonify(routes.group_page_result(group_id, res, limit, lookups)))
 
 # users - groups
 
 @app.route('/user/<user>/groups/', methods = ['GET'])
+@readonly
 def get_user_groups(user: str) -> Response:
-    id = user.isnumeric()
-    status: Optional[str] = request.args.get('status')
-    with props.conn.cursor() as cur:
-        cur.execute('SELECT g.id, g.name, uc.count, ugs.name, g.creator_id, u.username, g.balance FROM groups g'
-                '   JOIN users_groups ug ON g.id = ug.group_id'
-                '   JOIN (SELECT group_id, count(*) FROM users_groups WHERE '
-                '       status_id in (select id from user_group_statuses where name = \'user\' or name = \'admin\' or name = \'creator\') GROUP BY group_id)'
-                '           as uc ON g.id = uc.group_id'
-                '   JOIN users u ON u.id = g.creator_id'
-                '   JOIN user_group_statuses ugs on ug.status_id = ugs.id' +
-                ('  WHERE ug.user_id = %s' if id else ' WHERE ug.user_id = (SELECT id FROM users WHERE username = %s)') +
-                ('  AND ug.status_id = ugs.name = %s' if status is not None else '') +
-                '   ORDER BY g.id', (user, status) if status is not None else (user,))
-        res = pandas.DataFrame(cur.fetchall(), columns = ('id', 'name', 'size', 'status', 'creator_id', 'creator', 'balance'))
-        return make_response(jsonify({
-            'groups': list(res.transpose().to_dict().values())
-        }))
+    with get_conn().cursor() as cur:
+        statements.execute(cur, f'user_groups_version_{queries.user_variant(user)}', (user,))
+        response = not_modified(cur.fetchone()[0])
+        if response is not None:
+            return response
+        statements.execute(cur, *routes.user_groups_statement(user, request.args.get('status'), lookups))
+        return stream_json('groups', routes.user_groups_result(cur.fetchall(), lookups))
 
 @app.route('/group/<int:group_id>/join/', methods = ['POST'])
 def user_to_group(group_id: int) -> Response:
-    if not 'user' in request.args:
-        return make_response(jsonify({'error': f'user parameter is missing in request path'}), 400)
-    id = request.args['user'].isnumeric()
-    
-    with props.conn.cursor() as cur:
-        cur.execute('INSERT INTO users_groups (user_id, group_id, status_id) VALUES (' 
-                + ('%s' if id else'(SELECT id FROM users WHERE username = %s)')
-                + ', %s, (SELECT id FROM user_group_statuses WHERE name = \'pending\')) ON CONFLICT DO NOTHING',
-                (request.args['user'], group_id))
-        props.conn.commit()
+    user = routes.require_user(request.args)
+    with get_conn().cursor() as cur:
+        statements.execute(cur, *routes.join_statement(group_id, user, lookups))
+        bump_version(cur, group_id)
+        get_conn().commit()
+        memberships.invalidate_group(group_id)
         return make_response(jsonify({'result': 'ok'}))
 
 @app.route('/group/<int:group_id>/status/<user>/', methods = ['PUT'])
 def user_set_status(group_id: int, user: str) -> Response:
-    if not 'user' in request.args:
-        return make_response(jsonify({'error': f'user parameter is missing in request path'}), 400)
-    if not 'status' in request.args:
-        return make_response(jsonify({'error': 'new status is missing in request path'}), 400)
-    user_id = user.isnumeric()
-    requester_id = request.args['user'].isnumeric()
-    with props.conn.cursor() as cur:
-        cur.execute('SELECT id FROM user_group_statuses WHERE name = %s', (request.args['status'],))
-        status_id = cur.fetchone()
-        if status_id is None:
-            return make_response(jsonify({'error': 'status is not found'}))
-        status_id = status_id[0]
-        cur.execute('SELECT s.name FROM users_groups ug JOIN user_group_statuses s on ug.status_id = s.id WHERE ug.group_id = %s AND ug.user_id = '
-                + ('%s' if requester_id else '(SELECT id FROM users WHERE username = %s)'),
-                (group_id, request.args['user']))
-        res = cur.fetchone()
-        if res is None or res[0] not in ('admin', 'creator') or request.args['status'] == 'creator' or (res[0] == 'admin' and request.args['status'] == 'admin'):
-            return make_response(jsonify({'error': 'not enough rights to change someone else\'s status'}), 403)
-        cur.execute('SELECT id FROM users_groups WHERE group_id = %s AND user_id = '
-                + ('%s' if id else '(SELECT id FROM users WHERE username = %s)'),
-                (group_id, user))
-        res = cur.fetchone()
-        if res is None:
-            return make_response(jsonify({'error': f'user ({user}) is not found in the group ({group_id})'}), 400)
-        ug_id = res[0]
-
-        cur.execute('UPDATE users_groups SET status_id = %s WHERE id = %s', (status_id, ug_id))
-        props.conn.commit()
+    status_id = routes.new_status(request.args, lookups)
+    with get_conn().cursor() as cur:
+        routes.require_status_rights(find_membership(cur, group_id, request.args['user'], cached=False),
+                request.args['status'], lookups)
+        membership = routes.require_member(find_membership(cur, group_id, user, cached=False), user, group_id)
+        statements.execute(cur, 'set_status', (status_id, membership.id))
+        bump_version(cur, group_id)
+        get_conn().commit()
+        memberships.invalidate_group(group_id)
         return make_response(jsonify({'result': 'ok'}))
 
 # users
 
 @app.route('/user/', methods = ['POST'])
 def add_user() -> Response:
-    body = json.loads(request.data)
-    if not ('username' in body and 'password' in body):
-        raise Exception('Missing one of the (username, password) in request body')
-    if len(body['username']) < 2:
-        return make_response(jsonify({'error': 'username must be at least 2 characters long'}), 400)
-    if body['username'].isnumeric():
-        return make_response(jsonify({'error': 'username must contain at least one letter or other symbol'}), 400)
-    if sum(filter(lambda sym: sym in body['username'], list('/& '))) != 0:
-        return make_response(jsonify({'error': 'username contains illegal characters'}))
+    username, password = routes.new_user(routes.json_body(request.data))
+    password = hasher.hash(password).result() # before taking a connection, so that it is not held meanwhile
     try:
-        with props.conn.cursor() as cur:
-            t = time.localtime()
-            cur.execute('INSERT INTO users (username, password, registration_date) VALUES (%s, %s, %s) RETURNING id',
-                    (body['username'], body['password'], f'{t.tm_year}-{t.tm_mon}-{t.tm_mday} {t.tm_hour}:{t.tm_min}:{t.tm_sec}'))
-            props.conn.commit()
+        with get_conn().cursor() as cur:
+            cur.execute(queries.add_user, routes.add_user_params(username, password))
+            get_conn().commit()
             return make_response(jsonify({'result': f'added user with id={cur.fetchone()[0]}'}))
     except psycopg2.DatabaseError as ex:
         print(ex)
-        props.conn.rollback()
-        return make_response(jsonify({'error': f"User with username '{body['username']} already exists"}))
+        get_conn().rollback()
+        raise ApiError(f"User with username '{username}' already exists")
 
 @app.route('/user/<int:id>/', methods = ['GET'])
+@readonly
 def get_user(id: int) -> Response:
-    with props.conn.cursor() as cur:
-        cur.execute('SELECT username FROM users WHERE id = %s', (id,))
+    with get_conn().cursor() as cur:
+        statements.execute(cur, 'get_user', (id,))
         res = cur.fetchall()
         if len(res) == 0:
-            return make_response(jsonify({'error': 'user not found'}), 404)
+            raise ApiError('user not found', 404)
         return make_response(jsonify({'username': res[0]}))
 
 @app.route('/login/', methods = ['POST'])
 def login() -> Response:
-    body = json.loads(request.data)
-    if not ('username' in body and 'password' in body):
-        return make_response(jsonify({'error': 'request body is missing username or password fields'}), 400)
-    with props.conn.cursor() as cur:
-        cur.execute('SELECT password FROM users WHERE username = %s', (body['username'],))
-        res = cur.fetchall()
-        if len(res) == 0 or res[0][0] != body['password']:
-            return make_response(jsonify({'result': 'wrong username or password'}), 403)
-        return make_response(jsonify({'result': 'ok'}))
+    username, password = routes.login_body(routes.json_body(request.data))
+    with get_conn().cursor() as cur:
+        statements.execute(cur, 'user_password', (username,))
+        res = cur.fetchone()
+    get_conn().commit()
+    release_conn(None) # the connection is not held while the password is checked
+    if res is None:
+        return make_response(jsonify({'result': 'wrong username or password'}), 403)
+    user_id, stored = res
+    matches, rehash = hasher.check(password, stored).result()
+    if not matches:
+        return make_response(jsonify({'result': 'wrong username or password'}), 403)
+    if rehash:
+        hashed = hasher.hash(password).result()
+        with get_conn().cursor() as cur:
+            cur.execute(queries.set_password, (hashed, user_id))
+        get_conn().commit()
+    return make_response(jsonify({'result': 'ok', 'token': tokens.issue(user_id, username)}))
 
 # operations
 
 @app.route('/group/<int:group_id>/operations/', methods = ['GET'])
+@readonly
 def get_operations(group_id: int) -> Response:
-    if not 'user' in request.args:
-        return make_response(jsonify({'error': f'user parameter is missing in request path'}), 400)
-    id = request.args['user'].isnumeric()
-    page = request.args.get('page', 0)
-    with props.conn.cursor() as cur:
-        cur.execute('SELECT id FROM users_groups WHERE group_id = %s AND user_id = '
-                + ('%s' if id else '(SELECT id FROM users WHERE username = %s)'),
-                (group_id, request.args['user']))
+    user = routes.require_user(request.args)
+    with get_conn().cursor() as cur:
+        routes.require_member(find_membership(cur, group_id, user), user, group_id)
+        response = not_modified(group_version(cur, group_id))
+        if response is not None:
+            return response
+        rows, next_cursor, prev_cursor = keyset_page(cur, 'operations', (group_id,), (6, 0))
+        balances = None
+        statement = routes.running_balances_statement(request.args, group_id, rows, lookups)
+        if statement is not None:
+            statements.execute(cur, *statement)
+            balances = dict(cur.fetchall())
+        return stream_json('operations', routes.operations_result(rows, lookups, balances), {'next': next_cursor, 'prev': prev_cursor})
+
+@app.route('/group/<int:group_id>/balance', methods = ['GET'])
+@readonly
+def get_balance(group_id: int) -> Response:
+    '''Returns balance of the group after the operations dated up to `at` (YYYY-MM-DD[ HH:MM:SS], now by default),
+        summed from the nearest balance checkpoint before it.
+    '''
+    user = routes.require_user(request.args)
+    name, params = routes.balance_statement(request.args, group_id, lookups)
+    with get_conn().cursor() as cur:
+        routes.require_member(find_membership(cur, group_id, user), user, group_id)
+        response = not_modified(group_version(cur, group_id))
+        if response is not None:
+            return response
+        statements.execute(cur, name, params)
         res = cur.fetchone()
-        if res is None:
-            return make_response(jsonify({'error': f'user ({request.args["user"]}) is not found in the group ({group_id})'}), 403)
-        ug_id = res[0]
-        cur.execute('SELECT o.id, u.username, ot.name, o.amount, o.name, o.description, o.date FROM operations o JOIN users u ON o.user_id = u.id'
-                ' JOIN operation_types ot ON o.type_id = ot.id WHERE o.group_id = %s LIMIT %s OFFSET %s', (group_id, 50, page * 50))
-        res = pandas.DataFrame(cur.fetchall(), columns=('id', 'user', 'type', 'amount', 'name', 'description', 'date'))
-        res['date'] = res['date'].apply(lambda t: f'{t.year:02}-{t.month:02}-{t.day:02} {t.hour:02}:{t.minute:02}:{t.second:02}')
-        return make_response(jsonify({
-            'operations': list(res.transpose().to_dict().values())
-        }))
+    return make_response(jsonify(routes.balance_result(params, res)))
+
+@app.route('/group/<int:group_id>/operations/export', methods = ['GET'])
+def export_operations(group_id: int) -> Response:
+    '''Streams all of the group operations (optionally limited by `from` and `to` dates) ordered by date
+        in `csv` or `ndjson` format. Operations are read with server-side cursor in batches of `export_batch_size`.
+    '''
+    export_format, query, params = routes.export_query(request.args, group_id)
+    with get_conn().cursor() as cur:
+        routes.require_member(find_membership(cur, group_id, request.args['user']), request.args['user'], group_id)
+
+    # connection of the request is handed over to the response, which holds it until it is fully sent
+    conn = g.pop('conn')
+    def generate():
+        with conn.cursor(name=f'export_group_{group_id}') as cur:
+            cur.itersize = export_batch_size
+            cur.execute(query, params)
+            yield routes.export_header(export_format)
+            while True:
+                rows = cur.fetchmany(export_batch_size)
+                if len(rows) == 0:
+                    break
+                yield routes.export_chunk(export_format, rows, lookups)
+    response = Response(generate(), mimetype=routes.export_formats[export_format],
+            headers=routes.export_headers(export_format, group_id))
+    response.call_on_close(lambda: props.pool.putconn(conn))
+    return response
 
 @app.route('/group/<int:group_id>/operation/', methods = ['POST'])
 def create_operation(group_id):
-    body = json.loads(request.data)
-    if not ('user' in body and 'type' in body and 'amount' in body and 'name' in body):
-        return make_response(jsonify({'error': 'request body is missing user, type, amount or name fields'}), 400)
-    if body['type'] not in ('income', 'spending'):
-        return make_response(jsonify({'error': f"operation type must be one of the ('income', 'spending'), but not '{body['type']}'"}), 400)
+    name, params = routes.new_operation(routes.json_body(request.data), group_id, lookups)
+    conn = get_conn()
+    conn.autocommit = True # the statement is a transaction by itself, so there are no BEGIN and COMMIT round trips
     try:
-        amount = float(body['amount'])
-    except ValueError:
-        return make_response(jsonify({'error': f'amount must be a floating point number (but is {body["amount"]})'}))
-    id = isinstance(body['user'], int)
-    with props.conn.cursor() as cur:
-        cur.execute('SELECT id FROM users_groups WHERE group_id = %s AND user_id = '
-                + ('%s' if id else '(SELECT id FROM users WHERE username = %s)'),
-                (group_id, body['user']))
-        res = cur.fetchone()
-        if res is None:
-            return make_response(jsonify({'error': f'user ({body["user"]}) is not found in the group ({group_id})'}), 400)
-        ug_id = res[0]
-        t = time.localtime()
-        cur.execute('INSERT INTO operations (user_id, group_id, type_id, amount, name, description, date) VALUES ('
-                + ('%s' if id else '(SELECT id FROM users WHERE username = %s)')
-                + ', %s, (SELECT id FROM operation_types WHERE name = %s), %s, %s, %s, %s)',
-                (body['user'], group_id, body['type'], amount, body['name'], body.get('description', ''),
-                    f'{t.tm_year}-{t.tm_mon}-{t.tm_mday} {t.tm_hour}:{t.tm_min}:{t.tm_sec}'))
-        cur.execute('UPDATE groups SET balance = balance ' + ('+' if body['type'] == 'income' else '-') + ' %s WHERE id = %s', (amount, group_id))
-        props.conn.commit()
-        return make_response(jsonify({'result': 'ok'}))
+        with conn.cursor() as cur:
+            statements.execute(cur, name, params)
+            res = cur.fetchone()
+    finally:
+        conn.autocommit = False
+    return make_response(jsonify(routes.created_operation_result(res, params[1], group_id)))
+
+@app.route('/group/<int:group_id>/operations/bulk', methods = ['POST'])
+def create_operations_bulk(group_id: int) -> Response:
+    '''Creates operations given as JSON array or CSV (uploaded as `file` or sent as text/csv body with a header line)
+        with the same fields as a single operation plus optional `date`. Either all of the operations are inserted
+        or none of them, in the latter case the errors are reported for each wrong row (numbered from 0).
+    '''
+    if 'file' in request.files:
+        rows = list(csv.DictReader(io.TextIOWrapper(request.files['file'].stream, encoding='utf-8')))
+    elif request.mimetype == 'text/csv':
+        rows = list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    else:
+        rows = routes.json_body(request.data)
+    rows = routes.bulk_rows(rows)
+    user_ids: Dict[str, Optional[int]] = {}
+    with get_conn().cursor() as cur:
+        statements.execute(cur, 'archived_before')
+        parsed, errors = routes.parse_bulk(rows, lookups, cur.fetchone()[0])
+        for user in set(operation[0] for _, operation in parsed):
+            membership = find_membership(cur, group_id, user)
+            user_ids[user] = None if membership is None else membership.user_id
+        routes.authorize_bulk(g.get('user'), user_ids, require_token)
+        operations = routes.bulk_operations(parsed, errors, user_ids, group_id, len(rows))
+        bulk = routes.bulk_import(operations, user_ids, group_id, lookups)
+        cur.copy_expert(queries.copy_operations, io.StringIO(bulk.csv))
+        statements.execute(cur, 'add_to_balance', (bulk.balance_change, group_id))
+        psycopg2.extras.execute_values(cur, queries.add_to_stats.format(values='%s'), bulk.stats)
+        psycopg2.extras.execute_values(cur, queries.shift_checkpoints.format(values='%s'), bulk.checkpoints)
+        get_conn().commit()
+        return make_response(jsonify({'result': 'ok', 'inserted': len(operations)}))
+
+def rebuild_stats() -> None:
+    '''Recalculates monthly statistics of all groups from the operations table (except the archived months).'''
+    with props.pool.connection() as conn, conn.cursor() as cur:
+        cur.execute('LOCK TABLE operation_stats IN EXCLUSIVE MODE')
+        cur.execute(queries.delete_stats)
+        cur.execute(queries.rebuild_stats)
+        print(f'Rebuilt operations statistics: {cur.rowcount} (group, user, type, month) rows')
+
+def create_checkpoints() -> None:
+    '''Creates balance checkpoints of the groups up to the current month and recalculates the existing ones
+        from the monthly statistics.
+    '''
+    with props.pool.connection() as conn, conn.cursor() as cur:
+        # bulk imports shift checkpoints after changing the statistics in the same transaction: the lock waits
+        #   for the imports which have shifted them already, later ones shift the checkpoints created here
+        cur.execute('LOCK TABLE balance_checkpoints IN SHARE ROW EXCLUSIVE MODE')
+        cur.execute(queries.create_checkpoints, {'income': lookups.operation_types['income'], 'until': routes.checkpoint_month()})
+        print(f'Updated balance checkpoints: {cur.rowcount} (group, month) rows')
+
+def close_checkpoints() -> None:
+    '''Creates balance checkpoints of the months closed since the last ones. Existing checkpoints are not changed,
+        and only one of the workers creates them at once.
+    '''
+    global checkpoints_month
+    month = routes.checkpoint_month()
+    if checkpoints_month == month:
+        return
+    with props.pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(queries.try_checkpoints_lock)
+        if not cur.fetchone()[0]:
+            return # another worker creates them, the next write checks again
+        cur.execute(queries.last_checkpoint)
+        since = cur.fetchone()[0]
+        if since is None or since < month:
+            cur.execute('LOCK TABLE balance_checkpoints IN SHARE ROW EXCLUSIVE MODE') # see `create_checkpoints`
+            cur.execute(queries.close_checkpoints, {'income': lookups.operation_types['income'], 'since': since, 'until': month})
+            print(f'Created balance checkpoints up to {month:%Y-%m}: {cur.rowcount} (group, month) rows')
+    checkpoints_month = month
+
+def close_month() -> None:
+    '''Creates partitions of the next months and balance checkpoints of the closed ones, run after writes once
+        a new month is seen, so that a long running server does not put new rows to the future partitions.
+    '''
+    if not month_lock.acquire(blocking=False):
+        return
+    try:
+        if partitions_month != partitions.current_month():
+            ensure_partitions(partitions_ahead)
+        close_checkpoints()
+    finally:
+        month_lock.release()
+
+def reconcile_balances() -> bool:
+    '''Checks balances of the groups and their checkpoints against the operations, prints the mismatches and returns
+        if there are none.
+    '''
+    with props.pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(queries.reconcile_balances, {'income': lookups.operation_types['income']})
+        mismatches = cur.fetchall()
+    for group_id, month, balance, ledger in mismatches:
+        print(f'Group {group_id} {"balance" if month is None else f"checkpoint of {month:%Y-%m}"} is {balance},'
+                f' but operations sum to {ledger}')
+    print(f'Reconciled balances: {len(mismatches)} mismatches')
+    return len(mismatches) == 0
+
+@app.route('/group/<int:group_id>/stats', methods = ['GET'])
+@readonly
+def get_stats(group_id: int) -> Response:
+    '''Returns totals and counts of the group operations grouped by any of the (user, type, month) given in `by`
+        parameter (comma-separated, all by default), optionally limited by `from` and `to` months (YYYY-MM, inclusive).
+    '''
+    user = routes.require_user(request.args)
+    columns, query, params = routes.stats_query(request.args, group_id)
+    with get_conn().cursor() as cur:
+        routes.require_member(find_membership(cur, group_id, user), user, group_id)
+        response = not_modified(group_version(cur, group_id))
+        if response is not None:
+            return response
+        cur.execute(query, params)
+        return stream_json('stats', routes.stats_result(columns, cur.fetchall(), lookups))
 
 # chats
 
 @app.route('/group/<int:group_id>/chat/', methods = ['GET'])
+@readonly
 def get_chat(group_id: int):
-    if not 'user' in request.args:
-        return make_response(jsonify({'error': f'user parameter is missing in request path'}), 400)
-    id = request.args['user'].isnumeric()
-    page = int(request.args.get('page', 0))
-    with props.conn.cursor() as cur:
-        cur.execute('SELECT count(*) FROM users_groups '
-                + ('WHERE group_id = %s AND user_id = %s' if id else
-                        'ug JOIN users u ON u.id = ug.user_id WHERE ug.group_id = %s AND u.username = %s'), (group_id, request.args['user'],))
-        if cur.fetchone()[0] != 1:
-            return make_response(jsonify({'error': f'user ({request.args["user"]}) is not in the given group ({group_id})'}), 403)
-        cur.execute('SELECT m.id, ug.user_id, u.username, m.message, m.time FROM users_groups ug JOIN users u ON ug.user_id = u.id'
-                '   JOIN messages m on m.user_group_id = ug.id WHERE ug.group_id = %s ORDER BY id DESC LIMIT %s OFFSET %s', (group_id, 50, 50 * page))
-        res = pandas.DataFrame(cur.fetchall(), columns=('message_id', 'user_id', 'user', 'message', 'time'))
-        res['time'] = res['time'].apply(lambda t: f'{t.year:02}-{t.month:02}-{t.day:02} {t.hour:02}:{t.minute:02}:{t.second:02}')
-        return make_response(jsonify({
-            'messages': list(res.transpose().to_dict().values())
-        }))
+    user = routes.require_user(request.args)
+    with get_conn().cursor() as cur:
+        routes.require_member(find_membership(cur, group_id, user), user, group_id)
+        response = not_modified(group_version(cur, group_id))
+        if response is not None:
+            return response
+        rows, next_cursor, prev_cursor = keyset_page(cur, 'messages', (group_id,), (4, 0))
+        return stream_json('messages', routes.messages_result(rows), {'next': next_cursor, 'prev': prev_cursor})
         
 
+# search
+
+@app.route('/group/<int:group_id>/search', methods = ['GET'])
+@readonly
+def search_group(group_id: int) -> Response:
+    '''Returns chat messages and operations of the group matching `q` (words, "quoted phrases", `or` and `-excluded`
+        words), the most relevant and then the newest ones first, paged with `after` cursors.
+    '''
+    query, params, limit = routes.search_query(request.args, group_id)
+    with get_conn().cursor() as cur:
+        routes.require_member(find_membership(cur, group_id, request.args['user']), request.args['user'], group_id)
+        response = not_modified(group_version(cur, group_id))
+        if response is not None:
+            return response
+        cur.execute(query, params)
+        results, next_cursor = search_result(cur.fetchall(), limit, lookups.operation_type_names.get)
+        return stream_json('results', results, {'next': next_cursor})
+
 @app.route('/group/<int:group_id>/chat/', methods = ['POST'])
 def send_to_chat(group_id: int):
-    body = json.loads(request.data)
-    if not 'user' in body:
-        return make_response(jsonify({'error': f'user parameter is missing in request body'}))
-    id = body['user'].isnumeric()
-    with props.conn.cursor() as cur:
-        cur.execute('SELECT ug.id FROM users_groups ug JOIN users u ON u.id = ug.user_id WHERE u.username = %s' if id else 'WHERE ug.id = %s', (body['user'],))
-        res = cur.fetchall()
-        if len(res) == 0:
-            return make_response(jsonify({'error': f'user ({body["user"]}) is not in the given group ({group_id})'}), 403)
-        cur.execute('INSERT INTO messages (user_group_id, time, message) VALUES (%s, %s %s)', (res[0][0]))
-        props.conn.commit()
-        return make_response(jsonify({'result': 'ok'}))
+    body = routes.require_fields(routes.json_body(request.data), ('user', 'message'))
+    with get_conn().cursor() as cur:
+        membership = routes.require_member(find_membership(cur, group_id, body['user']), body['user'], group_id)
+        statements.execute(cur, *routes.send_message_statement(membership, group_id, body['message']))
+        get_conn().commit()
+        return make_response(jsonify({'result': 'ok', 'message_id': cur.fetchone()[0]}))
+
+def fetch_message(message_id: int) -> Optional[dict]:
+    with props.pool.connection() as conn, conn.cursor() as cur:
+        statements.execute(cur, 'get_message', (message_id,))
+        return next(routes.messages_result(cur.fetchall()), None)
+
+def get_chat_listener() -> ChatListener:
+    global chat_listener
+    if chat_listener is None:
+        chat_listener = ChatListener(props.conn_string, fetch_message)
+    return chat_listener
+
+@app.route('/group/<int:group_id>/chat/stream', methods = ['GET'])
+def chat_stream(group_id: int) -> Response:
+    '''Sends new messages of the group chat as Server-Sent Events. Stream does not hold a database connection,
+        messages come from the shared LISTEN connection, but it holds a request thread, so only `sse_streams`
+        of them are served at once.
+    '''
+    user = routes.require_user(request.args)
+    with get_conn().cursor() as cur:
+        routes.require_member(find_membership(cur, group_id, user), user, group_id)
+    if not sse_streams.acquire(blocking=False):
+        raise ApiError('too many chat streams are open, try again later', 503)
+    listener = get_chat_listener()
+    def generate():
+        messages = listener.subscribe(group_id)
+        try:
+            yield routes.sse_start
+            while True:
+                try:
+                    message = messages.get(timeout=sse_keepalive)
+                except queue.Empty:
+                    yield routes.sse_keepalive_event
+                    continue
+                yield routes.sse_message(message)
+        finally:
+            listener.unsubscribe(group_id, messages)
+    response = Response(generate(), mimetype='text/event-stream', headers=routes.sse_headers)
+    response.call_on_close(sse_streams.release) # also when the stream is closed before it starts
+    return response
 
 # api help
 
@@ -357,29 +691,63 @@ def api():
         }
     }))
 
+@app.route('/api/cache/', methods = ['GET'])
+def api_cache():
+    return make_response(jsonify({
+        'memberships': memberships.stats,
+        'pool': props.pool.stats,
+        'statements': statements.stats,
+        'chat_listener': get_chat_listener().stats,
+        'replicas': replicas.stats if replicas is not None else None,
+        'password_hasher': hasher.stats
+    }))
+
+@app.route('/metrics', methods = ['GET'])
+def get_metrics() -> Response:
+    '''Returns requests and database statements metrics with pool and caches state in Prometheus text format.'''
+    gauges = {'pool': props.pool.stats, 'memberships': memberships.stats, 'password_hasher': hasher.stats}
+    if chat_listener is not None:
+        gauges['chat_listener'] = chat_listener.stats
+    if replicas is not None:
+        gauges['replicas'] = replicas.stats
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
 # errors handling
 
 @app.errorhandler(Exception)
 def any_error(error: Exception) -> Response:
-    props.conn.rollback()
-    print(f'path: {request.path}?{"&".join(map(lambda x: f"{x[0]}={x[1]}", request.args.items()))}, body={request.data.decode()}')
-    traceback.print_exc()
+    if 'conn' in g and not g.conn.closed: # the connection may have been closed by the server
+        g.conn.rollback()
+    return make_response(jsonify(routes.error_result(error, request.path, request.args, request.data.decode())), 500)
+
+@app.errorhandler(ApiError)
+def api_error(error: ApiError) -> Response:
+    return make_response(jsonify(routes.api_error_result(error)), error.status)
+
+@app.errorhandler(BadCursor)
+def bad_cursor_error(error: BadCursor) -> Response:
     return make_response(jsonify({
         'error': str(error),
-        'error_type': str(type(error)),
-        'path': request.path,
-        'body': request.data.decode(),
-        'params': '&'.join(map(lambda x: f'{x[0]}={x[1]}', request.args.items())),
-        'trace': list(itertools.chain(*map(lambda x: x.split('\n'), traceback.format_tb(error.__traceback__))))
-    }), 500)
+        'path': request.path
+    }), 400)
+
+@app.errorhandler(PoolTimeout)
+def pool_timeout_error(error: PoolTimeout) -> Response:
+    return make_response(jsonify({
+        'error': str(error),
+        'path': request.path
+    }), 503)
+
+@app.errorhandler(HasherBusy)
+def hasher_busy_error(error: HasherBusy) -> Response:
+    return make_response(jsonify({
+        'error': str(error),
+        'path': request.path
+    }), 503)
 
 @app.errorhandler(404)
 def not_found_error(_) -> Response:
-    return make_response(jsonify({
-        'error': 'not found',
-        'path': request.path,
-        'params': '&'.join(map(lambda x: f'{x[0]}={x[1]}', request.args.items())),
-    }), 404)
+    return make_response(jsonify(routes.not_found_result(request.path, request.args)), 404)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Starts up the finances app API server')
@@ -395,12 +763,136 @@ if __name__ == '__main__':
                         help=f'database user password', type=str, default='postgres')
     parser.add_argument('-p', '--port', action='store', dest='api_port',
                         help=f'api port number', type=int, default=3001)
+    parser.add_argument('-m', '--db_pool_min', action='store', dest='db_pool_min',
+                        help=f'minimal number of database connections kept open', type=int, default=1)
+    parser.add_argument('-M', '--db_pool_max', action='store', dest='db_pool_max',
+                        help=f'maximal number of database connections', type=int, default=10)
+    parser.add_argument('-T', '--db_pool_timeout', action='store', dest='db_pool_timeout',
+                        help=f'seconds to wait for a free database connection', type=float, default=10.0)
+    parser.add_argument('-c', '--membership_cache_size', action='store', dest='membership_cache_size',
+                        help=f'number of (group, user) memberships kept in memory, 0 to disable', type=int, default=10000)
+    parser.add_argument('-t', '--membership_cache_ttl', action='store', dest='membership_cache_ttl',
+                        help=f'seconds a cached membership stays valid', type=float, default=30.0)
+    parser.add_argument('-b', '--export_batch_size', action='store', dest='export_batch_size',
+                        help=f'number of operations read from the database at once on export', type=int, default=1000)
+    parser.add_argument('--rebuild_stats', action='store_true', dest='rebuild_stats',
+                        help=f'recalculate operations statistics from the whole ledger and exit')
+    parser.add_argument('--checkpoint_balances', action='store_true', dest='checkpoint_balances',
+                        help=f'create balance checkpoints of the past months and exit')
+    parser.add_argument('--reconcile_balances', action='store_true', dest='reconcile_balances',
+                        help=f'check balances of the groups against their operations and exit (with status 1 on mismatches)')
+    parser.add_argument('--partitions_ahead', action='store', dest='partitions_ahead',
+                        help=f'number of next months partitions of operations and messages are created for at startup and when a month starts', type=int, default=3)
+    parser.add_argument('--archive_before', action='store', dest='archive_before',
+                        help=f'archive operations and messages older than this month (YYYY-MM) to --archive_dir and exit', type=str, default=None)
+    parser.add_argument('--archive_dir', action='store', dest='archive_dir',
+                        help=f'directory archived partitions are written to as gzipped CSV files', type=str, default='archive')
+    parser.add_argument('-q', '--slow_query_ms', action='store', dest='slow_query_ms',
+                        help=f'print database statements running longer than this number of milliseconds', type=float, default=None)
+    parser.add_argument('--no_prepared_statements', action='store_true', dest='no_prepared_statements',
+                        help=f'execute statements of the hot paths as plain queries instead of prepared ones')
+    parser.add_argument('-s', '--server', action='store', dest='server',
+                        help=f'server mode: threaded Flask with psycopg2 (sync) or Quart with psycopg 3 (async)',
+                        type=str, choices=('sync', 'async'), default='sync')
+    parser.add_argument('-R', '--db_replica', action='append', dest='db_replicas',
+                        help=f'read-only replica as host[:port] or connection string, can be given several times', type=str, default=None)
+    parser.add_argument('--replica_stickiness', action='store', dest='replica_stickiness',
+                        help=f'seconds reads of a user who changed data are served by the primary', type=float, default=5.0)
+    parser.add_argument('--replica_max_lag', action='store', dest='replica_max_lag',
+                        help=f'seconds of replication lag after which a replica is not used', type=float, default=10.0)
+    parser.add_argument('--token_secret', action='store', dest='token_secret',
+                        help=f'key signing session tokens, random one (tokens are invalid after restart) by default', type=str, default=None)
+    parser.add_argument('--token_ttl', action='store', dest='token_ttl',
+                        help=f'seconds a session token is valid for', type=float, default=86400.0)
+    parser.add_argument('--require_token', action='store_true', dest='require_token',
+                        help=f'reject requests made by a user without a token of the user')
+    parser.add_argument('--hash_workers', action='store', dest='hash_workers',
+                        help=f'number of processes hashing passwords (in every worker process)', type=int, default=2)
+    parser.add_argument('--hash_queue', action='store', dest='hash_queue',
+                        help=f'number of passwords waiting to be hashed, after which logins are answered with 503', type=int, default=32)
+    parser.add_argument('-w', '--workers', action='store', dest='workers',
+                        help=f'number of pre-forked worker processes (sync server), 0 to serve in one process', type=int, default=0)
+    parser.add_argument('--threads', action='store', dest='threads',
+                        help=f'number of request threads of each worker process', type=int, default=32)
+    parser.add_argument('--sse_streams', action='store', dest='sse_streams',
+                        help=f'number of chat streams served at once by each worker process (sync server), further ones are answered with 503', type=int, default=16)
+    parser.add_argument('--max_requests', action='store', dest='max_requests',
+                        help=f'number of requests after which a worker process is replaced, 0 to keep workers', type=int, default=10000)
+    parser.add_argument('--graceful_timeout', action='store', dest='graceful_timeout',
+                        help=f'seconds workers finish requests in progress for on shutdown', type=int, default=30)
     args = parser.parse_args()
-
-    props = Properties(args.db_addr, args.db_port, args.db_name, args.db_user, args.db_pass, args.api_port)
-
-    print(f'Starting finances app API server at port {props.api_port}.')
-    print(f'Using postgresql database: {props.db_user}@{props.db_addr}:{props.db_port}/{props.db_name}')
+    if args.workers != 0 and args.server != 'sync':
+        parser.error('workers can only be used with sync server')
+    if args.db_replicas is not None and args.server != 'sync':
+        parser.error('replicas can only be used with sync server')
+    if args.sse_streams < 0 or (args.workers != 0 and args.sse_streams >= args.threads):
+        parser.error('sse_streams must not be negative and must leave some of the threads to other requests')
+    if args.hash_workers < 1:
+        parser.error('at least one hash worker is needed')
+    if args.archive_before is not None:
+        try:
+            archive_before = datetime.datetime.strptime(args.archive_before, '%Y-%m').date()
+        except ValueError:
+            parser.error(f'archive_before must be in YYYY-MM format (but is {args.archive_before})')
+        if archive_before > datetime.date.today().replace(day=1):
+            parser.error('months after the current one can not be archived')
+
+    props = Properties(args.db_addr, args.db_port, args.db_name, args.db_user, args.db_pass, args.api_port,
+            args.db_pool_min, args.db_pool_max, args.db_pool_timeout)
+    memberships = MembershipCache(args.membership_cache_size, args.membership_cache_ttl)
+    export_batch_size = args.export_batch_size
+    partitions_ahead = args.partitions_ahead
+    sse_streams = threading.BoundedSemaphore(args.sse_streams)
+    statements.enabled = not args.no_prepared_statements
+    # the secret is chosen before fork, so that all of the workers accept the same tokens
+    tokens = TokenSigner(args.token_secret.encode() if args.token_secret is not None else os.urandom(32), args.token_ttl)
+    require_token = args.require_token
+    hasher = PasswordHasher(args.hash_workers, args.hash_queue)
+    if args.db_replicas is not None:
+        # reads wait for a busy replica shortly, as they can be served by the primary
+        replicas = ReplicaSet([replica_conn_string(replica, args.db_name, args.db_user, args.db_pass) for replica in args.db_replicas],
+                lambda conn_string: ConnectionPool(conn_string, props.pool_min, props.pool_max, min(props.pool_timeout, 1.0),
+                    connection_factory=PreparingConnection, cursor_factory=TimedCursor),
+                args.replica_stickiness, args.replica_max_lag)
+    if args.slow_query_ms is not None:
+        metrics.slow_query_threshold = args.slow_query_ms / 1000
+
+    print(f'Starting finances app API server ({args.server}{f", {args.workers} workers" if args.workers != 0 else ""})'
+            f' at port {props.api_port}.')
+    print(f'Using postgresql database: {props.db_user}@{props.db_addr}:{props.db_port}/{props.db_name}'
+            f' (pool of {props.pool_min}-{props.pool_max} connections{" in every worker" if args.workers != 0 else ""})')
+    if replicas is not None:
+        print(f'Read-only routes are served by {len(replicas.replicas)} replicas')
 
     ensure_tables()
-    app.run(host='0.0.0.0', port=props.api_port)
\ No newline at end of file
+    ensure_partitions(partitions_ahead)
+    if args.rebuild_stats:
+        rebuild_stats()
+    if args.rebuild_stats or args.checkpoint_balances:
+        create_checkpoints()
+        props.close()
+        exit(0)
+    if args.reconcile_balances:
+        reconciled = reconcile_balances()
+        props.close()
+        exit(0 if reconciled else 1)
+    if args.archive_before is not None:
+        close_checkpoints() # checkpoints of the months to be archived keep their balances
+        archive_partitions(archive_before, args.archive_dir)
+        props.close()
+        exit(0)
+    if args.server == 'async':
+        props.close() # async server opens its own pool
+        import backend_async
+        backend_async.run(props, lookups, memberships, export_batch_size, hasher, tokens, require_token, partitions_ahead)
+    elif args.workers != 0:
+        props.close() # every worker opens its own pool after fork
+        import prefork
+        prefork.run(app, props.api_port, args.workers, args.threads, args.max_requests, args.graceful_timeout,
+                init_worker=warm_up, exit_worker=shut_down)
+    else:
+        hasher.start()
+        try:
+            app.run(host='0.0.0.0', port=props.api_port, threaded=True)
+        finally:
+            shut_down()
\ No newline at end of file
@@ -0,0 +1,606 @@
+'''Async variant of the API server: the same routes and JSON contracts as `backend.py`, served by Quart (ASGI)
+    on hypercorn with psycopg 3 async connections pool.
+
+Requests are validated and responses are built by `routes.py` for both of the servers, so routes here only run
+    the registered statements (as plain queries) and send the results. It is started with `backend.py --server async`
+    after the migrations are applied and lookups are loaded.
+'''
+import asyncio
+import csv
+import datetime
+import io
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import psycopg
+import psycopg_pool
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from quart import Quart, Response, g, jsonify, request
+
+import partitions
+import queries
+import routes
+from auth import HasherBusy, PasswordHasher, TokenSigner
+from cache import Membership, MembershipCache
+from chat_async import AsyncChatListener
+from lookups import Lookups
+from metrics import metrics
+from pagination import keyset_direction, keyset_params, keyset_result, page_args, page_limit, search_result
+from routes import ApiError
+from serialization import BadCursor, make_etag
+from statements import registry as statements
+
+_version = '2021-01-30'
+
+app = Quart(__name__)
+props = None # backend.Properties
+lookups: Lookups
+memberships = MembershipCache()
+export_batch_size = 1000
+pool: psycopg_pool.AsyncConnectionPool
+chat_listener: Optional[AsyncChatListener] = None
+sse_keepalive = 15.0
+hasher: PasswordHasher
+tokens: TokenSigner
+require_token = False
+partitions_ahead = 3
+partitions_month: Optional[datetime.date] = None # month the partitions ahead are created from
+checkpoints_month: Optional[datetime.date] = None # latest month the balance checkpoints are created for
+month_task: Optional[asyncio.Task] = None
+month_retry = 60.0 # seconds before `close_month` is tried again, if another worker does it or it fails
+month_tried = float('-inf')
+
+class TimedAsyncCursor(psycopg.AsyncCursor):
+    '''Cursor recording duration and row count of every statement it executes to `metrics`, see `metrics.TimedCursor`.'''
+    async def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            metrics.observe_query(query, time.perf_counter() - start, self.rowcount)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().executemany(query, params_seq, **kwargs)
+        finally:
+            metrics.observe_query(query, time.perf_counter() - start, self.rowcount)
+
+@app.before_serving
+async def open_pool() -> None:
+    global pool
+    pool = psycopg_pool.AsyncConnectionPool(props.conn_string, props.pool_min, props.pool_max, timeout=props.pool_timeout,
+            check=psycopg_pool.AsyncConnectionPool.check_connection, kwargs={'cursor_factory': TimedAsyncCursor}, open=False)
+    await pool.open(wait=True)
+
+@app.after_serving
+async def close_pool() -> None:
+    if chat_listener is not None:
+        await chat_listener.stop()
+    hasher.close()
+    await pool.close()
+
+@app.before_request
+async def before_request() -> None:
+    g.request_start = time.perf_counter()
+    await authenticate()
+
+@app.after_request
+async def after_request(response: Response) -> Response:
+    if 'request_start' in g: # streamed responses are measured until their body starts to be sent
+        metrics.observe_request(request.url_rule.rule if request.url_rule is not None else 'unmatched', request.method,
+                response.status_code, time.perf_counter() - g.request_start)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Methods'] = '*'
+    # the wildcard does not cover Authorization
+    response.headers['Access-Control-Allow-Headers'] = '*, Authorization'
+    if request.method not in ('GET', 'HEAD') and response.status_code < 400 and \
+            (partitions_month != partitions.current_month() or checkpoints_month != routes.checkpoint_month()):
+        start_closing_month()
+    if 'etag' in g and response.status_code in (200, 304):
+        response.set_etag(g.etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+async def get_conn() -> psycopg.AsyncConnection:
+    '''Returns database connection of the current request, taking it from the pool on the first call.'''
+    if 'conn' not in g:
+        g.conn = await pool.getconn()
+    return g.conn
+
+@app.teardown_request
+async def release_conn(_) -> None:
+    conn = g.pop('conn', None)
+    if conn is not None:
+        if conn.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+            await conn.rollback()
+        await pool.putconn(conn)
+
+async def execute(cur: psycopg.AsyncCursor, name: str, params=()) -> None:
+    '''Executes the registered statement as a plain query (async connections do not prepare them).'''
+    await cur.execute(statements[name].sql, params)
+
+async def find_membership(cur: psycopg.AsyncCursor, group_id: int, user, cached: bool = True) -> Optional[Membership]:
+    '''Returns membership of the user (given by id or username) in the group, see `backend.find_membership`.'''
+    user = str(user)
+    membership = memberships.get(group_id, user) if cached else None
+    if membership is not None:
+        return membership
+    generation = memberships.generation
+    await execute(cur, f'find_membership_{queries.user_variant(user)}', (group_id, user))
+    res = await cur.fetchone()
+    if res is None:
+        return None
+    membership = Membership(*res)
+    memberships.put(group_id, user, membership, generation)
+    return membership
+
+async def group_version(cur: psycopg.AsyncCursor, group_id: int) -> Optional[int]:
+    await execute(cur, 'group_version', (group_id,))
+    res = await cur.fetchone()
+    return None if res is None else res[0]
+
+def not_modified(version) -> Optional[Tuple[str, int]]:
+    '''Sets ETag of the response to the hash of data version and request path with parameters.
+
+    Returns 304 response if the client already has this version, None otherwise.
+    '''
+    g.etag = make_etag(version, request.full_path)
+    if request.if_none_match.contains_weak(g.etag):
+        return '', 304
+    return None
+
+async def keyset_page(cur: psycopg.AsyncCursor, name: str, params: tuple,
+        key_indexes: Tuple[int, int]) -> Tuple[list, Optional[str], Optional[str]]:
+    '''Executes statement returning one page of rows ordered from the newest to the oldest one, see `backend.keyset_page`.'''
+    after, before, limit = page_args(request.args)
+    await execute(cur, f'{name}_{keyset_direction(after, before)}', keyset_params(params, after, before, limit))
+    return keyset_result(await cur.fetchall(), key_indexes, after, before, limit)
+
+async def body_json() -> Any:
+    return await request.get_json(force=True, silent=True) if request.mimetype != 'multipart/form-data' else None
+
+async def authenticate() -> None:
+    '''Verifies token of the request, see `routes.authenticate`.'''
+    user = routes.authenticate(request.headers.get('Authorization'),
+            routes.acting_users(request.args, await body_json(), request.view_args), tokens, require_token)
+    if user is not None:
+        g.user = user
+
+# groups
+
+@app.route('/group/<int:group_id>/', methods = ['GET'])
+async def get_group(group_id: int):
+    async with (await get_conn()).cursor() as cur:
+        await execute(cur, 'get_group', (group_id,))
+        res = await cur.fetchone()
+        if res is None:
+            raise ApiError(f'group with id={group_id} is not found', 404)
+        response = not_modified(res[-1])
+        if response is not None:
+            return response
+        statement = routes.group_users_statement(group_id, request.args.get('status'), lookups)
+        users = []
+        if statement is not None:
+            await execute(cur, *statement)
+            users = await cur.fetchall()
+        return jsonify(routes.group_result(group_id, res[:-1], users, lookups))
+
+@app.route('/group/', methods = ['POST'])
+async def add_group():
+    query, params = routes.new_group(routes.json_body(await request.get_data()))
+    conn = await get_conn()
+    async with conn.cursor() as cur:
+        await cur.execute(query, params)
+        id, creator_id = await cur.fetchone()
+        await cur.execute(queries.add_membership, (creator_id, id, lookups.statuses['creator']))
+        user_group_id = (await cur.fetchone())[0]
+        await conn.commit()
+        return jsonify({'group_id': id, 'user_group_id': user_group_id})
+
+@app.route('/group/<int:group_id>/', methods = ['DELETE'])
+async def delete_group(group_id: int):
+    user = routes.require_user(request.args)
+    conn = await get_conn()
+    async with conn.cursor() as cur:
+        routes.require_creator(await find_membership(cur, group_id, user, cached=False), lookups)
+        await cur.execute(queries.delete_group, (group_id,))
+        await conn.commit()
+        memberships.invalidate_group(group_id)
+        return jsonify({'result': f'deleted group with id={group_id}'})
+
+@app.route('/group/<int:group_id>/page', methods = ['GET'])
+async def get_group_page(group_id: int):
+    user = routes.require_user(request.args)
+    limit = page_limit(request.args)
+    async with (await get_conn()).cursor() as cur:
+        routes.require_member(await find_membership(cur, group_id, user), user, group_id)
+        response = not_modified(await group_version(cur, group_id))
+        if response is not None:
+            return response
+        await execute(cur, 'group_page', {'group_id': group_id, 'limit': limit + 1})
+        res = await cur.fetchone()
+    return jsonify(routes.group_page_result(group_id, res, limit, lookups))
+
+# users - groups
+
+@app.route('/user/<user>/groups/', methods = ['GET'])
+async def get_user_groups(user: str):
+    async with (await get_conn()).cursor() as cur:
+        await execute(cur, f'user_groups_version_{queries.user_variant(user)}', (user,))
+        response = not_modified((await cur.fetchone())[0])
+        if response is not None:
+            return response
+        await execute(cur, *routes.user_groups_statement(user, request.args.get('status'), lookups))
+        return jsonify({'groups': list(routes.user_groups_result(await cur.fetchall(), lookups))})
+
+@app.route('/group/<int:group_id>/join/', methods = ['POST'])
+async def user_to_group(group_id: int):
+    user = routes.require_user(request.args)
+    conn = await get_conn()
+    async with conn.cursor() as cur:
+        await execute(cur, *routes.join_statement(group_id, user, lookups))
+        await execute(cur, 'bump_version', (group_id,))
+        await conn.commit()
+        memberships.invalidate_group(group_id)
+        return jsonify({'result': 'ok'})
+
+@app.route('/group/<int:group_id>/status/<user>/', methods = ['PUT'])
+async def user_set_status(group_id: int, user: str):
+    status_id = routes.new_status(request.args, lookups)
+    conn = await get_conn()
+    async with conn.cursor() as cur:
+        routes.require_status_rights(await find_membership(cur, group_id, request.args['user'], cached=False),
+                request.args['status'], lookups)
+        membership = routes.require_member(await find_membership(cur, group_id, user, cached=False), user, group_id)
+        await execute(cur, 'set_status', (status_id, membership.id))
+        await execute(cur, 'bump_version', (group_id,))
+        await conn.commit()
+        memberships.invalidate_group(group_id)
+        return jsonify({'result': 'ok'})
+
+# users
+
+@app.route('/user/', methods = ['POST'])
+async def add_user():
+    username, password = routes.new_user(routes.json_body(await request.get_data()))
+    password = await asyncio.wrap_future(hasher.hash(password))
+    conn = await get_conn()
+    try:
+        async with conn.cursor() as cur:
+            await cur.execute(queries.add_user, routes.add_user_params(username, password))
+            id = (await cur.fetchone())[0]
+            await conn.commit()
+            return jsonify({'result': f'added user with id={id}'})
+    except psycopg.DatabaseError as ex:
+        print(ex)
+        await conn.rollback()
+        raise ApiError(f"User with username '{username}' already exists")
+
+@app.route('/user/<int:id>/', methods = ['GET'])
+async def get_user(id: int):
+    async with (await get_conn()).cursor() as cur:
+        await execute(cur, 'get_user', (id,))
+        res = await cur.fetchall()
+        if len(res) == 0:
+            raise ApiError('user not found', 404)
+        return jsonify({'username': res[0]})
+
+@app.route('/login/', methods = ['POST'])
+async def login():
+    username, password = routes.login_body(routes.json_body(await request.get_data()))
+    async with (await get_conn()).cursor() as cur:
+        await execute(cur, 'user_password', (username,))
+        res = await cur.fetchone()
+    await release_conn(None) # the connection is not held while the password is checked
+    if res is None:
+        return jsonify({'result': 'wrong username or password'}), 403
+    user_id, stored = res
+    matches, rehash = await asyncio.wrap_future(hasher.check(password, stored))
+    if not matches:
+        return jsonify({'result': 'wrong username or password'}), 403
+    if rehash:
+        hashed = await asyncio.wrap_future(hasher.hash(password))
+        conn = await get_conn()
+        async with conn.cursor() as cur:
+            await cur.execute(queries.set_password, (hashed, user_id))
+        await conn.commit()
+    return jsonify({'result': 'ok', 'token': tokens.issue(user_id, username)})
+
+# operations
+
+@app.route('/group/<int:group_id>/operations/', methods = ['GET'])
+async def get_operations(group_id: int):
+    user = routes.require_user(request.args)
+    async with (await get_conn()).cursor() as cur:
+        routes.require_member(await find_membership(cur, group_id, user), user, group_id)
+        response = not_modified(await group_version(cur, group_id))
+        if response is not None:
+            return response
+        rows, next_cursor, prev_cursor = await keyset_page(cur, 'operations', (group_id,), (6, 0))
+        balances = None
+        statement = routes.running_balances_statement(request.args, group_id, rows, lookups)
+        if statement is not None:
+            await execute(cur, *statement)
+            balances = dict(await cur.fetchall())
+        return jsonify({'operations': list(routes.operations_result(rows, lookups, balances)), 'next': next_cursor, 'prev': prev_cursor})
+
+@app.route('/group/<int:group_id>/balance', methods = ['GET'])
+async def get_balance(group_id: int):
+    user = routes.require_user(request.args)
+    name, params = routes.balance_statement(request.args, group_id, lookups)
+    async with (await get_conn()).cursor() as cur:
+        routes.require_member(await find_membership(cur, group_id, user), user, group_id)
+        response = not_modified(await group_version(cur, group_id))
+        if response is not None:
+            return response
+        await execute(cur, name, params)
+        res = await cur.fetchone()
+    return jsonify(routes.balance_result(params, res))
+
+@app.route('/group/<int:group_id>/operations/export', methods = ['GET'])
+async def export_operations(group_id: int):
+    export_format, query, params = routes.export_query(request.args, group_id)
+    async with (await get_conn()).cursor() as cur:
+        routes.require_member(await find_membership(cur, group_id, request.args['user']), request.args['user'], group_id)
+
+    async def generate():
+        # connection is held by the response until it is fully sent, not by the request
+        async with pool.connection() as conn, conn.cursor(name=f'export_group_{group_id}') as cur:
+            cur.itersize = export_batch_size
+            await cur.execute(query, params)
+            yield routes.export_header(export_format)
+            while True:
+                rows = await cur.fetchmany(export_batch_size)
+                if len(rows) == 0:
+                    break
+                yield routes.export_chunk(export_format, rows, lookups)
+    response = Response(generate(), mimetype=routes.export_formats[export_format],
+            headers=routes.export_headers(export_format, group_id))
+    response.timeout = None
+    return response
+
+@app.route('/group/<int:group_id>/operation/', methods = ['POST'])
+async def create_operation(group_id: int):
+    name, params = routes.new_operation(routes.json_body(await request.get_data()), group_id, lookups)
+    conn = await get_conn()
+    await conn.set_autocommit(True) # the statement is a transaction by itself, so there are no BEGIN and COMMIT round trips
+    try:
+        async with conn.cursor() as cur:
+            await execute(cur, name, params)
+            res = await cur.fetchone()
+    finally:
+        await conn.set_autocommit(False)
+    return jsonify(routes.created_operation_result(res, params[1], group_id))
+
+@app.route('/group/<int:group_id>/operations/bulk', methods = ['POST'])
+async def create_operations_bulk(group_id: int):
+    files = await request.files
+    if 'file' in files:
+        rows = list(csv.DictReader(io.StringIO(files['file'].read().decode('utf-8'))))
+    elif request.mimetype == 'text/csv':
+        rows = list(csv.DictReader(io.StringIO(await request.get_data(as_text=True))))
+    else:
+        rows = routes.json_body(await request.get_data())
+    rows = routes.bulk_rows(rows)
+    user_ids: Dict[str, Optional[int]] = {}
+    conn = await get_conn()
+    async with conn.cursor() as cur:
+        await execute(cur, 'archived_before')
+        parsed, errors = routes.parse_bulk(rows, lookups, (await cur.fetchone())[0])
+        for user in set(operation[0] for _, operation in parsed):
+            membership = await find_membership(cur, group_id, user)
+            user_ids[user] = None if membership is None else membership.user_id
+        routes.authorize_bulk(g.get('user'), user_ids, require_token)
+        operations = routes.bulk_operations(parsed, errors, user_ids, group_id, len(rows))
+        bulk = routes.bulk_import(operations, user_ids, group_id, lookups)
+        async with cur.copy(queries.copy_operations) as copy:
+            await copy.write(bulk.csv)
+        await execute(cur, 'add_to_balance', (bulk.balance_change, group_id))
+        await cur.executemany(queries.add_to_stats.format(values='(%s, %s, %s, %s, %s, %s)'), bulk.stats)
+        await cur.executemany(queries.shift_checkpoints.format(values='(%s::integer, %s::date, %s::float)'), bulk.checkpoints)
+        await conn.commit()
+        return jsonify({'result': 'ok', 'inserted': len(operations)})
+
+@app.route('/group/<int:group_id>/stats', methods = ['GET'])
+async def get_stats(group_id: int):
+    user = routes.require_user(request.args)
+    columns, query, params = routes.stats_query(request.args, group_id)
+    async with (await get_conn()).cursor() as cur:
+        routes.require_member(await find_membership(cur, group_id, user), user, group_id)
+        response = not_modified(await group_version(cur, group_id))
+        if response is not None:
+            return response
+        await cur.execute(query, params)
+        return jsonify({'stats': list(routes.stats_result(columns, await cur.fetchall(), lookups))})
+
+# chats
+
+@app.route('/group/<int:group_id>/chat/', methods = ['GET'])
+async def get_chat(group_id: int):
+    user = routes.require_user(request.args)
+    async with (await get_conn()).cursor() as cur:
+        routes.require_member(await find_membership(cur, group_id, user), user, group_id)
+        response = not_modified(await group_version(cur, group_id))
+        if response is not None:
+            return response
+        rows, next_cursor, prev_cursor = await keyset_page(cur, 'messages', (group_id,), (4, 0))
+        return jsonify({'messages': list(routes.messages_result(rows)), 'next': next_cursor, 'prev': prev_cursor})
+
+# search
+
+@app.route('/group/<int:group_id>/search', methods = ['GET'])
+async def search_group(group_id: int):
+    query, params, limit = routes.search_query(request.args, group_id)
+    async with (await get_conn()).cursor() as cur:
+        routes.require_member(await find_membership(cur, group_id, request.args['user']), request.args['user'], group_id)
+        response = not_modified(await group_version(cur, group_id))
+        if response is not None:
+            return response
+        await cur.execute(query, params)
+        results, next_cursor = search_result(await cur.fetchall(), limit, lookups.operation_type_names.get)
+        return jsonify({'results': results, 'next': next_cursor})
+
+@app.route('/group/<int:group_id>/chat/', methods = ['POST'])
+async def send_to_chat(group_id: int):
+    body = routes.require_fields(routes.json_body(await request.get_data()), ('user', 'message'))
+    conn = await get_conn()
+    async with conn.cursor() as cur:
+        membership = routes.require_member(await find_membership(cur, group_id, body['user']), body['user'], group_id)
+        await execute(cur, *routes.send_message_statement(membership, group_id, body['message']))
+        message_id = (await cur.fetchone())[0]
+        await conn.commit()
+        return jsonify({'result': 'ok', 'message_id': message_id})
+
+def start_closing_month() -> None:
+    global month_task, month_tried
+    if (month_task is None or month_task.done()) and time.monotonic() - month_tried >= month_retry:
+        month_tried = time.monotonic()
+        month_task = asyncio.get_running_loop().create_task(close_month())
+
+async def close_month() -> None:
+    '''Creates partitions of the next months and balance checkpoints of the closed ones, see `backend.close_month`.'''
+    if partitions_month != partitions.current_month():
+        await ensure_partitions()
+    if checkpoints_month != routes.checkpoint_month():
+        await close_checkpoints()
+
+async def ensure_partitions() -> None:
+    '''Creates partitions of the current month and `partitions_ahead` next ones, see `partitions.ensure_partitions`.'''
+    global partitions_month
+    month = partitions.current_month()
+    async with pool.connection() as conn, conn.cursor() as cur:
+        for table in partitions.partitioned_tables:
+            await cur.execute('SELECT create_month_partitions(%s, %s, %s)', (table, month, partitions.add_months(month, partitions_ahead)))
+            for name, in await cur.fetchall():
+                print(f'Created partition {name}')
+    partitions_month = month
+
+async def close_checkpoints() -> None:
+    '''Creates balance checkpoints of the months closed since the last ones, see `backend.close_checkpoints`.'''
+    global checkpoints_month
+    month = routes.checkpoint_month()
+    async with pool.connection() as conn, conn.cursor() as cur:
+        await cur.execute(queries.try_checkpoints_lock)
+        if not (await cur.fetchone())[0]:
+            return # another worker creates them, the next write checks again
+        await cur.execute(queries.last_checkpoint)
+        since = (await cur.fetchone())[0]
+        if since is None or since < month:
+            await cur.execute('LOCK TABLE balance_checkpoints IN SHARE ROW EXCLUSIVE MODE')
+            await cur.execute(queries.close_checkpoints, {'income': lookups.operation_types['income'], 'since': since, 'until': month})
+            print(f'Created balance checkpoints up to {month:%Y-%m}: {cur.rowcount} (group, month) rows')
+    checkpoints_month = month
+
+async def fetch_message(message_id: int) -> Optional[dict]:
+    async with pool.connection() as conn, conn.cursor() as cur:
+        await execute(cur, 'get_message', (message_id,))
+        return next(routes.messages_result(await cur.fetchall()), None)
+
+def get_chat_listener() -> AsyncChatListener:
+    global chat_listener
+    if chat_listener is None:
+        chat_listener = AsyncChatListener(props.conn_string, fetch_message)
+    return chat_listener
+
+@app.route('/group/<int:group_id>/chat/stream', methods = ['GET'])
+async def chat_stream(group_id: int):
+    user = routes.require_user(request.args)
+    async with (await get_conn()).cursor() as cur:
+        routes.require_member(await find_membership(cur, group_id, user), user, group_id)
+    listener = get_chat_listener()
+    async def generate():
+        messages = listener.subscribe(group_id)
+        try:
+            yield routes.sse_start
+            while True:
+                try:
+                    message = await asyncio.wait_for(messages.get(), sse_keepalive)
+                except asyncio.TimeoutError:
+                    yield routes.sse_keepalive_event
+                    continue
+                yield routes.sse_message(message)
+        finally:
+            listener.unsubscribe(group_id, messages)
+    response = Response(generate(), mimetype='text/event-stream', headers=routes.sse_headers)
+    response.timeout = None
+    return response
+
+# api help
+
+@app.route('/', methods = ['GET'])
+@app.route('/api/', methods = ['GET'])
+async def api():
+    return jsonify({
+        'version': _version,
+        '_links': {
+            'self': {
+                'href': '/api/'
+            }
+        }
+    })
+
+@app.route('/api/cache/', methods = ['GET'])
+async def api_cache():
+    return jsonify({
+        'memberships': memberships.stats,
+        'pool': pool.get_stats(),
+        'chat_listener': get_chat_listener().stats,
+        'password_hasher': hasher.stats
+    })
+
+@app.route('/metrics', methods = ['GET'])
+async def get_metrics():
+    gauges = {'pool': pool.get_stats(), 'memberships': memberships.stats, 'password_hasher': hasher.stats}
+    if chat_listener is not None:
+        gauges['chat_listener'] = chat_listener.stats
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+# errors handling
+
+@app.errorhandler(Exception)
+async def any_error(error: Exception):
+    if 'conn' in g and not g.conn.closed: # the connection may have been closed by the server
+        await g.conn.rollback()
+    return jsonify(routes.error_result(error, request.path, request.args, (await request.get_data()).decode())), 500
+
+@app.errorhandler(ApiError)
+async def api_error(error: ApiError):
+    return jsonify(routes.api_error_result(error)), error.status
+
+@app.errorhandler(BadCursor)
+async def bad_cursor_error(error: BadCursor):
+    return jsonify({
+        'error': str(error),
+        'path': request.path
+    }), 400
+
+@app.errorhandler(psycopg_pool.PoolTimeout)
+async def pool_timeout_error(error: psycopg_pool.PoolTimeout):
+    return jsonify({
+        'error': str(error),
+        'path': request.path
+    }), 503
+
+@app.errorhandler(HasherBusy)
+async def hasher_busy_error(error: HasherBusy):
+    return jsonify({
+        'error': str(error),
+        'path': request.path
+    }), 503
+
+@app.errorhandler(404)
+async def not_found_error(_):
+    return jsonify(routes.not_found_result(request.path, request.args)), 404
+
+def run(properties, lookups_: Lookups, memberships_: MembershipCache, export_batch_size_: int, hasher_: PasswordHasher,
+        tokens_: TokenSigner, require_token_: bool = False, partitions_ahead_: int = 3) -> None:
+    '''Serves the API with hypercorn until interrupted. Database schema must be already migrated.'''
+    global props, lookups, memberships, export_batch_size, hasher, tokens, require_token, partitions_ahead
+    props, lookups, memberships, export_batch_size = properties, lookups_, memberships_, export_batch_size_
+    hasher, tokens, require_token, partitions_ahead = hasher_, tokens_, require_token_, partitions_ahead_
+    hasher.start()
+    config = Config()
+    config.bind = [f'0.0.0.0:{props.api_port}']
+    asyncio.run(serve(app, config))
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Set, Tuple
+
+class Membership(NamedTuple):
+    id: int
+    user_id: int
+    status_id: int
+
+class MembershipCache:
+    '''Bounded LRU cache of (group, user) -> membership with entries expiring after `ttl` seconds.
+
+    User can be given either by id or by username, so the same membership can be stored under two keys,
+        that is why invalidation is done for the whole group. Every invalidation starts a new `generation`: membership
+        read from the database is only put if no invalidation happened since the read started, otherwise it could be
+        the old one read before the change was committed.
+
+    Invalidations reach only the cache of the process, caches of other workers keep the old memberships until they
+        expire, so rights are checked against the database itself.
+    '''
+    def __init__(self, max_size: int = 10000, ttl: float = 30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: 'OrderedDict[Tuple[int, str], Tuple[float, Membership]]' = OrderedDict()
+        self._groups: Dict[int, Set[Tuple[int, str]]] = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, group_id: int, user: str) -> Optional[Membership]:
+        key = (group_id, user)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    @property
+    def generation(self) -> int:
+        '''Number of the invalidations so far, taken before reading a membership which is then put.'''
+        return self._generation
+
+    def put(self, group_id: int, user: str, membership: Membership, generation: Optional[int] = None) -> None:
+        if self.max_size <= 0:
+            return
+        key = (group_id, user)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, membership)
+            self._entries.move_to_end(key)
+            self._groups.setdefault(group_id, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_group(self, group_id: int) -> None:
+        with self._lock:
+            for key in self._groups.pop(group_id, ()):
+                self._entries.pop(key, None)
+            self._generation += 1
+            self.invalidations += 1
+
+    def _remove(self, key: Tuple[int, str]) -> None:
+        self._entries.pop(key, None)
+        keys = self._groups.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._groups[key[0]]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                    'invalidations': self.invalidations}
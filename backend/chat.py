@@ -0,0 +1,121 @@
+import json
+import psycopg2, psycopg2.extensions
+import queue
+import select
+import socket
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, Optional, Set
+
+def chat_channel(group_id: int) -> str:
+    return f'chat_{group_id}'
+
+class ChatListener:
+    '''Shared LISTEN connection delivering chat notifications of the groups to the subscribed queues.
+
+    One background thread owns the connection and LISTENs only to the channels which have subscribers. Notifications
+        too long for NOTIFY payload contain only `message_id` and are completed with `fetch_message`.
+    '''
+    def __init__(self, conn_string: str, fetch_message: Callable[[int], Optional[Dict[str, Any]]],
+            queue_size: int = 100, reconnect_delay: float = 5.0):
+        self.conn_string = conn_string
+        self.fetch_message = fetch_message
+        self.queue_size = queue_size
+        self.reconnect_delay = reconnect_delay
+        self._subscribers: Dict[int, Set[queue.Queue]] = {}
+        self._listening: Set[int] = set()
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def subscribe(self, group_id: int) -> queue.Queue:
+        q: queue.Queue = queue.Queue(self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(group_id, set()).add(q)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='chat-listener', daemon=True)
+                self._thread.start()
+        self._wakeup()
+        return q
+
+    def unsubscribe(self, group_id: int, q: queue.Queue) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(group_id)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if len(subscribers) == 0:
+                    del self._subscribers[group_id]
+        self._wakeup()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'groups': len(self._subscribers), 'subscribers': sum(map(len, self._subscribers.values()))}
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wakeup()
+
+    def _wakeup(self) -> None:
+        try:
+            self._wakeup_w.send(b'\0')
+        except BlockingIOError:
+            pass # listener thread is already woken up and has not read the socket yet
+
+    def _sync_channels(self, conn: psycopg2.extensions.connection) -> None:
+        with self._lock:
+            wanted = set(self._subscribers)
+        with conn.cursor() as cur:
+            for group_id in wanted - self._listening:
+                cur.execute(f'LISTEN {chat_channel(group_id)}')
+            for group_id in self._listening - wanted:
+                cur.execute(f'UNLISTEN {chat_channel(group_id)}')
+        self._listening = wanted
+
+    def _deliver(self, notify: psycopg2.extensions.Notify) -> None:
+        group_id = int(notify.channel[len('chat_'):])
+        message = json.loads(notify.payload)
+        if 'message' not in message:
+            message = self.fetch_message(message['message_id'])
+            if message is None:
+                return
+        with self._lock:
+            subscribers = list(self._subscribers.get(group_id, ()))
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                pass # client is not reading, it will reconnect and get missed messages with the chat history request
+
+    def _run(self) -> None:
+        while not self._stopped:
+            try:
+                conn = psycopg2.connect(self.conn_string)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                self._listening = set()
+                try:
+                    while not self._stopped:
+                        self._sync_channels(conn)
+                        readable, _, _ = select.select([conn, self._wakeup_r], [], [], 60)
+                        if self._wakeup_r in readable:
+                            try:
+                                while self._wakeup_r.recv(1024):
+                                    pass
+                            except BlockingIOError:
+                                pass
+                        if len(readable) == 0:
+                            with conn.cursor() as cur: # check that the connection is still alive
+                                cur.execute('SELECT 1')
+                        if conn in readable:
+                            conn.poll()
+                        while conn.notifies:
+                            self._deliver(conn.notifies.pop(0))
+                finally:
+                    conn.close()
+            except Exception:
+                traceback.print_exc()
+                time.sleep(self.reconnect_delay)
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import psycopg
+import traceback
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from chat import chat_channel
+
+class AsyncChatListener:
+    '''Shared LISTEN connection of the async server delivering chat notifications of the groups to the subscribed queues.
+
+    Works like `chat.ChatListener`, but as a task of the event loop instead of a thread. Notifications are read
+        for `poll_interval` seconds at a time, after which LISTEN/UNLISTEN are issued for the groups which
+        subscribers have changed.
+    '''
+    def __init__(self, conn_string: str, fetch_message: Callable[[int], Awaitable[Optional[Dict[str, Any]]]],
+            queue_size: int = 100, reconnect_delay: float = 5.0, poll_interval: float = 0.5):
+        self.conn_string = conn_string
+        self.fetch_message = fetch_message
+        self.queue_size = queue_size
+        self.reconnect_delay = reconnect_delay
+        self.poll_interval = poll_interval
+        self._subscribers: Dict[int, Set[asyncio.Queue]] = {}
+        self._listening: Set[int] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, group_id: int) -> asyncio.Queue:
+        q: asyncio.Queue = asyncio.Queue(self.queue_size)
+        self._subscribers.setdefault(group_id, set()).add(q)
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return q
+
+    def unsubscribe(self, group_id: int, q: asyncio.Queue) -> None:
+        subscribers = self._subscribers.get(group_id)
+        if subscribers is not None:
+            subscribers.discard(q)
+            if len(subscribers) == 0:
+                del self._subscribers[group_id]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'groups': len(self._subscribers), 'subscribers': sum(map(len, self._subscribers.values()))}
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _sync_channels(self, conn: psycopg.AsyncConnection) -> None:
+        wanted = set(self._subscribers)
+        for group_id in wanted - self._listening:
+            await conn.execute(f'LISTEN {chat_channel(group_id)}')
+        for group_id in self._listening - wanted:
+            await conn.execute(f'UNLISTEN {chat_channel(group_id)}')
+        self._listening = wanted
+
+    async def _deliver(self, notify: psycopg.Notify) -> None:
+        group_id = int(notify.channel[len('chat_'):])
+        message = json.loads(notify.payload)
+        if 'message' not in message:
+            message = await self.fetch_message(message['message_id'])
+            if message is None:
+                return
+        for q in list(self._subscribers.get(group_id, ())):
+            try:
+                q.put_nowait(message)
+            except asyncio.QueueFull:
+                pass # client is not reading, it will reconnect and get missed messages with the chat history request
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(self.conn_string, autocommit=True) as conn:
+                    self._listening = set()
+                    while True:
+                        await self._sync_channels(conn)
+                        async for notify in conn.notifies(timeout=self.poll_interval):
+                            await self._deliver(notify)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+                await asyncio.sleep(self.reconnect_delay)
@@ -0,0 +1,31 @@
+import psycopg2
+from types import MappingProxyType
+from typing import Mapping, Optional
+
+class Lookups:
+    '''Immutable name <-> id maps of the `user_group_statuses` and `operation_types` tables.
+
+    The tables are filled by migrations and never change while the server is running, so they are read once
+        at startup and queries bind plain integer ids instead of selecting them by name.
+    '''
+    def __init__(self, statuses: Mapping[str, int], operation_types: Mapping[str, int]):
+        self.statuses: Mapping[str, int] = MappingProxyType(dict(statuses))
+        self.status_names: Mapping[int, str] = MappingProxyType({id: name for name, id in statuses.items()})
+        self.operation_types: Mapping[str, int] = MappingProxyType(dict(operation_types))
+        self.operation_type_names: Mapping[int, str] = MappingProxyType({id: name for name, id in operation_types.items()})
+        self.member_status_ids = tuple(self.statuses[status] for status in ('creator', 'admin', 'user'))
+
+    @classmethod
+    def load(cls, conn: psycopg2.extensions.connection) -> 'Lookups':
+        with conn.cursor() as cur:
+            cur.execute('SELECT name, id FROM user_group_statuses')
+            statuses = dict(cur.fetchall())
+            cur.execute('SELECT name, id FROM operation_types')
+            operation_types = dict(cur.fetchall())
+        return cls(statuses, operation_types)
+
+    def status_id(self, name: str) -> Optional[int]:
+        return self.statuses.get(name)
+
+    def operation_type_id(self, name: str) -> Optional[int]:
+        return self.operation_types.get(name)
@@ -0,0 +1,158 @@
+import bisect
+import psycopg2, psycopg2.extensions
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_table_re = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|COPY)\s+(\w+)', re.IGNORECASE)
+
+class Histogram:
+    '''Counts of observed values by upper bounds of the buckets, with their sum, as in Prometheus histogram.'''
+    def __init__(self, buckets: Sequence[float] = default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> Iterable[str]:
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {total}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    '''Latencies and status codes of the requests by route and durations and row counts of the statements by their kind.
+
+    Statement kind is its command and the first table it reads or changes (e.g. `select_operations`), or the name
+        of the prepared statement (e.g. `execute_get_group`), so that the number of series does not depend
+        on the query parameters. Statements running longer than
+        `slow_query_threshold` seconds are printed (without parameters, as they can hold passwords).
+
+    Metrics of pre-forked worker processes are kept by each worker, their series are told apart by `worker` label.
+    '''
+    def __init__(self, buckets: Sequence[float] = default_buckets, slow_query_threshold: Optional[float] = None,
+            worker: Optional[str] = None):
+        self.buckets = buckets
+        self.slow_query_threshold = slow_query_threshold
+        self.worker = worker
+        self._requests: Dict[Tuple[str, str], Histogram] = {}
+        self._responses: Dict[Tuple[str, str, int], int] = {}
+        self._queries: Dict[str, Histogram] = {}
+        self._query_rows: Dict[str, int] = {}
+        self._statements: Dict[str, str] = {}
+        self.slow_queries = 0
+        self._lock = threading.Lock()
+
+    def statement_kind(self, sql) -> str:
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        elif not isinstance(sql, str):
+            sql = str(sql) # psycopg2.sql.Composed
+        kind = self._statements.get(sql)
+        if kind is None:
+            words = sql.split(None, 2)
+            command = words[0].lower() if len(words) != 0 else ''
+            match = _table_re.search(sql)
+            if command in ('prepare', 'execute') and len(words) > 1:
+                kind = f'{command}_{words[1].lower()}'
+            else:
+                kind = command if match is None else f'{command}_{match.group(1).lower()}'
+            if len(self._statements) >= 10000:
+                self._statements.clear()
+            self._statements[sql] = kind
+        return kind
+
+    def observe_request(self, route: str, method: str, status: int, seconds: float) -> None:
+        with self._lock:
+            histogram = self._requests.get((route, method))
+            if histogram is None:
+                histogram = self._requests[(route, method)] = Histogram(self.buckets)
+            histogram.observe(seconds)
+            self._responses[(route, method, status)] = self._responses.get((route, method, status), 0) + 1
+
+    def observe_query(self, sql, seconds: float, rows: int) -> None:
+        kind = self.statement_kind(sql)
+        slow = self.slow_query_threshold is not None and seconds >= self.slow_query_threshold
+        with self._lock:
+            histogram = self._queries.get(kind)
+            if histogram is None:
+                histogram = self._queries[kind] = Histogram(self.buckets)
+            histogram.observe(seconds)
+            self._query_rows[kind] = self._query_rows.get(kind, 0) + max(rows, 0)
+            if slow:
+                self.slow_queries += 1
+        if slow:
+            print(f'slow query ({seconds * 1000:.1f} ms, {max(rows, 0)} rows): {" ".join(str(sql).split())}')
+
+    def render(self, gauges: Optional[Dict[str, Dict[str, float]]] = None) -> str:
+        '''Returns the metrics in Prometheus text exposition format, `gauges` are added as `finances_<group>_<name>`.'''
+        lines: List[str] = []
+        worker = [] if self.worker is None else [f'worker="{_escape(self.worker)}"']
+        labels = lambda *pairs: ','.join(worker + list(pairs))
+        braces = lambda *pairs: f'{{{labels(*pairs)}}}' if len(worker) + len(pairs) != 0 else ''
+        with self._lock:
+            lines.append('# HELP finances_request_duration_seconds Time of request processing by route.')
+            lines.append('# TYPE finances_request_duration_seconds histogram')
+            for (route, method), histogram in sorted(self._requests.items()):
+                lines.extend(histogram.render('finances_request_duration_seconds', labels(f'route="{_escape(route)}"', f'method="{method}"')))
+            lines.append('# HELP finances_responses_total Responses by route and status code.')
+            lines.append('# TYPE finances_responses_total counter')
+            for (route, method, status), count in sorted(self._responses.items()):
+                series = braces(f'route="{_escape(route)}"', f'method="{method}"', f'status="{status}"')
+                lines.append(f'finances_responses_total{series} {count}')
+            lines.append('# HELP finances_query_duration_seconds Time of database statements execution by statement kind.')
+            lines.append('# TYPE finances_query_duration_seconds histogram')
+            for kind, histogram in sorted(self._queries.items()):
+                lines.extend(histogram.render('finances_query_duration_seconds', labels(f'statement="{_escape(kind)}"')))
+            lines.append('# HELP finances_query_rows_total Rows returned or changed by database statements.')
+            lines.append('# TYPE finances_query_rows_total counter')
+            for kind, rows in sorted(self._query_rows.items()):
+                series = braces(f'statement="{_escape(kind)}"')
+                lines.append(f'finances_query_rows_total{series} {rows}')
+            lines.append('# TYPE finances_slow_queries_total counter')
+            lines.append(f'finances_slow_queries_total{braces()} {self.slow_queries}')
+        for group, values in (gauges or {}).items():
+            for name, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'# TYPE finances_{group}_{name} gauge')
+                    lines.append(f'finances_{group}_{name}{braces()} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class TimedCursor(psycopg2.extensions.cursor):
+    '''Cursor recording duration and row count of every statement it executes to `metrics`.'''
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.observe_query(query, time.perf_counter() - start, self.rowcount)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            metrics.observe_query(query, time.perf_counter() - start, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            metrics.observe_query(sql, time.perf_counter() - start, self.rowcount)
@@ -46,4 +46,4 @@ CREATE TABLE IF NOT EXISTS messages (
     user_group_id integer REFERENCES users_groups(id) ON DELETE CASCADE NOT NULL,
     time timestamp NOT NULL,
     message text NOT NULL
-)
\ No newline at end of file
+);
@@ -0,0 +1,7 @@
+INSERT INTO user_group_statuses (name)
+    SELECT s.name FROM (VALUES ('creator'), ('admin'), ('user'), ('pending'), ('blocked')) AS s(name)
+    WHERE NOT EXISTS (SELECT 1 FROM user_group_statuses ugs WHERE ugs.name = s.name);
+
+INSERT INTO operation_types (name)
+    SELECT t.name FROM (VALUES ('income'), ('spending')) AS t(name)
+    WHERE NOT EXISTS (SELECT 1 FROM operation_types ot WHERE ot.name = t.name);
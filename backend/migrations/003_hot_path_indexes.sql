@@ -0,0 +1,16 @@
+-- operations pages: WHERE group_id = ? ORDER BY date DESC, id DESC
+CREATE INDEX IF NOT EXISTS operations_group_date_idx ON operations (group_id, date, id);
+
+-- group members and member counts: WHERE group_id = ? AND status_id = ?
+CREATE INDEX IF NOT EXISTS users_groups_group_status_idx ON users_groups (group_id, status_id);
+
+-- chat pages filter by group, so the group is stored in messages to let one index serve WHERE and ORDER BY
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS group_id integer REFERENCES groups(id) ON DELETE CASCADE;
+UPDATE messages m SET group_id = ug.group_id FROM users_groups ug WHERE ug.id = m.user_group_id AND m.group_id IS NULL;
+ALTER TABLE messages ALTER COLUMN group_id SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS messages_group_time_idx ON messages (group_id, time, id);
+
+-- cascade deletes of memberships
+CREATE INDEX IF NOT EXISTS messages_user_group_idx ON messages (user_group_id);
+
@@ -0,0 +1,15 @@
+-- monthly totals of operations by group, user and type, updated together with operations
+CREATE TABLE IF NOT EXISTS operation_stats (
+    group_id integer REFERENCES groups(id) ON DELETE CASCADE NOT NULL,
+    user_id integer REFERENCES users(id) NOT NULL,
+    type_id integer REFERENCES operation_types(id) NOT NULL,
+    month date NOT NULL,
+    total float NOT NULL DEFAULT 0,
+    count integer NOT NULL DEFAULT 0,
+    PRIMARY KEY (group_id, user_id, type_id, month)
+);
+
+INSERT INTO operation_stats (group_id, user_id, type_id, month, total, count)
+    SELECT group_id, user_id, type_id, date_trunc('month', date)::date, sum(amount), count(*) FROM operations
+    GROUP BY group_id, user_id, type_id, date_trunc('month', date)
+    ON CONFLICT DO NOTHING;
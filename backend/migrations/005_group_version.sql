@@ -0,0 +1,2 @@
+-- incremented by every change of the group data, used for ETag of the group responses
+ALTER TABLE groups ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT 0;
@@ -0,0 +1,16 @@
+-- full-text search of chat messages and operations: search vectors are generated columns, so PostgreSQL keeps them
+--   up to date on every insert and update (including COPY). 'simple' configuration lowercases words without stemming,
+--   as messages can be written in any language
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', message)) STORED;
+
+-- words of the name rank higher than words of the description
+ALTER TABLE operations ADD COLUMN IF NOT EXISTS search tsvector
+    GENERATED ALWAYS AS (setweight(to_tsvector('simple', name), 'A') || setweight(to_tsvector('simple', description), 'B')) STORED;
+
+-- group id is the first index column, so that search reads only the matching rows of the group
+--   however large the history of other groups is
+CREATE INDEX IF NOT EXISTS messages_search_idx ON messages USING gin (group_id, search);
+CREATE INDEX IF NOT EXISTS operations_search_idx ON operations USING gin (group_id, search);
@@ -0,0 +1,140 @@
+-- operations and messages are partitioned by month of their date and time, so that vacuum and indexes of the recent
+--   months, which are read and written, do not grow with the whole history, and old months can be archived.
+--   Partitions of a table cover all the dates without gaps: <table>_history holds rows older than the first month
+--   partition and <table>_future rows newer than the last one. There is no DEFAULT partition, as it would keep
+--   PostgreSQL from reading partitions in order and stopping at the recent ones for ORDER BY date DESC LIMIT queries
+
+-- Creates month partitions of the table for the months from `first_month` to `last_month` which are not covered by them
+--   yet, returns names of the created partitions. History and future partitions overlapping the new months are
+--   detached, replaced by the month partitions and new history and future ones, and their rows are inserted again
+CREATE OR REPLACE FUNCTION create_month_partitions(parent regclass, first_month date, last_month date) RETURNS SETOF text AS $$
+DECLARE
+    name text;
+    columns text;
+    first_existing date;
+    last_existing date;
+    month date;
+BEGIN
+    SELECT c.relname INTO name FROM pg_class c WHERE c.oid = parent;
+    first_month := date_trunc('month', first_month);
+    last_month := date_trunc('month', last_month);
+    PERFORM pg_advisory_xact_lock(hashtext('create_month_partitions ' || name));
+    SELECT min(to_date(right(c.relname, 7), 'YYYY_MM')), max(to_date(right(c.relname, 7), 'YYYY_MM'))
+        INTO first_existing, last_existing
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = parent AND c.relname ~ ('^' || name || '_\d{4}_\d{2}$');
+
+    IF first_existing IS NULL THEN -- new table
+        EXECUTE format('CREATE TABLE %I PARTITION OF %s FOR VALUES FROM (MINVALUE) TO (%L)', name || '_history', parent, first_month);
+        RETURN NEXT name || '_history';
+        first_existing := first_month;
+        last_existing := first_month - interval '1 month';
+        EXECUTE format('CREATE TABLE %I PARTITION OF %s FOR VALUES FROM (%L) TO (MAXVALUE)', name || '_future', parent, first_month);
+    END IF;
+    IF first_month >= first_existing AND last_month <= last_existing THEN
+        RETURN;
+    END IF;
+
+    SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY a.attnum) INTO columns FROM pg_attribute a
+        WHERE a.attrelid = parent AND a.attnum > 0 AND NOT a.attisdropped AND a.attgenerated = '';
+    IF first_month < first_existing THEN
+        EXECUTE format('ALTER TABLE %s DETACH PARTITION %I', parent, name || '_history');
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', name || '_history', name || '_history_split');
+        EXECUTE format('CREATE TABLE %I PARTITION OF %s FOR VALUES FROM (MINVALUE) TO (%L)', name || '_history', parent, first_month);
+        month := first_month;
+        WHILE month < first_existing LOOP
+            EXECUTE format('CREATE TABLE %I PARTITION OF %s FOR VALUES FROM (%L) TO (%L)', name || to_char(month, '_YYYY_MM'),
+                    parent, month, month + interval '1 month');
+            RETURN NEXT name || to_char(month, '_YYYY_MM');
+            month := month + interval '1 month';
+        END LOOP;
+        EXECUTE format('INSERT INTO %s (%s) SELECT %s FROM %I', parent, columns, columns, name || '_history_split');
+        EXECUTE format('DROP TABLE %I', name || '_history_split');
+    END IF;
+    IF last_month > last_existing THEN
+        EXECUTE format('ALTER TABLE %s DETACH PARTITION %I', parent, name || '_future');
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', name || '_future', name || '_future_split');
+        month := last_existing + interval '1 month';
+        WHILE month <= last_month LOOP
+            EXECUTE format('CREATE TABLE %I PARTITION OF %s FOR VALUES FROM (%L) TO (%L)', name || to_char(month, '_YYYY_MM'),
+                    parent, month, month + interval '1 month');
+            RETURN NEXT name || to_char(month, '_YYYY_MM');
+            month := month + interval '1 month';
+        END LOOP;
+        EXECUTE format('CREATE TABLE %I PARTITION OF %s FOR VALUES FROM (%L) TO (MAXVALUE)', name || '_future', parent, month);
+        EXECUTE format('INSERT INTO %s (%s) SELECT %s FROM %I', parent, columns, columns, name || '_future_split');
+        EXECUTE format('DROP TABLE %I', name || '_future_split');
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- partitions detached and dumped to files by `backend.py --archive_before`
+CREATE TABLE IF NOT EXISTS archived_partitions (
+    name varchar(63) PRIMARY KEY NOT NULL,
+    parent varchar(63) NOT NULL,
+    upper_bound timestamp NOT NULL,
+    rows bigint NOT NULL,
+    file varchar(255) NOT NULL,
+    archived_at timestamp NOT NULL DEFAULT now()
+);
+
+-- operations: primary key of a partitioned table must contain the partition key, ids stay unique as they are
+--   taken from the same sequence
+ALTER TABLE operations RENAME TO operations_unpartitioned;
+ALTER INDEX operations_pkey RENAME TO operations_unpartitioned_pkey;
+DROP INDEX operations_group_date_idx;
+DROP INDEX operations_search_idx;
+ALTER SEQUENCE operations_id_seq OWNED BY NONE;
+
+CREATE TABLE operations (
+    id integer NOT NULL DEFAULT nextval('operations_id_seq'),
+    user_id integer REFERENCES users(id) NOT NULL,
+    group_id integer REFERENCES groups(id) ON DELETE CASCADE NOT NULL,
+    type_id integer REFERENCES operation_types(id) NOT NULL,
+    amount float NOT NULL,
+    name varchar(50) NOT NULL,
+    description varchar(255) NOT NULL DEFAULT '',
+    date timestamp NOT NULL,
+    search tsvector GENERATED ALWAYS AS (setweight(to_tsvector('simple', name), 'A') || setweight(to_tsvector('simple', description), 'B')) STORED,
+    PRIMARY KEY (id, date)
+) PARTITION BY RANGE (date);
+ALTER SEQUENCE operations_id_seq OWNED BY operations.id;
+
+SELECT create_month_partitions('operations', coalesce(min(date), now()), now()) FROM operations_unpartitioned;
+INSERT INTO operations (id, user_id, group_id, type_id, amount, name, description, date)
+    SELECT id, user_id, group_id, type_id, amount, name, description, date FROM operations_unpartitioned;
+DROP TABLE operations_unpartitioned;
+
+-- indexes of the partitioned table are created on every partition
+CREATE INDEX operations_group_date_idx ON operations (group_id, date, id);
+CREATE INDEX operations_search_idx ON operations USING gin (group_id, search);
+
+-- messages
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER INDEX messages_pkey RENAME TO messages_unpartitioned_pkey;
+DROP INDEX messages_group_time_idx;
+DROP INDEX messages_user_group_idx;
+DROP INDEX messages_search_idx;
+ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+
+CREATE TABLE messages (
+    id integer NOT NULL DEFAULT nextval('messages_id_seq'),
+    user_group_id integer REFERENCES users_groups(id) ON DELETE CASCADE NOT NULL,
+    time timestamp NOT NULL,
+    message text NOT NULL,
+    group_id integer REFERENCES groups(id) ON DELETE CASCADE NOT NULL,
+    search tsvector GENERATED ALWAYS AS (to_tsvector('simple', message)) STORED,
+    PRIMARY KEY (id, time)
+) PARTITION BY RANGE (time);
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+SELECT create_month_partitions('messages', coalesce(min(time), now()), now()) FROM messages_unpartitioned;
+INSERT INTO messages (id, user_group_id, time, message, group_id)
+    SELECT id, user_group_id, time, message, group_id FROM messages_unpartitioned;
+DROP TABLE messages_unpartitioned;
+
+CREATE INDEX messages_group_time_idx ON messages (group_id, time, id);
+CREATE INDEX messages_user_group_idx ON messages (user_group_id);
+CREATE INDEX messages_search_idx ON messages USING gin (group_id, search);
+
+ANALYZE operations, messages;
@@ -0,0 +1,9 @@
+-- balance of a group before the month: sum of its operations dated before the month. Balance at a date and running
+--   balance of operations pages are summed from the nearest checkpoint, and checkpoints keep balances of the archived
+--   months. Checkpoints are created from operation_stats by the server when a month closes
+CREATE TABLE IF NOT EXISTS balance_checkpoints (
+    group_id integer REFERENCES groups(id) ON DELETE CASCADE NOT NULL,
+    month date NOT NULL,
+    balance float NOT NULL,
+    PRIMARY KEY (group_id, month)
+);
@@ -0,0 +1,2 @@
+-- the server reads the last checkpoint month to find out if checkpoints of a closed month are to be created
+CREATE INDEX IF NOT EXISTS balance_checkpoints_month_idx ON balance_checkpoints (month);
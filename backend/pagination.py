@@ -0,0 +1,81 @@
+from typing import Callable, Dict, Mapping, Optional, Sequence, Tuple
+
+from serialization import BadCursor, decode_cursor, decode_search_cursor, encode_cursor, encode_search_cursor, format_time
+
+def page_limit(args: Mapping[str, str]) -> int:
+    '''Returns page size `limit` (1-200, 50 by default) of the request arguments.'''
+    try:
+        return min(max(int(args.get('limit', 50)), 1), 200)
+    except ValueError:
+        raise BadCursor(f'limit must be an integer (but is {args["limit"]})')
+
+def page_args(args: Mapping[str, str]) -> Tuple[Optional[str], Optional[str], int]:
+    '''Returns `after` and `before` cursors and page size `limit` (see `page_limit`) of the request arguments.'''
+    after, before = args.get('after'), args.get('before')
+    if after is not None and before is not None:
+        raise BadCursor('only one of the (after, before) cursors can be given')
+    return after, before, page_limit(args)
+
+def keyset_direction(after: Optional[str], before: Optional[str]) -> str:
+    return 'after' if after is not None else 'before' if before is not None else 'first'
+
+def keyset_sql(query: str, key: Tuple[str, str], direction: str) -> str:
+    '''Returns query selecting one page of rows in the given direction ('first', 'after' or 'before' cursor).
+
+    `query` must end with a WHERE clause, keyset condition, ORDER BY and LIMIT are appended to it. `key` holds the
+        (time, id) key columns. Cursor time and key (for 'after' and 'before') and limit are the last parameters:
+        the time condition is implied by the key one, but lets PostgreSQL skip partitions on the other side of the cursor.
+    '''
+    time_key, id_key = key
+    if direction == 'after':
+        return f'{query} AND {time_key} <= %s AND ({time_key}, {id_key}) < (%s, %s) ORDER BY {time_key} DESC, {id_key} DESC LIMIT %s'
+    if direction == 'before':
+        return f'{query} AND {time_key} >= %s AND ({time_key}, {id_key}) > (%s, %s) ORDER BY {time_key}, {id_key} LIMIT %s'
+    return f'{query} ORDER BY {time_key} DESC, {id_key} DESC LIMIT %s'
+
+def keyset_params(params: tuple, after: Optional[str], before: Optional[str], limit: int) -> tuple:
+    '''Returns parameters of the `keyset_sql` query. One row more than `limit` is selected to find out if there are
+        more pages.
+    '''
+    if after is not None or before is not None:
+        key = decode_cursor(after if after is not None else before)
+        return params + key[:1] + key + (limit + 1,)
+    return params + (limit + 1,)
+
+def keyset_result(rows: Sequence[tuple], key_indexes: Tuple[int, int], after: Optional[str], before: Optional[str],
+        limit: int) -> Tuple[list, Optional[str], Optional[str]]:
+    '''Returns rows of the page selected by `keyset_query` and cursors of the next (older) and previous (newer) pages
+        if there are any. `key_indexes` are positions of the (time, id) key columns in the row.
+    '''
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+    if before is not None:
+        rows.reverse()
+    if len(rows) == 0:
+        return rows, None, None
+    time_column, id_column = key_indexes
+    next_cursor = encode_cursor(rows[-1][time_column], rows[-1][id_column]) if has_more or before is not None else None
+    prev_cursor = encode_cursor(rows[0][time_column], rows[0][id_column]) if has_more and before is not None or after is not None else None
+    return rows, next_cursor, prev_cursor
+
+def search_params(group_id: int, q: str, after: Optional[str], limit: int) -> Dict[str, object]:
+    '''Returns parameters of the `queries.search` query, formatted with `queries.search_after` if `after` is given.'''
+    params = {'group_id': group_id, 'q': q, 'limit': limit + 1}
+    if after is not None:
+        params['rank'], params['time'], params['kind'], params['id'] = decode_search_cursor(after)
+    return params
+
+def search_result(rows: Sequence[tuple], limit: int, type_names: Callable[[int], str]) -> Tuple[list, Optional[str]]:
+    '''Returns search results of the page selected by `queries.search` and cursor of the next page if there is one.'''
+    results = []
+    for kind, id, user, time, rank, text, description, type_id, amount in rows[:limit]:
+        result = {'kind': kind, 'id': id, 'user': user, 'time': format_time(time), 'rank': rank}
+        if kind == 'message':
+            result['message'] = text
+        else:
+            result.update({'type': type_names(type_id), 'amount': amount, 'name': text, 'description': description})
+        results.append(result)
+    if len(rows) <= limit:
+        return results, None
+    kind, id, _, time, rank = rows[limit - 1][:5]
+    return results, encode_search_cursor(rank, time, kind, id)
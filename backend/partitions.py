@@ -0,0 +1,101 @@
+import datetime
+import gzip
+import os
+import re
+import psycopg2
+from typing import List, Tuple
+
+# partitioned tables and their columns dumped to archives (generated search columns are computed again on restore)
+partitioned_tables = {
+    'operations': ('id', 'user_id', 'group_id', 'type_id', 'amount', 'name', 'description', 'date'),
+    'messages': ('id', 'user_group_id', 'group_id', 'time', 'message')
+}
+
+def add_months(month: datetime.date, months: int) -> datetime.date:
+    n = month.year * 12 + month.month - 1 + months
+    return datetime.date(n // 12, n % 12 + 1, 1)
+
+def partition_month(name: str) -> datetime.date:
+    '''Returns month of the `<table>_YYYY_MM` partition or upper bound of the detached `<table>_before_YYYY_MM` one.'''
+    match = re.search(r'_(\d{4})_(\d{2})$', name)
+    return datetime.date(int(match.group(1)), int(match.group(2)), 1)
+
+def create_partitions(conn: psycopg2.extensions.connection, first_month: datetime.date, last_month: datetime.date) -> List[str]:
+    '''Creates month partitions of the partitioned tables for the months from `first_month` to `last_month`
+        which are not created yet, returns their names.
+    '''
+    created = []
+    with conn.cursor() as cur:
+        for table in partitioned_tables:
+            cur.execute('SELECT create_month_partitions(%s, %s, %s)', (table, first_month, last_month))
+            created.extend(name for name, in cur.fetchall())
+    conn.commit()
+    return created
+
+def current_month() -> datetime.date:
+    return datetime.date.today().replace(day=1)
+
+def ensure_partitions(conn: psycopg2.extensions.connection, months_ahead: int) -> List[str]:
+    '''Creates partitions of the current month and `months_ahead` next ones, so that new rows do not go to the
+        future partitions (which hold rows of all the later months).
+    '''
+    month = current_month()
+    return create_partitions(conn, month, add_months(month, months_ahead))
+
+def _detached(cur: psycopg2.extensions.cursor, table: str) -> List[str]:
+    '''Returns names of the partitions of the table detached for archival but not archived yet.'''
+    cur.execute('SELECT relname FROM pg_class WHERE relkind = \'r\' AND NOT relispartition AND relname ~ %s'
+            ' ORDER BY relname', (f'^{table}_(before_)?\\d{{4}}_\\d{{2}}$',))
+    return [name for name, in cur.fetchall()]
+
+def detach_partitions(conn: psycopg2.extensions.connection, table: str, before: datetime.date) -> List[str]:
+    '''Detaches month partitions of the table older than the `before` month together with the history partition,
+        which is replaced by an empty one ending at `before`. Returns names of all the detached partitions
+        which are not archived yet.
+    '''
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (f'create_month_partitions {table}',))
+        cur.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid'
+                ' WHERE i.inhparent = %s::regclass AND c.relname ~ %s', (table, f'^{table}_\\d{{4}}_\\d{{2}}$'))
+        months = sorted(name for name, in cur.fetchall() if partition_month(name) < before)
+        if len(months) != 0:
+            for name in months + [f'{table}_history']:
+                cur.execute(f'ALTER TABLE {table} DETACH PARTITION {name}')
+            cur.execute(f'ALTER TABLE {table}_history RENAME TO {table}_before_{partition_month(months[0]):%Y_%m}')
+            cur.execute(f'CREATE TABLE {table}_history PARTITION OF {table} FOR VALUES FROM (MINVALUE) TO (%s)', (before,))
+        detached = _detached(cur, table)
+    conn.commit()
+    return detached
+
+def dump_partition(conn: psycopg2.extensions.connection, table: str, name: str, directory: str) -> Tuple[str, int]:
+    '''Writes rows of the detached partition to `<name>.csv.gz` file in the directory and drops the partition,
+        returns the file name and number of rows.
+    '''
+    path = os.path.join(directory, f'{name}.csv.gz')
+    upper_bound = partition_month(name) if f'{table}_before_' in name else add_months(partition_month(name), 1)
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT count(*) FROM {name}')
+        rows = cur.fetchone()[0]
+        with gzip.open(path + '.part', 'wt', encoding='utf-8') as file:
+            cur.copy_expert(f'COPY {name} ({", ".join(partitioned_tables[table])}) TO STDOUT WITH (FORMAT csv, HEADER)', file)
+        os.replace(path + '.part', path)
+        cur.execute('INSERT INTO archived_partitions (name, parent, upper_bound, rows, file) VALUES (%s, %s, %s, %s, %s)'
+                ' ON CONFLICT (name) DO UPDATE SET upper_bound = EXCLUDED.upper_bound, rows = EXCLUDED.rows,'
+                '   file = EXCLUDED.file, archived_at = now()', (name, table, upper_bound, rows, path))
+        cur.execute(f'DROP TABLE {name}')
+    conn.commit()
+    return path, rows
+
+def archive_partitions(conn: psycopg2.extensions.connection, before: datetime.date, directory: str) -> List[Tuple[str, int]]:
+    '''Moves rows of the partitioned tables older than the `before` month to gzipped CSV files in the directory.
+
+    Partitions are detached (which briefly locks the tables) and committed before they are dumped, and dropped only
+        after their files are written: if archival is interrupted, partitions left detached are dumped by the next one.
+        Returns (file name, number of rows) of the archived partitions.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    archived = []
+    for table in partitioned_tables:
+        for name in detach_partitions(conn, table, before):
+            archived.append(dump_partition(conn, table, name, directory))
+    return archived
@@ -0,0 +1,164 @@
+import psycopg2
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    '''Thread-safe pool of psycopg2 connections.
+
+    Keeps at least `min_size` and at most `max_size` connections open. `getconn` waits up to `timeout` seconds
+        for a free connection, connections idle for more than `check_interval` seconds are checked with `SELECT 1`
+        before being given out, and broken connections are closed and replaced with new ones: right away when they are
+        given out, and when they are returned if the pool would be left with less than `min_size` connections. Connections are opened
+        with `connection_factory` class and `cursor_factory` as their default cursor class if they are given.
+    '''
+    def __init__(self, conn_string: str, min_size: int = 1, max_size: int = 10, timeout: float = 10.0,
+            check_interval: float = 30.0, connection_factory: Optional[type] = None, cursor_factory: Optional[type] = None):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f'wrong pool size: min_size={min_size}, max_size={max_size}')
+        self.conn_string = conn_string
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.connect_kwargs = {key: value for key, value in
+                (('connection_factory', connection_factory), ('cursor_factory', cursor_factory)) if value is not None}
+        self._idle: List[psycopg2.extensions.connection] = []
+        self._last_used: Dict[int, float] = {}
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+
+    def _open(self) -> psycopg2.extensions.connection:
+        return psycopg2.connect(self.conn_string, **self.connect_kwargs)
+
+    def _connect(self) -> psycopg2.extensions.connection:
+        conn = self._open()
+        self._last_used[id(conn)] = time.monotonic()
+        self._size += 1
+        return conn
+
+    def _discard(self, conn: psycopg2.extensions.connection) -> None:
+        self._last_used.pop(id(conn), None)
+        self._size -= 1
+        try:
+            if not conn.closed:
+                conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_healthy(self, conn: psycopg2.extensions.connection) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self) -> psycopg2.extensions.connection:
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout('connection pool is closed')
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1 # reserve the place while connecting without the lock
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f'could not get database connection in {self.timeout} seconds'
+                            f' (all {self.max_size} connections are busy)')
+                self._cond.wait(remaining)
+        if conn is not None and self._is_healthy(conn):
+            return conn
+        if conn is not None:
+            with self._cond:
+                self._discard(conn)
+                self._size += 1
+        return self._reconnect()
+
+    def _reconnect(self) -> psycopg2.extensions.connection:
+        '''Opens new connection in place already reserved in `_size`, releasing the place on failure.'''
+        try:
+            conn = self._open()
+        except psycopg2.Error:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._last_used[id(conn)] = time.monotonic()
+        return conn
+
+    def putconn(self, conn: psycopg2.extensions.connection, discard: bool = False) -> None:
+        '''Returns connection to the pool, rolling back its unfinished transaction if there is one.'''
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            replenish = False
+            if discard or conn.closed or self._closed:
+                self._discard(conn)
+                replenish = not self._closed and self._size < self.min_size
+                if replenish:
+                    self._size += 1 # reserved for the replacement
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+        if replenish:
+            self._replenish()
+
+    def _replenish(self) -> None:
+        '''Opens an idle connection in place already reserved in `_size`. On failure the place is released, and
+            the connection is opened by the next `getconn` instead.
+        '''
+        try:
+            conn = self._reconnect()
+        except psycopg2.Error:
+            return
+        with self._cond:
+            if self._closed:
+                self._discard(conn)
+                return
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self) -> Iterator[psycopg2.extensions.connection]:
+        conn = self.getconn()
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            self.putconn(conn)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {'size': self._size, 'idle': len(self._idle), 'min_size': self.min_size, 'max_size': self.max_size}
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._discard(self._idle.pop())
+            self._cond.notify_all()
@@ -0,0 +1,41 @@
+'''Pre-fork server running the WSGI app in several worker processes with gunicorn (`python -m pip install gunicorn`).
+
+Workers accept connections from the shared listening socket and serve them by threads. Every worker is set up with
+    `init_worker` after fork, so that database connections, sockets and threads are never shared between processes,
+    and is replaced after `max_requests` requests (with jitter, so that workers are not replaced at once). SIGTERM
+    stops the server gracefully: workers stop accepting connections and finish requests in progress for up to
+    `graceful_timeout` seconds, then `exit_worker` is called in every worker (SIGINT stops them at once).
+'''
+from typing import Any, Callable, Dict, Optional
+
+import gunicorn.app.base
+
+class PreforkServer(gunicorn.app.base.BaseApplication):
+    def __init__(self, app, options: Dict[str, Any]):
+        self.app = app
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.app
+
+def run(app, port: int, workers: int, threads: int, max_requests: int = 0, graceful_timeout: int = 30,
+        init_worker: Optional[Callable[[], None]] = None, exit_worker: Optional[Callable[[], None]] = None) -> None:
+    options = {
+        'bind': f'0.0.0.0:{port}',
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': threads,
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests // 10,
+        'graceful_timeout': graceful_timeout
+    }
+    if init_worker is not None:
+        options['post_worker_init'] = lambda worker: init_worker()
+    if exit_worker is not None:
+        options['worker_exit'] = lambda arbiter, worker: exit_worker()
+    PreforkServer(app, options).run()
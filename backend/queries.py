@@ -0,0 +1,260 @@
+'''SQL statements of the API routes, shared by the sync (psycopg2) and async (psycopg 3) servers.
+
+Both drivers take the same `%s` and `%(name)s` placeholders. Statements with `{user}` are formatted with
+    `user_ref`, as users can be given either by id or by username. Statements of the hot paths are also registered
+    in `statements` to be prepared.
+'''
+from typing import Sequence
+
+user_refs = {'by_id': '%s', 'by_name': '(SELECT id FROM users WHERE username = %s)'}
+
+def user_variant(user) -> str:
+    return 'by_id' if str(user).isnumeric() else 'by_name'
+
+def user_ref(user) -> str:
+    return user_refs[user_variant(user)]
+
+# groups
+
+find_membership = 'SELECT id, user_id, status_id FROM users_groups WHERE group_id = %s AND user_id = {user}'
+
+group_version = 'SELECT version FROM groups WHERE id = %s'
+
+bump_version = 'UPDATE groups SET version = version + 1 WHERE id = %s'
+
+get_group = 'SELECT g.name, g.creator_id, u.username, g.balance, g.version FROM groups g' \
+        ' JOIN users u ON u.id = g.creator_id WHERE g.id = %s'
+
+group_users = 'SELECT u.id, u.username, ug.status_id FROM users_groups ug' \
+        ' JOIN users u ON u.id = ug.user_id WHERE ug.group_id = %s'
+
+group_users_by_status = group_users + ' AND ug.status_id = %s'
+
+add_group = 'INSERT INTO groups (name, creator_id) VALUES (%s, {user}) RETURNING id, creator_id'
+
+add_membership = 'INSERT INTO users_groups (user_id, group_id, status_id) VALUES (%s, %s, %s) RETURNING id'
+
+delete_group = 'DELETE FROM groups WHERE id = %s'
+
+group_page = 'WITH ops AS (' \
+        '   SELECT o.id, u.username, o.type_id, o.amount, o.name, o.description, o.date FROM operations o' \
+        '       JOIN users u ON o.user_id = u.id WHERE o.group_id = %(group_id)s' \
+        '       ORDER BY o.date DESC, o.id DESC LIMIT %(limit)s' \
+        '), msgs AS (' \
+        '   SELECT m.id, ug.user_id, u.username, m.message, m.time FROM messages m' \
+        '       JOIN users_groups ug ON m.user_group_id = ug.id JOIN users u ON ug.user_id = u.id' \
+        '       WHERE m.group_id = %(group_id)s ORDER BY m.time DESC, m.id DESC LIMIT %(limit)s' \
+        ')' \
+        ' SELECT g.name, g.creator_id, cu.username, g.balance,' \
+        '   (SELECT coalesce(json_agg(json_build_array(u.id, u.username, ug.status_id)), \'[]\') FROM users_groups ug' \
+        '       JOIN users u ON u.id = ug.user_id WHERE ug.group_id = g.id),' \
+        '   (SELECT coalesce(json_agg(json_build_array(id, username, type_id, amount, name, description,' \
+        '       to_char(date, \'YYYY-MM-DD HH24:MI:SS.US\'))' \
+        '       ORDER BY date DESC, id DESC), \'[]\') FROM ops),' \
+        '   (SELECT coalesce(json_agg(json_build_array(id, user_id, username, message,' \
+        '       to_char(time, \'YYYY-MM-DD HH24:MI:SS.US\'))' \
+        '       ORDER BY time DESC, id DESC), \'[]\') FROM msgs)' \
+        ' FROM groups g JOIN users cu ON cu.id = g.creator_id WHERE g.id = %(group_id)s'
+
+# users - groups
+
+user_groups_version = 'SELECT string_agg(g.id || \':\' || g.version, \',\' ORDER BY g.id) FROM users_groups ug' \
+        ' JOIN groups g ON g.id = ug.group_id WHERE ug.user_id = {user}'
+
+user_groups = 'SELECT g.id, g.name, uc.count, ug.status_id, g.creator_id, u.username, g.balance FROM groups g' \
+        ' JOIN users_groups ug ON g.id = ug.group_id' \
+        ' JOIN (SELECT group_id, count(*) FROM users_groups WHERE status_id = ANY(%s) GROUP BY group_id)' \
+        '       as uc ON g.id = uc.group_id' \
+        ' JOIN users u ON u.id = g.creator_id' \
+        ' WHERE ug.user_id = {user}{status} ORDER BY g.id'
+
+join_group = 'INSERT INTO users_groups (user_id, group_id, status_id) VALUES ({user}, %s, %s) ON CONFLICT DO NOTHING'
+
+set_status = 'UPDATE users_groups SET status_id = %s WHERE id = %s'
+
+# users
+
+add_user = 'INSERT INTO users (username, password, registration_date) VALUES (%s, %s, %s) RETURNING id'
+
+get_user = 'SELECT username FROM users WHERE id = %s'
+
+user_password = 'SELECT id, password FROM users WHERE username = %s'
+
+set_password = 'UPDATE users SET password = %s WHERE id = %s'
+
+# operations
+
+operations_columns = ('id', 'user', 'type', 'amount', 'name', 'description', 'date')
+
+operations = 'SELECT o.id, u.username, o.type_id, o.amount, o.name, o.description, o.date' \
+        ' FROM operations o JOIN users u ON o.user_id = u.id WHERE o.group_id = %s'
+
+operations_key = ('o.date', 'o.id')
+
+copy_operations = 'COPY operations (user_id, group_id, type_id, amount, name, description, date) FROM STDIN WITH (FORMAT csv)'
+
+add_to_balance = 'UPDATE groups SET balance = balance + %s, version = version + 1 WHERE id = %s'
+
+upsert_stats = ' ON CONFLICT (group_id, user_id, type_id, month) DO UPDATE' \
+        '   SET total = operation_stats.total + EXCLUDED.total, count = operation_stats.count + EXCLUDED.count'
+
+add_to_stats = 'INSERT INTO operation_stats (group_id, user_id, type_id, month, total, count) VALUES {values}' + upsert_stats
+
+# one statement (and transaction) checking membership, inserting the operation and changing balance, version and stats:
+#   parameters are group id, user, signed balance change, type id, amount, name, description and date.
+#   Membership row is locked against deletion and the group row is locked by its UPDATE until the end of the statement,
+#   so concurrent operations of the group are serialized on the group row and no balance change is lost.
+#   Nothing is changed and no row is returned if the user is not a member of the group
+create_operation = 'WITH ug AS (SELECT user_id, group_id FROM users_groups WHERE group_id = %s AND user_id = {user} FOR KEY SHARE),' \
+        '   g AS (UPDATE groups SET balance = balance + %s, version = version + 1' \
+        '       WHERE id = (SELECT group_id FROM ug) RETURNING id),' \
+        '   o AS (INSERT INTO operations (user_id, group_id, type_id, amount, name, description, date)' \
+        '       SELECT ug.user_id, g.id, %s::integer, %s::float, %s::varchar, %s::varchar, %s::timestamp FROM ug, g' \
+        '       RETURNING id, user_id, group_id, type_id, amount, date),' \
+        '   s AS (INSERT INTO operation_stats (group_id, user_id, type_id, month, total, count)' \
+        '       SELECT group_id, user_id, type_id, date_trunc(\'month\', date)::date, amount, 1 FROM o' + upsert_stats + ')' \
+        ' SELECT id FROM o'
+
+# statistics of the archived months are kept, as their operations are not in the database anymore
+_not_archived = '(SELECT coalesce(max(upper_bound), \'-infinity\') FROM archived_partitions WHERE parent = \'operations\')'
+
+delete_stats = 'DELETE FROM operation_stats WHERE month >= ' + _not_archived
+
+# operations dated before it would land in the partition of the archived months
+archived_before = 'SELECT max(upper_bound) FROM archived_partitions WHERE parent = \'operations\''
+
+rebuild_stats = 'INSERT INTO operation_stats (group_id, user_id, type_id, month, total, count)' \
+        ' SELECT group_id, user_id, type_id, date_trunc(\'month\', date)::date, sum(amount), count(*) FROM operations' \
+        ' WHERE date >= ' + _not_archived + ' GROUP BY group_id, user_id, type_id, date_trunc(\'month\', date)'
+
+_stats_keys = {'user': 'u.username', 'type': 's.type_id', 'month': 's.month'}
+
+def stats(columns: Sequence[str], since: bool, until: bool) -> str:
+    '''Returns query of operations totals grouped by the given columns of ('user', 'type', 'month'), with optional
+        lower and upper month bounds.
+    '''
+    query = f'SELECT {"".join(map(lambda key: _stats_keys[key] + ", ", columns))}sum(s.total), sum(s.count) FROM operation_stats s' \
+            + (' JOIN users u ON u.id = s.user_id' if 'user' in columns else '') + ' WHERE s.group_id = %s' \
+            + (' AND s.month >= %s' if since else '') + (' AND s.month <= %s' if until else '')
+    if len(columns) != 0:
+        query += f' GROUP BY {", ".join(map(_stats_keys.get, columns))} ORDER BY {", ".join(map(_stats_keys.get, columns))}'
+    return query
+
+# balance checkpoints
+
+# checkpoint is the balance of a group before the month, so that balance at a date and running balance of operations
+#   are summed from the nearest checkpoint instead of the whole history
+_signed_amount = 'CASE WHEN o.type_id = %(income)s THEN o.amount ELSE -o.amount END'
+
+# checkpoints after every month with operations are summed from the monthly statistics (which keep the archived months)
+#   up to the closed month given by `until`, an hour after it starts so that operations dated by the end of the previous
+#   month are committed
+_checkpoints = 'INSERT INTO balance_checkpoints (group_id, month, balance)' \
+        ' SELECT group_id, month, balance FROM (' \
+        '   SELECT group_id, (month + interval \'1 month\')::date AS month,' \
+        '       sum(change) OVER (PARTITION BY group_id ORDER BY month) AS balance FROM (' \
+        '       SELECT group_id, month, sum(CASE WHEN type_id = %(income)s THEN total ELSE -total END) AS change' \
+        '       FROM operation_stats GROUP BY group_id, month) m) c' \
+        ' WHERE month <= %(until)s::date'
+
+# existing checkpoints are recalculated, so that they follow rebuilt statistics
+create_checkpoints = _checkpoints + ' ON CONFLICT (group_id, month) DO UPDATE SET balance = EXCLUDED.balance' \
+        '   WHERE balance_checkpoints.balance <> EXCLUDED.balance'
+
+# checkpoints of the months closed since the last ones (`since`) are added when the server sees a new month. The lock
+#   lets one of the workers create them while others skip it
+try_checkpoints_lock = 'SELECT pg_try_advisory_xact_lock(2020_0002)'
+last_checkpoint = 'SELECT max(month) FROM balance_checkpoints'
+close_checkpoints = _checkpoints + ' AND month > coalesce(%(since)s::date, \'-infinity\') ON CONFLICT (group_id, month) DO NOTHING'
+
+# back-dated operations change the checkpoints after them: values are (group id, month, signed total) of the operations
+shift_checkpoints = 'UPDATE balance_checkpoints c SET balance = c.balance + d.change FROM (' \
+        '   SELECT c.group_id, c.month, sum(v.change) AS change FROM balance_checkpoints c' \
+        '       JOIN (VALUES {values}) AS v(group_id, month, change) ON v.group_id = c.group_id AND v.month < c.month' \
+        '   GROUP BY c.group_id, c.month) d' \
+        ' WHERE c.group_id = d.group_id AND c.month = d.month'
+
+_nearest_checkpoint = 'WITH c AS (SELECT month, balance FROM balance_checkpoints' \
+        ' WHERE group_id = %(group_id)s AND month <= %({date})s::timestamp ORDER BY month DESC LIMIT 1)'
+
+# balance after the operations dated up to `at`, the checkpoint it is summed from and if operations before `at`
+#   are archived (and so the balance is not known unless `at` is a checkpoint)
+balance_at = _nearest_checkpoint.format(date='at') + \
+        ' SELECT coalesce((SELECT balance FROM c), 0) + coalesce(sum(' + _signed_amount + '), 0), (SELECT month FROM c),' \
+        '   %(at)s::timestamp < ' + _not_archived + ' AND %(at)s::timestamp > coalesce((SELECT month FROM c), \'-infinity\')' \
+        ' FROM operations o WHERE o.group_id = %(group_id)s' \
+        '   AND o.date >= coalesce((SELECT month FROM c), \'-infinity\') AND o.date <= %(at)s::timestamp'
+
+# (id, balance after the operation) of the operations from (since, since_id) to (until, until_id) keys, except
+#   the ones older than the archived months
+running_balances = _nearest_checkpoint.format(date='since') + \
+        ' SELECT id, balance FROM (' \
+        '   SELECT o.id, o.date, coalesce((SELECT balance FROM c), 0)' \
+        '       + sum(' + _signed_amount + ') OVER (ORDER BY o.date, o.id ROWS UNBOUNDED PRECEDING) AS balance' \
+        '   FROM operations o WHERE o.group_id = %(group_id)s AND o.date >= coalesce((SELECT month FROM c), \'-infinity\')' \
+        '       AND o.date <= %(until)s::timestamp AND (o.date, o.id) <= (%(until)s::timestamp, %(until_id)s::integer)) r' \
+        ' WHERE (date, id) >= (%(since)s::timestamp, %(since_id)s::integer) AND date >= ' + _not_archived
+
+# groups (month is NULL) and checkpoints whose balance differs from the one summed from the operations, starting
+#   from the last checkpoint before the not archived operations
+reconcile_balances = 'WITH since AS (SELECT ' + _not_archived + ' AS month),' \
+        '   base AS (SELECT DISTINCT ON (c.group_id) c.group_id, c.month, c.balance FROM balance_checkpoints c, since' \
+        '       WHERE c.month <= since.month ORDER BY c.group_id, c.month DESC),' \
+        '   monthly AS (SELECT o.group_id, date_trunc(\'month\', o.date)::date AS month, sum(' + _signed_amount + ') AS change' \
+        '       FROM operations o LEFT JOIN base b ON b.group_id = o.group_id' \
+        '       WHERE o.date >= coalesce(b.month, \'-infinity\') GROUP BY o.group_id, date_trunc(\'month\', o.date)),' \
+        '   expected AS (' \
+        '       SELECT g.id AS group_id, NULL::date AS month, g.balance, coalesce(b.balance, 0) + coalesce(sum(m.change), 0) AS ledger' \
+        '       FROM groups g LEFT JOIN base b ON b.group_id = g.id LEFT JOIN monthly m ON m.group_id = g.id' \
+        '       GROUP BY g.id, g.balance, b.balance' \
+        '       UNION ALL' \
+        '       SELECT c.group_id, c.month, c.balance, coalesce(b.balance, 0) + coalesce(sum(m.change), 0)' \
+        '       FROM balance_checkpoints c LEFT JOIN base b ON b.group_id = c.group_id' \
+        '           LEFT JOIN monthly m ON m.group_id = c.group_id AND m.month < c.month' \
+        '       WHERE c.month > coalesce(b.month, \'-infinity\') GROUP BY c.group_id, c.month, c.balance, b.balance)' \
+        ' SELECT group_id, month, balance, ledger FROM expected' \
+        ' WHERE abs(balance - ledger) > 1e-9 * greatest(1, abs(ledger)) ORDER BY group_id, month NULLS FIRST'
+
+# chats
+
+messages_columns = ('message_id', 'user_id', 'user', 'message', 'time')
+
+messages = 'SELECT m.id, ug.user_id, u.username, m.message, m.time' \
+        ' FROM messages m JOIN users_groups ug ON m.user_group_id = ug.id' \
+        ' JOIN users u ON ug.user_id = u.id WHERE m.group_id = %s'
+
+messages_key = ('m.time', 'm.id')
+
+get_message = 'SELECT m.id, ug.user_id, u.username, m.message, m.time FROM messages m' \
+        ' JOIN users_groups ug ON m.user_group_id = ug.id JOIN users u ON ug.user_id = u.id WHERE m.id = %s'
+
+# NOTIFY payload is limited to 8000 bytes, longer messages are sent with id only and read by the listener
+send_message = 'WITH m AS (INSERT INTO messages (user_group_id, group_id, time, message) VALUES (%s, %s, %s, %s)' \
+        '       RETURNING id, time, message),' \
+        '   v AS (UPDATE groups SET version = version + 1 WHERE id = %s),' \
+        '   n AS (SELECT m.id, json_build_object(\'message_id\', m.id, \'user_id\', u.id, \'user\', u.username,' \
+        '       \'message\', m.message, \'time\', to_char(m.time, \'YYYY-MM-DD HH24:MI:SS\'))::text AS payload' \
+        '       FROM m JOIN users u ON u.id = %s)' \
+        ' SELECT id, pg_notify(%s, CASE WHEN octet_length(payload) < 7900 THEN payload' \
+        '       ELSE json_build_object(\'message_id\', id)::text END) FROM n'
+
+# search
+
+_tsquery = 'websearch_to_tsquery(\'simple\', %(q)s)'
+
+# matches are ranked in the group subqueries and users are joined only to the rows of the page
+search = 'WITH found AS (' \
+        '   SELECT \'message\' AS kind, m.id, m.time, ts_rank(m.search, ' + _tsquery + ')::float8 AS rank, m.user_group_id,' \
+        '       NULL::integer AS user_id, m.message AS text, NULL::varchar AS description, NULL::integer AS type_id,' \
+        '       NULL::float AS amount' \
+        '   FROM messages m WHERE m.group_id = %(group_id)s AND m.time >= %(from)s AND m.search @@ ' + _tsquery + \
+        '   UNION ALL' \
+        '   SELECT \'operation\', o.id, o.date, ts_rank(o.search, ' + _tsquery + ')::float8, NULL, o.user_id, o.name,' \
+        '       o.description, o.type_id, o.amount' \
+        '   FROM operations o WHERE o.group_id = %(group_id)s AND o.date >= %(from)s AND o.search @@ ' + _tsquery + ')' \
+        ' SELECT f.kind, f.id, u.username, f.time, f.rank, f.text, f.description, f.type_id, f.amount FROM (' \
+        '   SELECT * FROM found{after} ORDER BY rank DESC, time DESC, kind DESC, id DESC LIMIT %(limit)s) f' \
+        '   LEFT JOIN users_groups ug ON ug.id = f.user_group_id JOIN users u ON u.id = coalesce(f.user_id, ug.user_id)' \
+        ' ORDER BY f.rank DESC, f.time DESC, f.kind DESC, f.id DESC'
+
+search_after = ' WHERE (rank, time, kind, id) < (%(rank)s, %(time)s, %(kind)s, %(id)s)'
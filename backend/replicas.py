@@ -0,0 +1,150 @@
+import itertools
+import psycopg2, psycopg2.extensions
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from pool import ConnectionPool, PoolTimeout
+
+# replay lag of a standby, 0 for a primary and for a standby streaming WAL which has replayed everything it received
+#   (so an idle primary does not look like lag), infinite for a standby which does not stream WAL from its primary,
+#   as it does not know how far behind it is (the status is only shown to pg_read_all_stats role, others see
+#   if the WAL receiver is running)
+lag_query = 'SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0::float' \
+        ' WHEN NOT EXISTS (SELECT FROM pg_stat_wal_receiver WHERE coalesce(status, \'streaming\') = \'streaming\')' \
+        ' THEN \'Infinity\'::float' \
+        ' WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0::float' \
+        ' ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp())::float, 0) END'
+
+def replica_conn_string(replica: str, db_name: str, db_user: str, db_pass: str) -> str:
+    '''Returns connection string of the replica given as `host[:port]` (with database name, user and password of the
+        primary) or as a complete connection string.
+    '''
+    if '=' in replica or replica.startswith('postgres'):
+        return replica
+    host, _, port = replica.partition(':')
+    return f'host={host} port={port or 5432} dbname={db_name} user={db_user} password={db_pass}'
+
+class Replica:
+    def __init__(self, conn_string: str):
+        self.conn_string = conn_string
+        self.pool: Optional[ConnectionPool] = None
+        self.healthy = True
+        self.checked = 0.0
+        self.lag = 0.0
+
+class ReplicaSet:
+    '''Pools of connections to read-only replicas, given out in turn to the requests which only read data.
+
+    Replicas are checked at most every `check_interval` seconds: the one which can not be connected to or replays WAL
+        more than `max_lag` seconds behind the primary is skipped until the next check. Users who changed data less
+        than `stickiness` seconds ago are served by the primary, so that they read their own writes. `getconn` returns
+        None when there is no healthy replica with a free connection and the primary is to be used.
+    '''
+    def __init__(self, conn_strings: Iterable[str], pool_factory: Callable[[str], ConnectionPool], stickiness: float = 5.0,
+            max_lag: float = 10.0, check_interval: float = 5.0):
+        self.replicas = [Replica(conn_string) for conn_string in conn_strings]
+        self.pool_factory = pool_factory
+        self.stickiness = stickiness
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._writes: Dict[str, float] = {}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self.replica_reads = 0
+        self.fallback_reads = 0
+        self.sticky_reads = 0
+
+    def wrote(self, users: Iterable[str]) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for user in users:
+                self._writes[user] = now
+            if len(self._writes) > 10000:
+                self._writes = {user: written for user, written in self._writes.items() if now - written < self.stickiness}
+
+    @staticmethod
+    def last_write() -> str:
+        '''Returns the time of a write to be sent back by the client as `last_write` of `is_sticky`.'''
+        return f'{time.time():.3f}'
+
+    def is_sticky(self, users: Iterable[str], last_write: Optional[str] = None) -> bool:
+        try:
+            # wall clock time, as the processes (and hosts) serving the client compare it, their clocks may differ a bit
+            sticky = last_write is not None and abs(time.time() - float(last_write)) < self.stickiness
+        except ValueError:
+            sticky = False
+        now = time.monotonic()
+        with self._lock:
+            sticky = sticky or any(now - self._writes.get(user, float('-inf')) < self.stickiness for user in users)
+            if sticky:
+                self.sticky_reads += 1
+        return sticky
+
+    def _check(self, replica: Replica, conn: psycopg2.extensions.connection) -> bool:
+        with conn.cursor() as cur:
+            cur.execute(lag_query)
+            replica.lag = float(cur.fetchone()[0])
+        conn.rollback()
+        return replica.lag <= self.max_lag
+
+    def _mark(self, replica: Replica, healthy: bool, reason: str = 'is not available') -> None:
+        if replica.healthy != healthy:
+            print(f'Replica {replica.conn_string.split(" password=")[0]} ' + ('is healthy again' if healthy else
+                    f'{reason}, its reads go to the primary'))
+        replica.healthy = healthy
+        replica.checked = time.monotonic()
+
+    def getconn(self) -> Optional[Tuple[Replica, psycopg2.extensions.connection]]:
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._turn) % len(self.replicas)]
+            check = time.monotonic() - replica.checked >= self.check_interval
+            if not replica.healthy and not check:
+                continue
+            try:
+                with self._lock:
+                    if replica.pool is None:
+                        replica.pool = self.pool_factory(replica.conn_string)
+                conn = replica.pool.getconn()
+            except PoolTimeout:
+                continue # busy, but not broken
+            except psycopg2.Error as ex:
+                self._mark(replica, False, f'is not available ({str(ex).strip()})')
+                continue
+            if check:
+                try:
+                    healthy = self._check(replica, conn)
+                    reason = f'lags {replica.lag:.1f}s behind the primary' if replica.lag != float('inf') else \
+                            'does not stream WAL from the primary'
+                except psycopg2.Error as ex:
+                    healthy, reason = False, f'could not be checked ({str(ex).strip()})'
+                self._mark(replica, healthy, reason)
+                if not healthy:
+                    replica.pool.putconn(conn, discard=True)
+                    continue
+            with self._lock:
+                self.replica_reads += 1
+            return replica, conn
+        with self._lock:
+            self.fallback_reads += 1
+        return None
+
+    def putconn(self, replica: Replica, conn: psycopg2.extensions.connection) -> None:
+        if conn.closed:
+            self._mark(replica, False, 'lost connection') # during the request
+        replica.pool.putconn(conn)
+
+    @property
+    def stats(self) -> Dict[str, object]:
+        return {
+            'replicas': [{'healthy': replica.healthy, 'lag': replica.lag} for replica in self.replicas],
+            'replica_reads': self.replica_reads,
+            'fallback_reads': self.fallback_reads,
+            'sticky_reads': self.sticky_reads
+        }
+
+    def close(self) -> None:
+        for replica in self.replicas:
+            if replica.pool is not None:
+                replica.pool.close()
+                replica.pool = None
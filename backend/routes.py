@@ -0,0 +1,446 @@
+'''Validation of the API requests and building of their responses, shared by the sync (`backend.py`) and async
+    (`backend_async.py`) servers. Servers only take the request data, run the statements with their database
+    drivers and send the results, so that both of them answer the same requests in the same way.
+
+Invalid requests raise `ApiError`, which both servers answer with `{"error": message}` and its status. Registered
+    statements are referred to by their names in `statements.registry`, which also holds their SQL.
+'''
+import csv
+import datetime
+import io
+import itertools
+import json
+import time
+import traceback
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Sequence, Tuple
+
+import partitions
+import queries
+from auth import TokenSigner, TokenUser
+from cache import Membership
+from chat import chat_channel
+from lookups import Lookups
+from pagination import page_args, search_params
+from serialization import BadCursor, encode_cursor, format_time, rows_to_dicts
+from validation import parse_operation
+
+class ApiError(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+Statement = Tuple[str, Any] # name of the registered statement and its parameters
+
+# requests
+
+def require_user(args: Mapping[str, str]) -> str:
+    if 'user' not in args:
+        raise ApiError('user parameter is missing in request path')
+    return args['user']
+
+def require_member(membership: Optional[Membership], user, group_id: int) -> Membership:
+    if membership is None:
+        raise ApiError(f'user ({user}) is not found in the group ({group_id})', 403)
+    return membership
+
+def json_body(data: bytes) -> Any:
+    try:
+        return json.loads(data)
+    except ValueError:
+        raise ApiError('request body must be JSON')
+
+def require_fields(body: Any, fields: Sequence[str]) -> dict:
+    if not isinstance(body, dict) or not all(field in body for field in fields):
+        raise ApiError(f'request body is missing {", ".join(fields[:-1])} or {fields[-1]} fields'
+                if len(fields) > 1 else f'request body is missing {fields[0]} field')
+    return body
+
+def parse_time_arg(args: Mapping[str, str], name: str) -> Optional[datetime.datetime]:
+    if name not in args:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(args[name])
+    except ValueError:
+        raise ApiError(f'{name} must be a date in YYYY-MM-DD[ HH:MM:SS] format (but is {args[name]})')
+
+def parse_month_arg(args: Mapping[str, str], name: str) -> Optional[datetime.date]:
+    if name not in args:
+        return None
+    try:
+        return datetime.datetime.strptime(args[name], '%Y-%m').date()
+    except ValueError:
+        raise ApiError(f'{name} must be a month in YYYY-MM format (but is {args[name]})')
+
+# authentication
+
+def acting_users(args: Mapping[str, str], body: Any, view_args: Optional[Mapping[str, Any]], path: bool = True) -> List[str]:
+    '''Returns users the request is made by: `user` of the parameters and of the JSON body, or of the path if there
+        are none (routes changing another user take the changed one in the path).
+    '''
+    users = [user for user in (args.get('user'), str(body['user']) if isinstance(body, dict) and 'user' in body else None)
+            if user is not None]
+    if len(users) == 0 and path and view_args is not None and 'user' in view_args:
+        users.append(str(view_args['user']))
+    return users
+
+def authenticate(header: Optional[str], users: Sequence[str], tokens: TokenSigner, require_token: bool) -> Optional[TokenUser]:
+    '''Verifies `Authorization: Bearer <token>` header of the request, its user must be the one the request is made by.
+        Returns user of the token, None if the request has no token.
+
+    Requests without token are served as before unless tokens are required, then only those not made by a user are.
+    '''
+    if header is None or not header.startswith('Bearer '):
+        if require_token and len(users) != 0:
+            raise ApiError('Authorization: Bearer <token> header is required', 401)
+        return None
+    user = tokens.verify(header[len('Bearer '):])
+    if user is None:
+        raise ApiError('token is invalid or expired', 401)
+    for acting_user in users:
+        if acting_user not in (user.username, str(user.id)):
+            raise ApiError(f'token of the user ({user.username}) can not be used by {acting_user}', 403)
+    return user
+
+# groups
+
+def group_users_statement(group_id: int, status: Optional[str], lookups: Lookups) -> Optional[Statement]:
+    '''Returns statement selecting users of the group (with the status if it is given), None if there are none.'''
+    if status is None:
+        return 'group_users', (group_id,)
+    if lookups.status_id(status) is None:
+        return None
+    return 'group_users_by_status', (group_id, lookups.status_id(status))
+
+def group_result(group_id: int, group: Sequence[Any], users: Iterable[Sequence[Any]], lookups: Lookups) -> dict:
+    '''Returns group given by (name, creator_id, creator, balance) with its (id, username, status_id) users.'''
+    name, creator_id, creator, balance = group
+    return {
+        'group': {
+            'id': group_id,
+            'name': name,
+            'creator_id': creator_id,
+            'creator': creator,
+            'balance': balance,
+            'users': list(rows_to_dicts(('id', 'username', 'status'), users, {'status': lookups.status_names.get}))
+        }
+    }
+
+def new_group(body: Any) -> Tuple[str, tuple]:
+    '''Returns query and parameters adding the group of the request body.'''
+    body = require_fields(body, ('name', 'user'))
+    return queries.add_group.format(user=queries.user_ref(body['user'])), (body['name'], body['user'])
+
+def require_creator(membership: Optional[Membership], lookups: Lookups) -> None:
+    if membership is None or membership.status_id != lookups.statuses['creator']:
+        raise ApiError('user does not have enough right to delete group', 403)
+
+def group_page_result(group_id: int, res: Optional[Sequence[Any]], limit: int, lookups: Lookups) -> dict:
+    '''Returns group page of the `group_page` statement row selected with `limit + 1` rows of each kind.'''
+    if res is None:
+        raise ApiError(f'group with id={group_id} is not found', 404)
+    name, creator_id, creator, balance, users, operations, messages = res
+    result = group_result(group_id, (name, creator_id, creator, balance), users, lookups)
+    parse_time = lambda t: format_time(datetime.datetime.fromisoformat(t))
+    for key, rows, columns, converters in (
+            ('operations', operations, queries.operations_columns, {'type': lookups.operation_type_names.get, 'date': parse_time}),
+            ('messages', messages, queries.messages_columns, {'time': parse_time})):
+        result[key] = list(rows_to_dicts(columns, rows[:limit], converters))
+        result[f'{key}_next'] = encode_cursor(datetime.datetime.fromisoformat(rows[limit - 1][-1]), rows[limit - 1][0]) \
+                if len(rows) > limit else None
+    return result
+
+# users - groups
+
+def user_groups_statement(user: str, status: Optional[str], lookups: Lookups) -> Statement:
+    variant = queries.user_variant(user)
+    if status is None:
+        return f'user_groups_{variant}', (list(lookups.member_status_ids), user)
+    return f'user_groups_by_status_{variant}', (list(lookups.member_status_ids), user, lookups.status_id(status))
+
+def user_groups_result(rows: Iterable[Sequence[Any]], lookups: Lookups) -> Iterator[dict]:
+    return rows_to_dicts(('id', 'name', 'size', 'status', 'creator_id', 'creator', 'balance'), rows,
+            {'status': lookups.status_names.get})
+
+def join_statement(group_id: int, user: str, lookups: Lookups) -> Statement:
+    return f'join_group_{queries.user_variant(user)}', (user, group_id, lookups.statuses['pending'])
+
+def new_status(args: Mapping[str, str], lookups: Lookups) -> int:
+    '''Returns id of the status the request sets.'''
+    require_user(args)
+    if 'status' not in args:
+        raise ApiError('new status is missing in request path')
+    status_id = lookups.status_id(args['status'])
+    if status_id is None:
+        raise ApiError('status is not found')
+    return status_id
+
+def require_status_rights(requester: Optional[Membership], status: str, lookups: Lookups) -> None:
+    '''Admins can make members admins and creators can make them anyone but the creator.'''
+    requester_status = None if requester is None else lookups.status_names[requester.status_id]
+    if requester_status not in ('admin', 'creator') or status == 'creator' or (requester_status == 'admin' and status == 'admin'):
+        raise ApiError('not enough rights to change someone else\'s status', 403)
+
+# users
+
+def new_user(body: Any) -> Tuple[str, str]:
+    '''Returns username and password of the user to add.'''
+    body = require_fields(body, ('username', 'password'))
+    username = body['username']
+    if len(username) < 2:
+        raise ApiError('username must be at least 2 characters long')
+    if username.isnumeric():
+        raise ApiError('username must contain at least one letter or other symbol')
+    if any(sym in username for sym in '/& '):
+        raise ApiError('username contains illegal characters')
+    return username, body['password']
+
+def add_user_params(username: str, password: str) -> tuple:
+    t = time.localtime()
+    return username, password, f'{t.tm_year}-{t.tm_mon}-{t.tm_mday} {t.tm_hour}:{t.tm_min}:{t.tm_sec}'
+
+def login_body(body: Any) -> Tuple[str, str]:
+    body = require_fields(body, ('username', 'password'))
+    return body['username'], body['password']
+
+# operations
+
+def operations_result(rows: Iterable[Sequence[Any]], lookups: Lookups,
+        balances: Optional[Mapping[int, float]] = None) -> Iterator[dict]:
+    '''Returns operations of the page, with the balance after each one if `balances` are given.'''
+    operations = rows_to_dicts(queries.operations_columns, rows, {'type': lookups.operation_type_names.get, 'date': format_time})
+    if balances is None:
+        return operations
+    return map(lambda operation: dict(operation, balance=balances.get(operation['id'])), operations)
+
+def running_balances_statement(args: Mapping[str, str], group_id: int, rows: Sequence[Sequence[Any]],
+        lookups: Lookups) -> Optional[Statement]:
+    '''Returns statement selecting balances after the operations of the page (rows from the newest to the oldest one)
+        if the request asks for them with `balance=true`.
+    '''
+    if args.get('balance') != 'true' or len(rows) == 0:
+        return None
+    return 'running_balances', {'group_id': group_id, 'income': lookups.operation_types['income'],
+            'since': rows[-1][6], 'since_id': rows[-1][0], 'until': rows[0][6], 'until_id': rows[0][0]}
+
+def balance_statement(args: Mapping[str, str], group_id: int, lookups: Lookups) -> Statement:
+    '''Returns statement selecting balance of the group at `at` (now by default).'''
+    at = parse_time_arg(args, 'at') or datetime.datetime.now()
+    return 'balance_at', {'group_id': group_id, 'at': at, 'income': lookups.operation_types['income']}
+
+def balance_result(params: Mapping[str, Any], res: Sequence[Any]) -> dict:
+    balance, checkpoint, archived = res
+    if archived:
+        raise ApiError(f'operations of the month of {format_time(params["at"])} are archived')
+    return {'balance': balance, 'at': format_time(params['at']),
+            'checkpoint': checkpoint.strftime('%Y-%m') if checkpoint is not None else None}
+
+export_formats = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+def export_query(args: Mapping[str, str], group_id: int) -> Tuple[str, str, tuple]:
+    '''Returns format, query and parameters of the operations export, optionally limited by `from` and `to` dates.'''
+    require_user(args)
+    export_format = args.get('format', 'csv')
+    if export_format not in export_formats:
+        raise ApiError(f"format must be one of the {tuple(export_formats)}, but not '{export_format}'")
+    query = queries.operations
+    params: tuple = (group_id,)
+    for arg, condition in (('from', ' AND o.date >= %s'), ('to', ' AND o.date < %s')):
+        date = parse_time_arg(args, arg)
+        if date is not None:
+            params += (date,)
+            query += condition
+    return export_format, query + ' ORDER BY o.date, o.id', params
+
+def export_header(export_format: str) -> str:
+    return ','.join(queries.operations_columns) + '\n' if export_format == 'csv' else ''
+
+def export_chunk(export_format: str, rows: Iterable[Sequence[Any]], lookups: Lookups) -> str:
+    operations = operations_result(rows, lookups)
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(map(lambda row: row.values(), operations))
+        return buffer.getvalue()
+    return ''.join(map(lambda row: json.dumps(row) + '\n', operations))
+
+def export_headers(export_format: str, group_id: int) -> Dict[str, str]:
+    return {'Content-Disposition': f'attachment; filename=group_{group_id}_operations.{export_format}'}
+
+def new_operation(body: Any, group_id: int, lookups: Lookups) -> Statement:
+    '''Returns `create_operation` statement of the operation in the request body, dated now.'''
+    body = require_fields(body, ('user', 'type', 'amount', 'name'))
+    operation, error = parse_operation({**body, 'date': None}, lookups)
+    if error is not None:
+        raise ApiError(error)
+    user, type_id, amount, name, description, date = operation
+    change = amount if type_id == lookups.operation_types['income'] else -amount
+    return f'create_operation_{queries.user_variant(user)}', (group_id, user, change, type_id, amount, name, description, date)
+
+def created_operation_result(res: Optional[Sequence[Any]], user: str, group_id: int) -> dict:
+    if res is None:
+        raise ApiError(f'user ({user}) is not found in the group ({group_id})')
+    return {'result': 'ok', 'id': res[0]}
+
+def bulk_rows(rows: Any) -> List[dict]:
+    '''Checks operations of the bulk import given as JSON array or CSV rows.'''
+    if not isinstance(rows, list) or not all(map(lambda row: isinstance(row, dict), rows)):
+        raise ApiError('request body must be a JSON array of operations')
+    if len(rows) == 0:
+        raise ApiError('no operations are given')
+    return rows
+
+def parse_bulk(rows: Sequence[dict], lookups: Lookups,
+        archived_before: Optional[datetime.date]) -> Tuple[List[Tuple[int, tuple]], List[dict]]:
+    '''Validates operations of the bulk import, returns (row, operation) of the valid ones and errors of the others.
+
+    Operations can not be dated before `archived_before`, the first month which is not archived.
+    '''
+    parsed, errors = [], []
+    for i, row in enumerate(rows):
+        operation, error = parse_operation(row, lookups, archived_before)
+        if error is not None:
+            errors.append({'row': i, 'error': error})
+        else:
+            parsed.append((i, operation))
+    return parsed, errors
+
+def authorize_bulk(user: Optional[TokenUser], user_ids: Mapping[str, Optional[int]], require_token: bool) -> None:
+    '''Checks users of the bulk import rows, which `authenticate` does not see: all of them must be the user
+        of the token (given by `user_ids` of their memberships), and the token is required if tokens are.
+    '''
+    if user is None:
+        if require_token:
+            raise ApiError('Authorization: Bearer <token> header is required', 401)
+        return
+    for name, user_id in user_ids.items():
+        if user_id is not None and user_id != user.id:
+            raise ApiError(f'token of the user ({user.username}) can not be used by {name}', 403)
+
+def bulk_operations(parsed: Sequence[Tuple[int, tuple]], errors: List[dict], user_ids: Mapping[str, Optional[int]],
+        group_id: int, rows: int) -> List[tuple]:
+    '''Returns operations of the bulk import, `user_ids` are ids of their users in the group (None if they are not
+        members). Raises `BulkErrors` with errors of all of the wrong rows if there are any.
+    '''
+    errors = errors + [{'row': i, 'error': f'user ({operation[0]}) is not found in the group ({group_id})'}
+            for i, operation in parsed if user_ids[operation[0]] is None]
+    if len(errors) != 0:
+        raise BulkErrors(sorted(errors, key=lambda error: error['row']), rows)
+    return [operation for _, operation in parsed]
+
+class BulkImport(NamedTuple):
+    csv: str # rows of `queries.copy_operations`
+    balance_change: float
+    stats: List[tuple] # rows of `queries.add_to_stats`
+    checkpoints: List[tuple] # rows of `queries.shift_checkpoints`
+
+def bulk_import(operations: Sequence[tuple], user_ids: Mapping[str, int], group_id: int, lookups: Lookups) -> BulkImport:
+    '''Returns data of the import of the operations validated by `parse_operation`, `user_ids` are ids of their users.'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC) # so that empty description is not NULL
+    balance_change = 0.0
+    income = lookups.operation_types['income']
+    totals: Dict[Tuple[int, int, datetime.date], Tuple[float, int]] = {}
+    changes: Dict[datetime.date, float] = {}
+    for user, type_id, amount, name, description, date in operations:
+        writer.writerow((user_ids[user], group_id, type_id, amount, name, description, date))
+        change = amount if type_id == income else -amount
+        balance_change += change
+        month = date.date().replace(day=1)
+        total, count = totals.get((user_ids[user], type_id, month), (0.0, 0))
+        totals[(user_ids[user], type_id, month)] = (total + amount, count + 1)
+        # back-dated operations change the balance checkpoints after them
+        changes[month] = changes.get(month, 0.0) + change
+    return BulkImport(buffer.getvalue(), balance_change,
+            [(group_id, user_id, type_id, month, total, count) for (user_id, type_id, month), (total, count) in totals.items()],
+            [(group_id, month, change) for month, change in changes.items()])
+
+class BulkErrors(ApiError):
+    '''Errors of the bulk import rows (numbered from 0).'''
+    def __init__(self, errors: List[dict], rows: int):
+        super().__init__(f'{len(errors)} of {rows} operations are invalid')
+        self.errors = errors
+
+def checkpoint_month() -> datetime.date:
+    '''Returns the latest month balance checkpoints are created for: the current one an hour after it starts,
+        so that operations dated by the end of the previous month are committed.
+    '''
+    return (datetime.datetime.now() - datetime.timedelta(hours=1)).date().replace(day=1)
+
+def stats_query(args: Mapping[str, str], group_id: int) -> Tuple[List[str], str, tuple]:
+    '''Returns columns, query and parameters of the operations statistics grouped by any of the (user, type, month)
+        given in `by` (all by default), optionally limited by `from` and `to` months.
+    '''
+    by = args.get('by', 'user,type,month').split(',')
+    if not all(map(lambda key: key in ('user', 'type', 'month'), by)):
+        raise ApiError(f"by must contain only ('user', 'type', 'month'), but is '{args['by']}'")
+    columns = [key for key in ('user', 'type', 'month') if key in by]
+    since, until = parse_month_arg(args, 'from'), parse_month_arg(args, 'to')
+    params = (group_id,) + tuple(month for month in (since, until) if month is not None)
+    return columns, queries.stats(columns, since is not None, until is not None), params
+
+def stats_result(columns: List[str], rows: Iterable[Sequence[Any]], lookups: Lookups) -> Iterator[dict]:
+    return rows_to_dicts(columns + ['total', 'count'], rows,
+            {'type': lookups.operation_type_names.get, 'month': lambda month: month.strftime('%Y-%m')})
+
+# chats
+
+def messages_result(rows: Iterable[Sequence[Any]]) -> Iterator[dict]:
+    return rows_to_dicts(queries.messages_columns, rows, {'time': format_time})
+
+search_months = 12 # months before the current one searched unless `from` is given
+
+def search_query(args: Mapping[str, str], group_id: int) -> Tuple[str, dict, int]:
+    '''Returns query, parameters and page size of the search of `q` in the group since `from` time.
+
+    All of the matches are ranked before the page is selected, so they are bounded by time (the last `search_months`
+        months and the current one by default), which also skips partitions of the earlier months.
+    '''
+    require_user(args)
+    if len(args.get('q', '').strip()) == 0:
+        raise ApiError('q parameter is missing or empty')
+    after, before, limit = page_args(args)
+    if before is not None:
+        raise BadCursor('search results can only be paged forward with after cursor')
+    since = parse_time_arg(args, 'from')
+    params = search_params(group_id, args['q'], after, limit)
+    params['from'] = since if since is not None else \
+            datetime.datetime.combine(partitions.add_months(partitions.current_month(), -search_months), datetime.time())
+    return queries.search.format(after='' if after is None else queries.search_after), params, limit
+
+def send_message_statement(membership: Membership, group_id: int, message: str) -> Statement:
+    return 'send_message', (membership.id, group_id, datetime.datetime.now().replace(microsecond=0), message, group_id,
+            membership.user_id, chat_channel(group_id))
+
+sse_start = 'retry: 3000\n\n'
+sse_keepalive_event = ': keepalive\n\n'
+sse_headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+def sse_message(message: dict) -> str:
+    return f'id: {message["message_id"]}\nevent: message\ndata: {json.dumps(message)}\n\n'
+
+# errors
+
+def error_result(error: Exception, path: str, args: Mapping[str, str], body: str) -> dict:
+    params = '&'.join(map(lambda x: f'{x[0]}={x[1]}', args.items()))
+    print(f'path: {path}?{params}, body={body}')
+    traceback.print_exc()
+    return {
+        'error': str(error),
+        'error_type': str(type(error)),
+        'path': path,
+        'body': body,
+        'params': params,
+        'trace': list(itertools.chain(*map(lambda x: x.split('\n'), traceback.format_tb(error.__traceback__))))
+    }
+
+def api_error_result(error: ApiError) -> dict:
+    result = {'error': str(error)}
+    if isinstance(error, BulkErrors):
+        result['errors'] = error.errors
+    return result
+
+def not_found_result(path: str, args: Mapping[str, str]) -> dict:
+    return {
+        'error': 'not found',
+        'path': path,
+        'params': '&'.join(map(lambda x: f'{x[0]}={x[1]}', args.items())),
+    }
@@ -0,0 +1,56 @@
+import os
+import psycopg2
+from typing import List, Tuple
+
+migrations_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# any constant number, so that only one process applies migrations at a time
+_migrations_lock_id = 2020_0001
+
+def list_migrations(directory: str = migrations_dir) -> List[Tuple[int, str]]:
+    '''Returns (version, file name) pairs of migrations in the directory. File names are `<version>_<name>.sql`.'''
+    migrations = []
+    for filename in os.listdir(directory):
+        if filename.endswith('.sql') and filename.split('_', 1)[0].isnumeric():
+            migrations.append((int(filename.split('_', 1)[0]), filename))
+    migrations.sort()
+    if len(set(version for version, _ in migrations)) != len(migrations):
+        raise ValueError(f'migrations directory {directory} contains several migrations with the same version')
+    return migrations
+
+def applied_versions(conn: psycopg2.extensions.connection) -> List[int]:
+    with conn.cursor() as cur:
+        # servers started at once would race creating the table (IF NOT EXISTS does not stop concurrent ones)
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (_migrations_lock_id,))
+        cur.execute('CREATE TABLE IF NOT EXISTS schema_version ('
+                '   version integer PRIMARY KEY NOT NULL,'
+                '   name varchar(100) NOT NULL,'
+                '   applied_at timestamp NOT NULL DEFAULT now()'
+                ')')
+        cur.execute('SELECT version FROM schema_version ORDER BY version')
+        return list(map(lambda x: x[0], cur.fetchall()))
+
+def migrate(conn: psycopg2.extensions.connection, directory: str = migrations_dir) -> List[str]:
+    '''Applies pending migrations in the order of their versions, each one in its own transaction.
+
+    Returns names of the applied migrations, nothing is executed if the schema is up to date.
+    '''
+    migrations = list_migrations(directory)
+    applied = set(applied_versions(conn))
+    conn.commit()
+    if all(version in applied for version, _ in migrations):
+        return []
+    done = []
+    for version, filename in migrations:
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_advisory_xact_lock(%s)', (_migrations_lock_id,))
+            cur.execute('SELECT 1 FROM schema_version WHERE version = %s', (version,))
+            if cur.fetchone() is not None:
+                conn.commit()
+                continue
+            with open(os.path.join(directory, filename)) as f:
+                cur.execute(f.read())
+            cur.execute('INSERT INTO schema_version (version, name) VALUES (%s, %s)', (version, filename))
+        conn.commit()
+        done.append(filename)
+    return done
@@ -0,0 +1,82 @@
+import base64
+import datetime
+import hashlib
+import json
+from flask import Response
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+def format_time(t: datetime.datetime) -> str:
+    return t.isoformat(' ', 'seconds')
+
+def make_etag(version, full_path: str) -> str:
+    '''Returns ETag of the response given by the data version and request path with parameters.'''
+    return hashlib.md5(f'{version}|{full_path}'.encode()).hexdigest()
+
+class BadCursor(ValueError):
+    pass
+
+def _encode_key(key: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def _decode_key(cursor: str) -> list:
+    return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+
+def encode_cursor(t: datetime.datetime, id: int) -> str:
+    '''Returns opaque pagination cursor pointing at the row with the given (time, id) key.'''
+    return _encode_key([t.isoformat(), id])
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    try:
+        t, id = _decode_key(cursor)
+        return datetime.datetime.fromisoformat(t), int(id)
+    except (ValueError, TypeError) as ex:
+        raise BadCursor(f'pagination cursor "{cursor}" is malformed') from ex
+
+def encode_search_cursor(rank: float, t: datetime.datetime, kind: str, id: int) -> str:
+    '''Returns opaque cursor pointing at the search result with the given (rank, time, kind, id) key.'''
+    return _encode_key([rank, t.isoformat(), kind, id])
+
+def decode_search_cursor(cursor: str) -> Tuple[float, datetime.datetime, str, int]:
+    try:
+        rank, t, kind, id = _decode_key(cursor)
+        return float(rank), datetime.datetime.fromisoformat(t), str(kind), int(id)
+    except (ValueError, TypeError) as ex:
+        raise BadCursor(f'search cursor "{cursor}" is malformed') from ex
+
+def rows_to_dicts(columns: Sequence[str], rows: Iterable[Sequence[Any]],
+        converters: Optional[Dict[str, Callable[[Any], Any]]] = None) -> Iterator[Dict[str, Any]]:
+    '''Maps cursor rows to dictionaries with given column names, applying converters to the named columns.'''
+    if not converters:
+        for row in rows:
+            yield dict(zip(columns, row))
+        return
+    converted = [(i, converters[column]) for i, column in enumerate(columns) if column in converters]
+    for row in rows:
+        row = list(row)
+        for i, converter in converted:
+            if row[i] is not None:
+                row[i] = converter(row[i])
+        yield dict(zip(columns, row))
+
+def stream_json(key: str, items: Iterable[Dict[str, Any]], extra: Optional[Dict[str, Any]] = None,
+        status: int = 200) -> Response:
+    '''Returns response with JSON object `{key: [items...], **extra}` encoded item by item while being sent.
+
+    `items` must not depend on the request database connection as it is already returned to the pool
+        when the response body is being generated.
+    '''
+    def generate() -> Iterator[str]:
+        yield '{' + json.dumps(key) + ': ['
+        first = True
+        for item in items:
+            if first:
+                first = False
+                yield json.dumps(item)
+            else:
+                yield ', ' + json.dumps(item)
+        yield ']'
+        if extra:
+            for name, value in extra.items():
+                yield f', {json.dumps(name)}: {json.dumps(value)}'
+        yield '}\n'
+    return Response(generate(), status=status, mimetype='application/json')
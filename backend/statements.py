@@ -0,0 +1,120 @@
+import psycopg2, psycopg2.errors, psycopg2.extensions
+import re
+from typing import Dict, List, Mapping, Set, Union
+
+import queries
+from pagination import keyset_sql
+
+_placeholder_re = re.compile(r'%\((\w+)\)s|%s|%%')
+
+class Statement:
+    '''Named SQL statement with psycopg2 placeholders and its PREPARE form with positional `$n` parameters.
+
+    Statement takes either positional (`%s`) or named (`%(name)s`) parameters, named ones are numbered in the order
+        of their first appearance.
+    '''
+    def __init__(self, name: str, sql: str):
+        self.name = name
+        self.sql = sql
+        self.param_names: List[str] = []
+        self.params_count = 0
+        positional = False
+        def to_positional(match: 're.Match') -> str:
+            nonlocal positional
+            if match.group(0) == '%%':
+                return '%'
+            if match.group(1) is None:
+                positional = True
+                self.params_count += 1
+                return f'${self.params_count}'
+            if match.group(1) not in self.param_names:
+                self.param_names.append(match.group(1))
+            return f'${self.param_names.index(match.group(1)) + 1}'
+        self.prepare_sql = f'PREPARE {name} AS {_placeholder_re.sub(to_positional, sql)}'
+        if positional and len(self.param_names) != 0:
+            raise ValueError(f'statement {name} mixes positional and named parameters')
+        self.params_count = max(self.params_count, len(self.param_names))
+        self.execute_sql = f'EXECUTE {name}' + (f' ({", ".join(["%s"] * self.params_count)})' if self.params_count else '')
+
+    def args(self, params: Union[tuple, Mapping[str, object]]) -> tuple:
+        if len(self.param_names) != 0:
+            return tuple(params[name] for name in self.param_names)
+        return tuple(params)
+
+class PreparingConnection(psycopg2.extensions.connection):
+    '''Connection remembering names of the statements prepared in its session.'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: Set[str] = set()
+
+class StatementRegistry:
+    '''Named statements of the hot paths, PREPAREd once per connection on the first use and then run with EXECUTE,
+        so that PostgreSQL does not parse and plan them on every request.
+
+    Statements are prepared only on `PreparingConnection`s, on others (or when the registry is disabled) they are
+        executed as plain queries. Prepared statements outlive transactions, so only failed PREPARE or EXECUTE
+        make the statement be prepared again.
+    '''
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._statements: Dict[str, Statement] = {}
+
+    def add(self, name: str, sql: str) -> None:
+        if name in self._statements:
+            raise ValueError(f'statement {name} is already registered')
+        self._statements[name] = Statement(name, sql)
+
+    def __getitem__(self, name: str) -> Statement:
+        return self._statements[name]
+
+    def __iter__(self):
+        return iter(self._statements.values())
+
+    def execute(self, cur: psycopg2.extensions.cursor, name: str, params: Union[tuple, Mapping[str, object]] = ()) -> None:
+        statement = self._statements[name]
+        conn = cur.connection
+        if not self.enabled or not isinstance(conn, PreparingConnection):
+            cur.execute(statement.sql, params)
+            return
+        if name not in conn.prepared:
+            try:
+                cur.execute(statement.prepare_sql)
+            except psycopg2.errors.DuplicatePreparedStatement:
+                conn.prepared.add(name) # transaction is aborted anyway, statement is used on the next request
+                raise
+            conn.prepared.add(name)
+        try:
+            cur.execute(statement.execute_sql, statement.args(params))
+        except psycopg2.errors.InvalidSqlStatementName:
+            conn.prepared.discard(name)
+            raise
+
+    def prepare_all(self, conn: psycopg2.extensions.connection) -> None:
+        '''Prepares all of the registered statements on the connection, e.g. when warming it up.'''
+        if not self.enabled or not isinstance(conn, PreparingConnection):
+            return
+        with conn.cursor() as cur:
+            for statement in self._statements.values():
+                if statement.name not in conn.prepared:
+                    cur.execute(statement.prepare_sql)
+                    conn.prepared.add(statement.name)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'enabled': self.enabled, 'statements': len(self._statements)}
+
+registry = StatementRegistry()
+
+for variant, user_ref in queries.user_refs.items():
+    registry.add(f'find_membership_{variant}', queries.find_membership.format(user=user_ref))
+    registry.add(f'user_groups_version_{variant}', queries.user_groups_version.format(user=user_ref))
+    registry.add(f'user_groups_{variant}', queries.user_groups.format(user=user_ref, status=''))
+    registry.add(f'user_groups_by_status_{variant}', queries.user_groups.format(user=user_ref, status=' AND ug.status_id = %s'))
+    registry.add(f'join_group_{variant}', queries.join_group.format(user=user_ref))
+    registry.add(f'create_operation_{variant}', queries.create_operation.format(user=user_ref))
+for name in ('group_version', 'bump_version', 'get_group', 'group_users', 'group_users_by_status', 'group_page', 'set_status',
+        'get_user', 'user_password', 'add_to_balance', 'archived_before', 'balance_at', 'running_balances', 'get_message', 'send_message'):
+    registry.add(name, getattr(queries, name))
+for name, key in (('operations', queries.operations_key), ('messages', queries.messages_key)):
+    for direction in ('first', 'after', 'before'):
+        registry.add(f'{name}_{direction}', keyset_sql(getattr(queries, name), key, direction))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# backend modules are imported by name, as the servers do
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
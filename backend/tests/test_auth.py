@@ -0,0 +1,25 @@
+import time
+
+from auth import TokenSigner, TokenUser
+
+def test_token_round_trip():
+    signer = TokenSigner(b'secret')
+    assert signer.verify(signer.issue(7, 'alice')) == TokenUser(7, 'alice')
+
+def test_expired_token(monkeypatch):
+    signer = TokenSigner(b'secret', ttl=60)
+    token = signer.issue(7, 'alice')
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 120)
+    assert signer.verify(token) is None
+
+def test_forged_token():
+    signer = TokenSigner(b'secret')
+    token = signer.issue(7, 'alice')
+    payload, _, signature = token.partition('.')
+    other = TokenSigner(b'other secret').issue(1, 'admin')
+    assert TokenSigner(b'other secret').verify(token) is None
+    assert signer.verify(other) is None
+    assert signer.verify(other.partition('.')[0] + '.' + signature) is None
+    assert signer.verify(payload) is None
+    assert signer.verify('') is None
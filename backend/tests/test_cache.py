@@ -0,0 +1,53 @@
+import time
+
+from cache import Membership, MembershipCache
+
+membership = Membership(1, 7, 2)
+
+def test_put_and_get():
+    cache = MembershipCache()
+    assert cache.get(1, 'alice') is None
+    cache.put(1, 'alice', membership)
+    assert cache.get(1, 'alice') == membership
+    assert cache.stats['hits'] == 1 and cache.stats['misses'] == 1
+
+def test_entries_expire(monkeypatch):
+    cache = MembershipCache(ttl=30)
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+    cache.put(1, 'alice', membership)
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 31)
+    assert cache.get(1, 'alice') is None
+    assert cache.stats['size'] == 0
+
+def test_least_recently_used_entry_is_evicted():
+    cache = MembershipCache(max_size=2)
+    cache.put(1, 'alice', membership)
+    cache.put(1, 'bob', membership)
+    cache.get(1, 'alice')
+    cache.put(2, 'alice', membership)
+    assert cache.get(1, 'bob') is None
+    assert cache.get(1, 'alice') == membership
+
+def test_invalidation_drops_all_keys_of_the_group():
+    cache = MembershipCache()
+    cache.put(1, 'alice', membership)
+    cache.put(1, '7', membership)
+    cache.put(2, 'alice', membership)
+    cache.invalidate_group(1)
+    assert cache.get(1, 'alice') is None and cache.get(1, '7') is None
+    assert cache.get(2, 'alice') == membership
+
+def test_membership_read_before_invalidation_is_not_put():
+    cache = MembershipCache()
+    generation = cache.generation
+    cache.invalidate_group(1) # committed while the membership was read
+    cache.put(1, 'alice', membership, generation)
+    assert cache.get(1, 'alice') is None
+    cache.put(1, 'alice', membership, cache.generation)
+    assert cache.get(1, 'alice') == membership
+
+def test_disabled_cache():
+    cache = MembershipCache(max_size=0)
+    cache.put(1, 'alice', membership)
+    assert cache.get(1, 'alice') is None
@@ -0,0 +1,48 @@
+import datetime
+
+import pytest
+
+from pagination import keyset_params, keyset_result, page_args, search_params
+from serialization import BadCursor, decode_cursor, decode_search_cursor, encode_cursor, encode_search_cursor
+
+t = datetime.datetime(2020, 5, 17, 12, 30, 15, 250000)
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(t, 42)) == (t, 42)
+    assert decode_search_cursor(encode_search_cursor(0.5, t, 'message', 7)) == (0.5, t, 'message', 7)
+
+@pytest.mark.parametrize('cursor', ['', 'garbage', encode_cursor(t, 42)[:-3], encode_search_cursor(0.5, t, 'message', 7)])
+def test_tampered_cursor_is_rejected(cursor):
+    with pytest.raises(BadCursor):
+        decode_cursor(cursor)
+
+def test_tampered_search_cursor_is_rejected():
+    with pytest.raises(BadCursor):
+        decode_search_cursor(encode_cursor(t, 42))
+    with pytest.raises(BadCursor):
+        search_params(1, 'q', 'garbage', 10)
+
+def test_page_args():
+    assert page_args({}) == (None, None, 50)
+    assert page_args({'after': 'a', 'limit': '1000'}) == ('a', None, 200)
+    with pytest.raises(BadCursor):
+        page_args({'after': 'a', 'before': 'b'})
+    with pytest.raises(BadCursor):
+        page_args({'limit': 'many'})
+
+def test_keyset_params():
+    assert keyset_params((1,), None, None, 10) == (1, 11)
+    assert keyset_params((1,), encode_cursor(t, 42), None, 10) == (1, t, t, 42, 11)
+
+def test_keyset_pages():
+    rows = [(t - datetime.timedelta(minutes=i), 10 - i) for i in range(4)] # newest first, one more than the limit
+    page, next_cursor, prev_cursor = keyset_result(rows, (0, 1), None, None, 3)
+    assert page == rows[:3] and prev_cursor is None
+    assert decode_cursor(next_cursor) == rows[2]
+    page, next_cursor, prev_cursor = keyset_result(rows[3:], (0, 1), next_cursor, None, 3)
+    assert page == rows[3:] and next_cursor is None
+    assert decode_cursor(prev_cursor) == rows[3]
+    # rows before the cursor are selected oldest first and returned newest first
+    page, next_cursor, prev_cursor = keyset_result(rows[2::-1], (0, 1), None, prev_cursor, 3)
+    assert page == rows[:3] and prev_cursor is None
+    assert decode_cursor(next_cursor) == rows[2]
@@ -0,0 +1,32 @@
+import pytest
+
+from statements import Statement, StatementRegistry
+
+def test_named_parameters_are_numbered_by_first_appearance():
+    statement = Statement('find', 'SELECT * FROM t WHERE a = %(a)s AND b = %(b)s OR a = %(a)s')
+    assert statement.prepare_sql == 'PREPARE find AS SELECT * FROM t WHERE a = $1 AND b = $2 OR a = $1'
+    assert statement.execute_sql == 'EXECUTE find (%s, %s)'
+    assert statement.args({'b': 2, 'a': 1, 'unused': 3}) == (1, 2)
+
+def test_positional_parameters():
+    statement = Statement('insert', 'INSERT INTO t VALUES (%s, %s)')
+    assert statement.prepare_sql == 'PREPARE insert AS INSERT INTO t VALUES ($1, $2)'
+    assert statement.execute_sql == 'EXECUTE insert (%s, %s)'
+    assert statement.args([1, 2]) == (1, 2)
+
+def test_without_parameters_and_with_percent():
+    statement = Statement('like', "SELECT * FROM t WHERE name LIKE 'a%%'")
+    assert statement.prepare_sql == "PREPARE like AS SELECT * FROM t WHERE name LIKE 'a%'"
+    assert statement.execute_sql == 'EXECUTE like'
+    assert statement.args(()) == ()
+
+def test_mixed_parameters_are_rejected():
+    with pytest.raises(ValueError):
+        Statement('mixed', 'SELECT %s, %(a)s')
+
+def test_registry_rejects_duplicate_names():
+    registry = StatementRegistry()
+    registry.add('one', 'SELECT 1')
+    with pytest.raises(ValueError):
+        registry.add('one', 'SELECT 2')
+    assert registry['one'].sql == 'SELECT 1'
@@ -0,0 +1,24 @@
+import datetime
+
+from lookups import Lookups
+from validation import parse_operation
+
+lookups = Lookups({'creator': 1, 'admin': 2, 'user': 3}, {'income': 1, 'expense': 2})
+
+def test_valid_operation():
+    operation, error = parse_operation({'user': 'alice', 'type': 'income', 'amount': '10.5', 'name': 'salary',
+            'date': '2020-05-17 12:00:00'}, lookups)
+    assert error is None
+    assert operation == ('alice', 1, 10.5, 'salary', '', datetime.datetime(2020, 5, 17, 12))
+
+def test_wrong_fields_are_row_errors():
+    valid = {'user': 'alice', 'type': 'income', 'amount': 1, 'name': 'salary'}
+    for wrong in ({'type': ['income']}, {'type': {'name': 'income'}}, {'type': 'gift'}, {'amount': 'nan'},
+            {'amount': [1]}, {'name': ''}, {'date': 'yesterday'}):
+        operation, error = parse_operation({**valid, **wrong}, lookups)
+        assert operation is None and error is not None
+
+def test_archived_months_are_rejected():
+    row = {'user': 'alice', 'type': 'income', 'amount': 1, 'name': 'salary', 'date': '2019-12-31 23:59:59'}
+    assert parse_operation(row, lookups, datetime.date(2020, 1, 1))[1] is not None
+    assert parse_operation(row, lookups, datetime.date(2019, 12, 1))[1] is None
@@ -0,0 +1,40 @@
+import datetime
+import math
+from typing import Optional, Tuple
+
+from lookups import Lookups
+
+def parse_operation(row: dict, lookups: Lookups,
+        archived_before: Optional[datetime.date] = None) -> Tuple[Optional[tuple], Optional[str]]:
+    '''Validates operation given as a dictionary of (user, type, amount, name, description, date) fields, dated
+        not before `archived_before` (the first month which is not archived) if it is given.
+
+    Returns (user, type_id, amount, name, description, date) tuple or an error message.
+    '''
+    missing = [field for field in ('user', 'type', 'amount', 'name') if row.get(field) in (None, '')]
+    if len(missing) != 0:
+        return None, f'missing {", ".join(missing)} field{"s" if len(missing) > 1 else ""}'
+    type_id = lookups.operation_type_id(row['type']) if isinstance(row['type'], str) else None
+    if type_id is None:
+        return None, f"operation type must be one of the {tuple(lookups.operation_types)}, but not '{row['type']}'"
+    try:
+        amount = float(row['amount'])
+    except (ValueError, TypeError):
+        return None, f'amount must be a floating point number (but is {row["amount"]})'
+    if not math.isfinite(amount):
+        return None, f'amount must be a finite number (but is {row["amount"]})'
+    name, description = str(row['name']), str(row.get('description') or '')
+    if len(name) > 50:
+        return None, 'name must be at most 50 characters long'
+    if len(description) > 255:
+        return None, 'description must be at most 255 characters long'
+    if row.get('date') in (None, ''):
+        date = datetime.datetime.now().replace(microsecond=0)
+    else:
+        try:
+            date = datetime.datetime.fromisoformat(str(row['date']))
+        except ValueError:
+            return None, f'date must be in YYYY-MM-DD HH:MM:SS format (but is {row["date"]})'
+    if archived_before is not None and date.date() < archived_before:
+        return None, f'date must not be before {archived_before:%Y-%m}, operations of the earlier months are archived'
+    return (str(row['user']), type_id, amount, name, description, date), None
@@ -0,0 +1,41 @@
+'''Compares sync and async backend servers under the same load.
+
+Start both servers against the same seeded database (e.g. `backend.py -p 3001` and `backend.py -p 3002 --server async`)
+    and run the script with the manifest written by `seed.py`.
+'''
+import argparse
+import json
+
+from load import endpoints, load_targets, print_level, revision, run_level
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares throughput and latency of the sync and async API servers')
+    parser.add_argument('-s', '--sync_addr', action='store', dest='sync_addr',
+                        help=f'sync server address', type=str, default='http://localhost:3001')
+    parser.add_argument('-a', '--async_addr', action='store', dest='async_addr',
+                        help=f'async server address', type=str, default='http://localhost:3002')
+    parser.add_argument('-f', '--manifest', action='store', dest='manifest',
+                        help=f'manifest of the seeded groups written by seed.py', type=str, default='seed.json')
+    parser.add_argument('-c', '--concurrency', action='store', dest='concurrency',
+                        help=f'comma-separated numbers of concurrent clients', type=str, default='16,64,256')
+    parser.add_argument('-d', '--duration', action='store', dest='duration',
+                        help=f'seconds of measured load for each server and concurrency level', type=float, default=10.0)
+    parser.add_argument('-w', '--warmup', action='store', dest='warmup',
+                        help=f'seconds of load before measuring', type=float, default=2.0)
+    parser.add_argument('-r', '--read_only', action='store_true', dest='read_only',
+                        help=f'do not create operations and chat messages')
+    parser.add_argument('-o', '--output', action='store', dest='output',
+                        help=f'file to write JSON results to', type=str, default='compare_servers.json')
+    args = parser.parse_args()
+
+    mix = [endpoint for endpoint in endpoints if not (args.read_only and endpoint.write)]
+    targets = load_targets(args.manifest)
+    results = {'revision': revision(), 'levels': []}
+    for concurrency in map(int, args.concurrency.split(',')):
+        for mode, api_addr in (('sync', args.sync_addr), ('async', args.async_addr)):
+            result = {'server': mode, **run_level(api_addr.rstrip('/'), mix, targets, concurrency, args.duration, args.warmup)}
+            print_level(mode, result)
+            results['levels'].append(result)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results are written to {args.output}')
@@ -0,0 +1,132 @@
+'''Stress test of operations created concurrently in one group: many writers post operations at once and then
+    the group balance and statistics are checked to have changed by exactly the sum of the accepted operations.
+
+Amounts are whole numbers, so that float sums do not depend on the order of additions. Every writer also posts
+    operations on behalf of a user who is not a member of the group, which must be rejected without changes.
+'''
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import requests
+
+from load import load_targets, percentile
+
+def group_state(api_addr: str, group: int, user: str) -> Tuple[float, Dict[str, Tuple[float, int]]]:
+    '''Returns balance of the group and (total, count) of its operations by type.'''
+    response = requests.get(f'{api_addr}/group/{group}/', timeout=30)
+    response.raise_for_status()
+    balance = response.json()['group']['balance']
+    response = requests.get(f'{api_addr}/group/{group}/stats', params={'user': user, 'by': 'type'}, timeout=30)
+    response.raise_for_status()
+    return balance, {row['type']: (row['total'], row['count']) for row in response.json()['stats']}
+
+def write(api_addr: str, group: int, members: List[str], writers: int, operations: int, seed: int) -> Dict[str, Any]:
+    '''Posts `operations` operations from each of `writers` threads, returns sums of the accepted ones by type.'''
+    totals = {'income': [0, 0], 'spending': [0, 0]}
+    latencies: List[float] = []
+    counts = {'accepted': 0, 'failed': 0, 'rejected': 0, 'wrongly_accepted': 0}
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(writers)
+    def writer(n: int) -> None:
+        rnd = random.Random(seed * 100003 + n)
+        session = requests.Session()
+        own_totals = {'income': [0, 0], 'spending': [0, 0]}
+        own_latencies = []
+        own_counts = dict.fromkeys(counts, 0)
+        try:
+            start_barrier.wait()
+            for i in range(operations):
+                stranger = i % 10 == 0
+                operation = {'user': f'not_a_member_{n}' if stranger else rnd.choice(members),
+                        'type': rnd.choice(('income', 'spending')), 'amount': rnd.randint(1, 1000),
+                        'name': 'concurrent write', 'description': f'writer {n}'}
+                start = time.perf_counter()
+                try:
+                    response = session.post(f'{api_addr}/group/{group}/operation/', json=operation, timeout=30)
+                    status = response.status_code
+                except requests.RequestException:
+                    status = None
+                own_latencies.append(time.perf_counter() - start)
+                if stranger:
+                    own_counts['rejected' if status == 400 else 'wrongly_accepted' if status == 200 else 'failed'] += 1
+                elif status == 200:
+                    own_counts['accepted'] += 1
+                    own_totals[operation['type']][0] += operation['amount']
+                    own_totals[operation['type']][1] += 1
+                else:
+                    own_counts['failed'] += 1
+        finally:
+            session.close()
+            with lock:
+                latencies.extend(own_latencies)
+                for key in counts:
+                    counts[key] += own_counts[key]
+                for operation_type in totals:
+                    totals[operation_type][0] += own_totals[operation_type][0]
+                    totals[operation_type][1] += own_totals[operation_type][1]
+    started = time.monotonic()
+    with ThreadPoolExecutor(writers, thread_name_prefix='writer') as executor:
+        for future in [executor.submit(writer, n) for n in range(writers)]:
+            future.result()
+    duration = time.monotonic() - started
+    latencies.sort()
+    return {
+        **counts,
+        'totals': totals,
+        'duration': round(duration, 3),
+        'rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2)
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Creates operations of one group concurrently and verifies its balance')
+    parser.add_argument('-a', '--api_addr', action='store', dest='api_addr',
+                        help=f'finances app API server address', type=str, default='http://localhost:3001')
+    parser.add_argument('-f', '--manifest', action='store', dest='manifest',
+                        help=f'seeded groups and their members, written by seed.py', type=str, default='seed.json')
+    parser.add_argument('-g', '--group', action='store', dest='group',
+                        help=f'id of the group to write to, the first group of the manifest by default', type=int, default=None)
+    parser.add_argument('-w', '--writers', action='store', dest='writers',
+                        help=f'number of concurrent writers', type=int, default=64)
+    parser.add_argument('-n', '--operations', action='store', dest='operations',
+                        help=f'number of operations posted by each writer', type=int, default=100)
+    parser.add_argument('-s', '--seed', action='store', dest='seed',
+                        help=f'random seed of the operations', type=int, default=2020)
+    args = parser.parse_args()
+
+    targets = load_targets(args.manifest)
+    group = args.group if args.group is not None else targets[0].group if len(targets) != 0 else None
+    members = [target.user for target in targets if target.group == group]
+    if len(members) == 0:
+        parser.error(f'group {group} has no members in {args.manifest}')
+    balance, stats = group_state(args.api_addr, group, members[0])
+    result = write(args.api_addr, group, members, args.writers, args.operations, args.seed)
+    new_balance, new_stats = group_state(args.api_addr, group, members[0])
+
+    totals = result['totals']
+    expected_balance = balance + totals['income'][0] - totals['spending'][0]
+    checks = {'balance': (new_balance, expected_balance)}
+    for operation_type in ('income', 'spending'):
+        total, count = stats.get(operation_type, (0, 0))
+        new_total, new_count = new_stats.get(operation_type, (0, 0))
+        checks[f'{operation_type}_total'] = (new_total - total, totals[operation_type][0])
+        checks[f'{operation_type}_count'] = (new_count - count, totals[operation_type][1])
+    print(json.dumps(result, indent=2))
+    ok = result['failed'] == 0 and result['wrongly_accepted'] == 0
+    for name, (actual, expected) in checks.items():
+        matches = abs(actual - expected) < 1e-6
+        ok = ok and matches
+        print(f'{name:<16} {"ok" if matches else "MISMATCH"}  actual {actual}  expected {expected}')
+    if result['failed'] != 0:
+        print(f'{result["failed"]} operations failed, the expected values may be wrong')
+    if result['wrongly_accepted'] != 0:
+        print(f'{result["wrongly_accepted"]} operations of a user who is not a member were accepted')
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,172 @@
+'''Drives a mix of the backend routes at set concurrency levels and reports throughput and latency per endpoint.
+
+Requests are made on behalf of random members of the groups from the manifest written by `seed.py`.
+    Results are printed and written as JSON, so that they can be compared between revisions.
+'''
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import requests
+
+class Target(NamedTuple):
+    group: int
+    user: str
+
+class Endpoint(NamedTuple):
+    name: str
+    weight: int
+    write: bool
+    request: Callable[[Target, random.Random], Tuple[str, str, Optional[Dict[str, Any]]]] # (method, path, json body)
+
+# words of the seeded operation names and messages
+search_words = ('groceries', 'rent', 'taxi', 'dinner', 'money', 'paid', '"next week"', 'rent -due')
+
+endpoints = (
+    Endpoint('user_groups', 20, False, lambda t, _: ('GET', f'/user/{t.user}/groups/', None)),
+    Endpoint('group', 10, False, lambda t, _: ('GET', f'/group/{t.group}/', None)),
+    Endpoint('group_page', 20, False, lambda t, _: ('GET', f'/group/{t.group}/page?user={t.user}', None)),
+    Endpoint('operations', 12, False, lambda t, _: ('GET', f'/group/{t.group}/operations/?user={t.user}', None)),
+    Endpoint('chat', 12, False, lambda t, _: ('GET', f'/group/{t.group}/chat/?user={t.user}', None)),
+    Endpoint('stats', 6, False, lambda t, _: ('GET', f'/group/{t.group}/stats?user={t.user}&by=user,type', None)),
+    Endpoint('search', 4, False, lambda t, rnd: ('GET', f'/group/{t.group}/search?user={t.user}&q={rnd.choice(search_words)}', None)),
+    Endpoint('create_operation', 12, True, lambda t, rnd: ('POST', f'/group/{t.group}/operation/', {
+        'user': t.user, 'type': rnd.choice(('income', 'spending')), 'amount': round(rnd.uniform(1, 500), 2),
+        'name': 'load test', 'description': ''})),
+    Endpoint('send_to_chat', 8, True, lambda t, _: ('POST', f'/group/{t.group}/chat/', {'user': t.user, 'message': 'load test'})),
+)
+
+def load_targets(manifest: str) -> List[Target]:
+    with open(manifest) as file:
+        groups = json.load(file)['groups']
+    return [Target(group['id'], user) for group in groups for user in group['members']]
+
+def percentile(values: List[float], p: float) -> float:
+    '''Returns p-th percentile of the sorted values (nearest-rank).'''
+    if len(values) == 0:
+        return 0.0
+    return values[min(max(int(round(len(values) * p / 100 + 0.5)) - 1, 0), len(values) - 1)]
+
+def summary(latencies: List[float], errors: int, duration: float) -> Dict[str, Any]:
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+def run_level(api_addr: str, mix: List[Endpoint], targets: List[Target], concurrency: int, duration: float,
+        warmup: float = 0.0, seed: int = 0) -> Dict[str, Any]:
+    '''Sends requests of the weighted endpoints mix from `concurrency` threads, each one waiting for the response
+        before sending the next request, for `duration` seconds after `warmup` seconds which are not measured.
+    '''
+    latencies: Dict[str, List[float]] = {endpoint.name: [] for endpoint in mix}
+    errors: Dict[str, int] = {endpoint.name: 0 for endpoint in mix}
+    lock = threading.Lock()
+    weights = [endpoint.weight for endpoint in mix]
+    measure_from = time.monotonic() + warmup
+    deadline = measure_from + duration
+    def worker(n: int) -> None:
+        rnd = random.Random(seed * 100003 + n)
+        session = requests.Session()
+        own_latencies: Dict[str, List[float]] = {endpoint.name: [] for endpoint in mix}
+        own_errors: Dict[str, int] = {endpoint.name: 0 for endpoint in mix}
+        try:
+            while True:
+                endpoint = rnd.choices(mix, weights)[0]
+                method, path, body = endpoint.request(rnd.choice(targets), rnd)
+                now = time.monotonic()
+                if now > deadline:
+                    break
+                start = time.perf_counter()
+                try:
+                    response = session.request(method, api_addr + path, json=body, timeout=30)
+                    response.content
+                    failed = response.status_code >= 400
+                except requests.RequestException:
+                    failed = True
+                if now >= measure_from:
+                    own_latencies[endpoint.name].append(time.perf_counter() - start)
+                    own_errors[endpoint.name] += failed
+        finally:
+            session.close()
+            with lock:
+                for name in latencies:
+                    latencies[name].extend(own_latencies[name])
+                    errors[name] += own_errors[name]
+    with ThreadPoolExecutor(concurrency, thread_name_prefix='load') as executor:
+        for future in [executor.submit(worker, n) for n in range(concurrency)]:
+            future.result()
+    result = {'concurrency': concurrency, 'duration': duration,
+            **summary([latency for values in latencies.values() for latency in values], sum(errors.values()), duration)}
+    result['endpoints'] = {name: summary(latencies[name], errors[name], duration) for name in latencies if len(latencies[name]) != 0}
+    return result
+
+def print_level(label: str, result: Dict[str, Any]) -> None:
+    print(f'{label} x{result["concurrency"]}: {result["rps"]} req/s, p50 {result["p50_ms"]} ms, p95 {result["p95_ms"]} ms,'
+            f' p99 {result["p99_ms"]} ms, errors {result["errors"]}')
+    for name, endpoint in result['endpoints'].items():
+        print(f'    {name:<18} {endpoint["rps"]:>8} req/s  p50 {endpoint["p50_ms"]:>8} ms  p95 {endpoint["p95_ms"]:>8} ms'
+                f'  p99 {endpoint["p99_ms"]:>8} ms  errors {endpoint["errors"]}')
+
+def revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-tests finances app API server with a mix of its routes')
+    parser.add_argument('-a', '--api_addr', action='store', dest='api_addr',
+                        help=f'finances app API server address', type=str, default='http://localhost:3001')
+    parser.add_argument('-f', '--manifest', action='store', dest='manifest',
+                        help=f'manifest of the seeded groups written by seed.py', type=str, default='seed.json')
+    parser.add_argument('-c', '--concurrency', action='store', dest='concurrency',
+                        help=f'comma-separated numbers of concurrent clients', type=str, default='1,8,32,128')
+    parser.add_argument('-d', '--duration', action='store', dest='duration',
+                        help=f'seconds of measured load at each concurrency level', type=float, default=20.0)
+    parser.add_argument('-w', '--warmup', action='store', dest='warmup',
+                        help=f'seconds of load before measuring at each concurrency level', type=float, default=3.0)
+    parser.add_argument('-r', '--read_only', action='store_true', dest='read_only',
+                        help=f'do not create operations and chat messages')
+    parser.add_argument('-e', '--endpoints', action='store', dest='endpoints',
+                        help=f'comma-separated names of endpoints to load, all of the mix by default', type=str, default=None)
+    parser.add_argument('-s', '--seed', action='store', dest='seed',
+                        help=f'random seed of the requests sequence', type=int, default=2020)
+    parser.add_argument('-l', '--label', action='store', dest='label',
+                        help=f'label of the run stored in results, e.g. server mode or configuration', type=str, default=None)
+    parser.add_argument('-o', '--output', action='store', dest='output',
+                        help=f'file to write JSON results to', type=str, default='load.json')
+    args = parser.parse_args()
+
+    mix = [endpoint for endpoint in endpoints if not (args.read_only and endpoint.write)
+            and (args.endpoints is None or endpoint.name in args.endpoints.split(','))]
+    if len(mix) == 0:
+        parser.error(f'no endpoints to load, known are: {", ".join(endpoint.name for endpoint in endpoints)}')
+    targets = load_targets(args.manifest)
+    results = {
+        'label': args.label,
+        'revision': revision(),
+        'api_addr': args.api_addr,
+        'started': datetime.datetime.now().isoformat(' ', 'seconds'),
+        'mix': {endpoint.name: endpoint.weight for endpoint in mix},
+        'levels': []
+    }
+    for concurrency in map(int, args.concurrency.split(',')):
+        result = run_level(args.api_addr.rstrip('/'), mix, targets, concurrency, args.duration, args.warmup, args.seed)
+        print_level(args.label or args.api_addr, result)
+        results['levels'].append(result)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results are written to {args.output}')
@@ -0,0 +1,132 @@
+'''Measures logins and their effect on other requests: while a number of threads log seeded users in (the first login
+    of a seeded user replaces the plain text password with a hash), other threads read groups with the issued tokens.
+
+Read latencies are reported both for the idle server and during the logins, so that password hashing slowing down
+    the request threads would show up as the difference. Cost of token verification is measured in process.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from load import Target, load_targets, percentile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+from auth import TokenSigner
+
+def summary(latencies: List[float]) -> Dict[str, Any]:
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2)
+    }
+
+def login(session: requests.Session, api_addr: str, user: str, password: str) -> Optional[str]:
+    response = session.post(f'{api_addr}/login/', json={'username': user, 'password': password}, timeout=30)
+    return response.json().get('token') if response.status_code == 200 else None
+
+def read(api_addr: str, targets: List[Target], tokens: Dict[str, str], readers: int, stop: threading.Event,
+        seed: int, duration: Optional[float] = None) -> List[float]:
+    '''Reads groups of the targets from `readers` threads until `stop` is set or for `duration` seconds.'''
+    latencies: List[float] = []
+    lock = threading.Lock()
+    until = time.monotonic() + duration if duration is not None else None
+    def reader(n: int) -> None:
+        rnd = random.Random(seed * 100003 + n)
+        own = []
+        with requests.Session() as session:
+            while not stop.is_set() and (until is None or time.monotonic() < until):
+                target = rnd.choice(targets)
+                start = time.perf_counter()
+                session.get(f'{api_addr}/group/{target.group}/operations/', params={'user': target.user, 'limit': 10},
+                        headers={'Authorization': f'Bearer {tokens[target.user]}'}, timeout=30)
+                own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+    with ThreadPoolExecutor(readers, thread_name_prefix='reader') as executor:
+        for future in [executor.submit(reader, n) for n in range(readers)]:
+            future.result()
+    return latencies
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures logins of the finances app and reads running meanwhile')
+    parser.add_argument('-a', '--api_addr', action='store', dest='api_addr',
+                        help=f'finances app API server address', type=str, default='http://localhost:3001')
+    parser.add_argument('-f', '--manifest', action='store', dest='manifest',
+                        help=f'seeded groups and their members, written by seed.py', type=str, default='seed.json')
+    parser.add_argument('-p', '--password', action='store', dest='password',
+                        help=f'password of the seeded users', type=str, default='password')
+    parser.add_argument('-l', '--logins', action='store', dest='logins',
+                        help=f'number of logins', type=int, default=500)
+    parser.add_argument('-c', '--login_concurrency', action='store', dest='login_concurrency',
+                        help=f'number of threads logging in', type=int, default=16)
+    parser.add_argument('-r', '--readers', action='store', dest='readers',
+                        help=f'number of threads reading groups', type=int, default=8)
+    parser.add_argument('-t', '--baseline', action='store', dest='baseline',
+                        help=f'seconds reads are measured for before the logins', type=float, default=5.0)
+    parser.add_argument('-s', '--seed', action='store', dest='seed',
+                        help=f'random seed of the users choice', type=int, default=2020)
+    parser.add_argument('-o', '--output', action='store', dest='output',
+                        help=f'file to write results to as JSON', type=str, default='logins.json')
+    args = parser.parse_args()
+
+    targets = load_targets(args.manifest)
+    if len(targets) == 0:
+        parser.error(f'there are no targets in {args.manifest}')
+    rnd = random.Random(args.seed)
+    users = sorted({target.user for target in targets})
+    tokens: Dict[str, str] = {}
+    with requests.Session() as session:
+        for user in users:
+            token = login(session, args.api_addr, user, args.password)
+            if token is None:
+                parser.error(f'user {user} can not log in with password {args.password}')
+            tokens[user] = token
+
+    stop = threading.Event()
+    baseline = read(args.api_addr, targets, tokens, args.readers, stop, args.seed, args.baseline)
+
+    login_latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    lock = threading.Lock()
+    def log_in(user: str) -> None:
+        with requests.Session() as session:
+            start = time.perf_counter()
+            response = session.post(f'{args.api_addr}/login/', json={'username': user, 'password': args.password}, timeout=30)
+            elapsed = time.perf_counter() - start
+        with lock:
+            login_latencies.append(elapsed)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    reads = ThreadPoolExecutor(1).submit(read, args.api_addr, targets, tokens, args.readers, stop, args.seed + 1)
+    started = time.monotonic()
+    with ThreadPoolExecutor(args.login_concurrency, thread_name_prefix='login') as executor:
+        for future in [executor.submit(log_in, rnd.choice(users)) for _ in range(args.logins)]:
+            future.result()
+    duration = time.monotonic() - started
+    stop.set()
+    during = reads.result()
+
+    signer = TokenSigner(os.urandom(32))
+    token = signer.issue(1, 'bench1')
+    verify_us = timeit.timeit(lambda: signer.verify(token), number=100000) / 100000 * 1e6
+    results = {
+        'logins': {**summary(login_latencies), 'per_second': round(len(login_latencies) / duration, 1),
+                'statuses': statuses},
+        'reads_idle': summary(baseline),
+        'reads_during_logins': summary(during),
+        'token_verify_us': round(verify_us, 2)
+    }
+    print(json.dumps(results, indent=2))
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results are written to {args.output}')
@@ -0,0 +1,140 @@
+'''Compares plain and prepared (PREPARE / EXECUTE) execution of the hot statements of user groups and chat routes.
+
+Every statement is run on the groups and members of the seed manifest, once with parameters sent in the query text
+    and once as EXECUTE of the statement prepared on the connection. Client latency is measured around the statement
+    and server planning and execution times are taken from EXPLAIN ANALYZE of the same statements.
+'''
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import psycopg2, psycopg2.extensions
+
+from load import Target, load_targets, percentile, revision
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+from lookups import Lookups
+from statements import PreparingConnection, registry
+
+class Case(NamedTuple):
+    statement: str
+    params: Callable[[Target], Optional[tuple]] # None when the statement cannot be run for the target
+
+def make_cases(conn: psycopg2.extensions.connection, targets: List[Target], limit: int) -> List[Case]:
+    member_status_ids = list(Lookups.load(conn).member_status_ids)
+    with conn.cursor() as cur:
+        cur.execute('SELECT username, id FROM users WHERE username = ANY(%s)', (list({target.user for target in targets}),))
+        user_ids = dict(cur.fetchall())
+        # cursor of the second page of each group's chat
+        cur.execute('SELECT g.group_id, m.time, m.id FROM unnest(%s) AS g(group_id) JOIN LATERAL'
+                ' (SELECT time, id FROM messages WHERE group_id = g.group_id ORDER BY time DESC, id DESC OFFSET %s LIMIT 1)'
+                '   AS m ON true', (list({target.group for target in targets}), limit - 1))
+        chat_keys = {group_id: (key_time, key_id) for group_id, key_time, key_id in cur.fetchall()}
+    return [
+        Case('user_groups_version_by_name', lambda target: (target.user,)),
+        Case('user_groups_by_name', lambda target: (member_status_ids, target.user)),
+        Case('user_groups_by_id', lambda target: (member_status_ids, user_ids[target.user])),
+        Case('messages_first', lambda target: (target.group, limit + 1)),
+        Case('messages_after', lambda target: (target.group, chat_keys[target.group][0]) + chat_keys[target.group] + (limit + 1,)
+                if target.group in chat_keys else None)
+    ]
+
+def run(cur: psycopg2.extensions.cursor, name: str, params: tuple) -> None:
+    registry.execute(cur, name, params)
+    cur.fetchall()
+
+def explain(cur: psycopg2.extensions.cursor, name: str, params: tuple) -> Tuple[float, float]:
+    '''Returns planning and execution time (ms) of the statement, prepared ones are explained as EXECUTE.'''
+    statement = registry[name]
+    if registry.enabled:
+        cur.execute(f'EXPLAIN (ANALYZE, FORMAT JSON) {statement.execute_sql}', statement.args(params))
+    else:
+        cur.execute(f'EXPLAIN (ANALYZE, FORMAT JSON) {statement.sql}', params)
+    plan = cur.fetchone()[0][0]
+    return plan.get('Planning Time', 0.0), plan['Execution Time']
+
+def measure(conn: psycopg2.extensions.connection, prepared: bool, case: Case, samples: List[tuple],
+        explains: int) -> Dict[str, Any]:
+    registry.enabled = prepared
+    with conn.cursor() as cur:
+        run(cur, case.statement, samples[0]) # PREPAREs the statement before measuring
+        latencies = []
+        for params in samples:
+            start = time.perf_counter()
+            run(cur, case.statement, params)
+            latencies.append(time.perf_counter() - start)
+        plans = [explain(cur, case.statement, params) for params in samples[:explains]]
+    latencies.sort()
+    return {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'planning_ms': round(sum(plan[0] for plan in plans) / len(plans), 3),
+        'execution_ms': round(sum(plan[1] for plan in plans) / len(plans), 3)
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares plain and prepared statements of the finances app hot paths')
+    parser.add_argument('-H', '--db_addr', action='store', dest='db_addr',
+                        help=f'postgres host address', type=str, default='localhost')
+    parser.add_argument('-P', '--db_port', action='store', dest='db_port',
+                        help=f'postgres port number', type=int, default=5432)
+    parser.add_argument('-d', '--db_name', action='store', dest='db_name',
+                        help=f'postgres database name', type=str, default='finances')
+    parser.add_argument('-U', '--db_user', action='store', dest='db_user',
+                        help=f'postgres user name', type=str, default='postgres')
+    parser.add_argument('-W', '--db_pass', action='store', dest='db_pass',
+                        help=f'database user password', type=str, default='postgres')
+    parser.add_argument('-f', '--manifest', action='store', dest='manifest',
+                        help=f'seeded groups and their members, written by seed.py', type=str, default='seed.json')
+    parser.add_argument('-n', '--iterations', action='store', dest='iterations',
+                        help=f'number of executions of each statement', type=int, default=2000)
+    parser.add_argument('-e', '--explains', action='store', dest='explains',
+                        help=f'number of executions of each statement explained with EXPLAIN ANALYZE', type=int, default=100)
+    parser.add_argument('-p', '--page_size', action='store', dest='page_size',
+                        help=f'chat page size', type=int, default=50)
+    parser.add_argument('-s', '--seed', action='store', dest='seed',
+                        help=f'random seed of the targets choice', type=int, default=2020)
+    parser.add_argument('-o', '--output', action='store', dest='output',
+                        help=f'file to write results to as JSON', type=str, default='prepared.json')
+    args = parser.parse_args()
+
+    targets = load_targets(args.manifest)
+    if len(targets) == 0:
+        parser.error(f'there are no targets in {args.manifest}')
+    conn_string = f'host={args.db_addr} port={args.db_port} dbname={args.db_name} user={args.db_user} password={args.db_pass}'
+    plain_conn = psycopg2.connect(conn_string)
+    prepared_conn = psycopg2.connect(conn_string, connection_factory=PreparingConnection)
+    plain_conn.autocommit = prepared_conn.autocommit = True
+    results = {
+        'revision': revision(),
+        'started': datetime.datetime.now().isoformat(' ', 'seconds'),
+        'iterations': args.iterations,
+        'statements': {}
+    }
+    try:
+        rnd = random.Random(args.seed)
+        for case in make_cases(plain_conn, targets, args.page_size):
+            samples = [params for params in (case.params(rnd.choice(targets)) for _ in range(args.iterations))
+                    if params is not None]
+            if len(samples) == 0:
+                print(f'{case.statement}: no data in the seeded groups, skipped')
+                continue
+            result = results['statements'][case.statement] = {
+                'plain': measure(plain_conn, False, case, samples, args.explains),
+                'prepared': measure(prepared_conn, True, case, samples, args.explains)
+            }
+            for mode in ('plain', 'prepared'):
+                print(f'{case.statement:<28} {mode:<9} p50 {result[mode]["p50_ms"]:8.3f} ms  p95 {result[mode]["p95_ms"]:8.3f} ms'
+                        f'  planning {result[mode]["planning_ms"]:7.3f} ms  execution {result[mode]["execution_ms"]:7.3f} ms')
+    finally:
+        plain_conn.close()
+        prepared_conn.close()
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results are written to {args.output}')
@@ -0,0 +1,143 @@
+'''Checks that chat and operations pages read only the partitions of the months they return.
+
+Pages of the seeded groups (the first one, the one after a cursor and the one before it) are explained with
+    EXPLAIN ANALYZE and the partitions the plan actually scanned are compared with the months of the page: newest-first
+    pages may read only partitions newer than their oldest row and not newer than the cursor, oldest-first ones
+    only partitions older than their newest row and not older than the cursor.
+'''
+import argparse
+import datetime
+import json
+import os
+import sys
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import psycopg2, psycopg2.extensions
+
+from load import load_targets, revision
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+import queries
+from pagination import keyset_params, keyset_sql
+from partitions import add_months, partition_month
+from serialization import encode_cursor
+
+# (query, key columns, positions of the (time, id) key in the row)
+pages = {
+    'operations': (queries.operations, queries.operations_key, (6, 0)),
+    'messages': (queries.messages, queries.messages_key, (4, 0))
+}
+
+Bounds = Tuple[Optional[datetime.datetime], Optional[datetime.datetime]] # None is unbounded
+
+def partition_bounds(cur: psycopg2.extensions.cursor, table: str) -> Dict[str, Bounds]:
+    cur.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass',
+            (table,))
+    names = [name for name, in cur.fetchall()]
+    months = sorted(partition_month(name) for name in names if name not in (f'{table}_history', f'{table}_future'))
+    as_time = lambda month: datetime.datetime.combine(month, datetime.time())
+    bounds: Dict[str, Bounds] = {f'{table}_{month:%Y_%m}': (as_time(month), as_time(add_months(month, 1))) for month in months}
+    if len(months) != 0:
+        bounds[f'{table}_history'] = (None, as_time(months[0]))
+        bounds[f'{table}_future'] = (as_time(add_months(months[-1], 1)), None)
+    return bounds
+
+def scans(plan: Dict[str, Any]) -> Iterator[Tuple[str, int]]:
+    '''Yields (relation, loops) of all the scans of the plan.'''
+    if 'Relation Name' in plan:
+        yield plan['Relation Name'], plan.get('Actual Loops', 0)
+    for child in plan.get('Plans', ()):
+        yield from scans(child)
+
+def overlaps(bounds: Bounds, since: Optional[datetime.datetime], until: Optional[datetime.datetime]) -> bool:
+    '''Returns if partition bounds overlap [since, until] range.'''
+    lower, upper = bounds
+    return (since is None or upper is None or upper > since) and (until is None or lower is None or lower <= until)
+
+def check(cur: psycopg2.extensions.cursor, table: str, bounds: Dict[str, Bounds], group: int, direction: str,
+        key: Optional[Tuple[datetime.datetime, int]], limit: int) -> Dict[str, Any]:
+    query, key_columns, (time_index, _) = pages[table]
+    cursor = encode_cursor(*key) if key is not None else None
+    sql = keyset_sql(query, key_columns, direction)
+    params = keyset_params((group,), cursor if direction == 'after' else None, cursor if direction == 'before' else None, limit)
+    cur.execute(sql, params)
+    times = [row[time_index] for row in cur.fetchall()]
+    cur.execute(f'EXPLAIN (ANALYZE, FORMAT JSON) {sql}', params)
+    plan = cur.fetchone()[0][0]['Plan']
+    planned = {name: loops for name, loops in scans(plan) if name in bounds}
+    executed = sorted(name for name, loops in planned.items() if loops > 0)
+    filled = len(times) > limit
+    if direction == 'before':
+        # oldest first from the cursor, up to the newest row if the page is full
+        since, until = key[0], max(times) if filled else None
+    else:
+        since, until = min(times) if filled else None, key[0] if key is not None else None
+    unexpected = [name for name in executed if not overlaps(bounds[name], since, until)]
+    return {
+        'partitions': len(bounds),
+        'planned': len(planned),
+        'executed': executed,
+        'unexpected': unexpected
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks partition pruning of the finances app chat and operations pages')
+    parser.add_argument('-H', '--db_addr', action='store', dest='db_addr',
+                        help=f'postgres host address', type=str, default='localhost')
+    parser.add_argument('-P', '--db_port', action='store', dest='db_port',
+                        help=f'postgres port number', type=int, default=5432)
+    parser.add_argument('-d', '--db_name', action='store', dest='db_name',
+                        help=f'postgres database name', type=str, default='finances')
+    parser.add_argument('-U', '--db_user', action='store', dest='db_user',
+                        help=f'postgres user name', type=str, default='postgres')
+    parser.add_argument('-W', '--db_pass', action='store', dest='db_pass',
+                        help=f'database user password', type=str, default='postgres')
+    parser.add_argument('-f', '--manifest', action='store', dest='manifest',
+                        help=f'seeded groups and their members, written by seed.py', type=str, default='seed.json')
+    parser.add_argument('-n', '--groups', action='store', dest='groups',
+                        help=f'number of seeded groups to check', type=int, default=10)
+    parser.add_argument('-p', '--page_size', action='store', dest='page_size',
+                        help=f'page size', type=int, default=50)
+    parser.add_argument('-o', '--output', action='store', dest='output',
+                        help=f'file to write results to as JSON', type=str, default='pruning.json')
+    args = parser.parse_args()
+
+    groups = sorted({target.group for target in load_targets(args.manifest)})[:args.groups]
+    if len(groups) == 0:
+        parser.error(f'there are no groups in {args.manifest}')
+    conn = psycopg2.connect(f'host={args.db_addr} port={args.db_port} dbname={args.db_name}'
+            f' user={args.db_user} password={args.db_pass}')
+    conn.autocommit = True
+    results: Dict[str, Any] = {
+        'revision': revision(),
+        'started': datetime.datetime.now().isoformat(' ', 'seconds'),
+        'checks': []
+    }
+    ok = True
+    try:
+        with conn.cursor() as cur:
+            for table, (query, key_columns, (time_index, id_index)) in pages.items():
+                bounds = partition_bounds(cur, table)
+                if len(bounds) == 0:
+                    parser.error(f'{table} is not partitioned, apply the database migrations first')
+                for group in groups:
+                    # key of the last row of the first page is the cursor of the second one
+                    cur.execute(keyset_sql(query, key_columns, 'first') + ' OFFSET %s', (group, 1, args.page_size - 1))
+                    row = cur.fetchone()
+                    key = (row[time_index], row[id_index]) if row is not None else None
+                    for direction in ('first', 'after', 'before'):
+                        if direction != 'first' and key is None:
+                            continue
+                        result = check(cur, table, bounds, group, direction, key if direction != 'first' else None,
+                                args.page_size)
+                        results['checks'].append({'table': table, 'group': group, 'direction': direction, **result})
+                        ok = ok and len(result['unexpected']) == 0
+                        print(f'{table:<10} group {group:<8} {direction:<6} partitions {result["partitions"]:3}'
+                                f'  planned {result["planned"]:3}  executed {len(result["executed"]):3}'
+                                + (f'  UNEXPECTED {", ".join(result["unexpected"])}' if len(result['unexpected']) != 0 else ''))
+    finally:
+        conn.close()
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results are written to {args.output}')
+    sys.exit(0 if ok else 1)
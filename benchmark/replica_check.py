@@ -0,0 +1,76 @@
+'''Checks read replica routing of the backend started with `--db_replica`: every member who creates an operation must
+    see it in the operations read right after that (read-your-writes, sending back `X-Last-Write` header of the write
+    as the frontend does), while reads of other users are served by replicas.
+
+Routing counters are taken from `GET /api/cache/` before and after the check, stop a replica during the check to see
+    its reads fall back to the primary.
+'''
+import argparse
+import json
+import random
+import sys
+from typing import Any, Dict
+
+import requests
+
+from load import load_targets
+
+def replica_stats(session: requests.Session, api_addr: str) -> Dict[str, Any]:
+    response = session.get(f'{api_addr}/api/cache/', timeout=30)
+    response.raise_for_status()
+    return response.json()['replicas']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks read-your-writes and replica routing of the finances app API server')
+    parser.add_argument('-a', '--api_addr', action='store', dest='api_addr',
+                        help=f'finances app API server address', type=str, default='http://localhost:3001')
+    parser.add_argument('-f', '--manifest', action='store', dest='manifest',
+                        help=f'seeded groups and their members, written by seed.py', type=str, default='seed.json')
+    parser.add_argument('-n', '--writes', action='store', dest='writes',
+                        help=f'number of operations created and read back', type=int, default=200)
+    parser.add_argument('-r', '--reads', action='store', dest='reads',
+                        help=f'number of reads of users who did not write', type=int, default=1000)
+    parser.add_argument('-s', '--seed', action='store', dest='seed',
+                        help=f'random seed of the targets choice', type=int, default=2020)
+    args = parser.parse_args()
+
+    targets = load_targets(args.manifest)
+    if len(targets) == 0:
+        parser.error(f'there are no targets in {args.manifest}')
+    rnd = random.Random(args.seed)
+    session = requests.Session()
+    before = replica_stats(session, args.api_addr)
+    if before is None:
+        sys.exit(f'API server at {args.api_addr} is not started with replicas')
+
+    stale_reads = 0
+    writers = set()
+    for i in range(args.writes):
+        target = rnd.choice(targets)
+        writers.add(target.user)
+        name = f'replica check {args.seed}-{i}'
+        response = session.post(f'{args.api_addr}/group/{target.group}/operation/', json={'user': target.user,
+                'type': 'income', 'amount': 1, 'name': name, 'description': ''}, timeout=30)
+        response.raise_for_status()
+        response = session.get(f'{args.api_addr}/group/{target.group}/operations/',
+                params={'user': target.user, 'limit': 20}, headers={'X-Last-Write': response.headers.get('X-Last-Write')},
+                timeout=30)
+        response.raise_for_status()
+        if all(operation['name'] != name for operation in response.json()['operations']):
+            stale_reads += 1
+    readers = [target for target in targets if target.user not in writers] or targets
+    for _ in range(args.reads):
+        session.get(f'{args.api_addr}/user/{rnd.choice(readers).user}/groups/', timeout=30).raise_for_status()
+    after = replica_stats(session, args.api_addr)
+
+    result = {
+        'stale_reads': stale_reads,
+        **{key: after[key] - before[key] for key in ('replica_reads', 'fallback_reads', 'sticky_reads')},
+        'replicas': after['replicas']
+    }
+    print(json.dumps(result, indent=2))
+    if stale_reads != 0:
+        print(f'{stale_reads} of {args.writes} operations were not read back by their authors')
+    if result['replica_reads'] == 0:
+        print('no reads were served by replicas')
+    sys.exit(0 if stale_reads == 0 and result['replica_reads'] != 0 else 1)
@@ -0,0 +1,190 @@
+'''Fills the database with synthetic users, groups, memberships, operations and messages for benchmarks.
+
+Rows are generated lazily and loaded with COPY in batches, so millions of operations do not need to fit in memory.
+    Seeded groups with their members are written to a manifest file which is used by the load driver.
+'''
+import argparse
+import csv
+import datetime
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend'))
+import partitions
+import queries
+import routes
+import schema
+from lookups import Lookups
+
+operation_names = ('groceries', 'rent', 'salary', 'taxi', 'cafe', 'internet', 'gift', 'tickets', 'medicine', 'clothes')
+message_words = ('who', 'paid', 'for', 'the', 'dinner', 'yesterday', 'I', 'will', 'send', 'money', 'tomorrow', 'ok',
+        'thanks', 'rent', 'is', 'due', 'next', 'week', 'see', 'you')
+
+def copy_rows(cur: psycopg2.extensions.cursor, table: str, columns: Sequence[str], rows: Iterable[Sequence],
+        batch_size: int) -> int:
+    '''Loads rows to the table with COPY in batches of `batch_size` rows, returns number of rows loaded.'''
+    count = 0
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if len(batch) == 0:
+            return count
+        buffer = io.StringIO()
+        csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(batch) # so that empty strings are not NULL
+        buffer.seek(0)
+        cur.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+        count += len(batch)
+
+def next_id(cur: psycopg2.extensions.cursor, table: str) -> int:
+    cur.execute(f'SELECT coalesce(max(id), 0) + 1 FROM {table}')
+    return cur.fetchone()[0]
+
+def random_time(rnd: random.Random, since: datetime.datetime, days: int) -> datetime.datetime:
+    return since + datetime.timedelta(seconds=rnd.randrange(days * 24 * 3600))
+
+def seed(conn: psycopg2.extensions.connection, users: int, groups: int, members: int, operations: int, messages: int,
+        days: int, batch_size: int, rnd: random.Random) -> List[Dict]:
+    '''Generates and loads the data in one transaction, returns seeded groups with their active members.'''
+    lookups = Lookups.load(conn)
+    statuses = lookups.statuses
+    income, spending = lookups.operation_types['income'], lookups.operation_types['spending']
+    since = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(days=days)
+    manifest = []
+    with conn.cursor() as cur:
+        cur.execute('LOCK TABLE users, groups, users_groups, operations, messages IN EXCLUSIVE MODE')
+        first_user, first_group, first_membership = next_id(cur, 'users'), next_id(cur, 'groups'), next_id(cur, 'users_groups')
+        first_operation, first_message = next_id(cur, 'operations'), next_id(cur, 'messages')
+        user_ids = range(first_user, first_user + users)
+
+        start = time.monotonic()
+        copy_rows(cur, 'users', ('id', 'username', 'password', 'registration_date'),
+                ((id, f'bench{id}', 'password', random_time(rnd, since - datetime.timedelta(days=365), 365)) for id in user_ids),
+                batch_size)
+        print(f'users: {users} ({time.monotonic() - start:.1f}s)')
+
+        # memberships of each group: (users_groups id, user id, status id), the first one is the creator
+        group_members: Dict[int, List[Tuple[int, int, int]]] = {}
+        membership_id = first_membership
+        for group_id in range(first_group, first_group + groups):
+            group_users = rnd.sample(user_ids, min(members, users))
+            group_members[group_id] = []
+            for i, user_id in enumerate(group_users):
+                status = 'creator' if i == 0 else rnd.choices(('user', 'admin', 'pending'), (80, 10, 10))[0]
+                group_members[group_id].append((membership_id, user_id, statuses[status]))
+                membership_id += 1
+            manifest.append({'id': group_id, 'members': [f'bench{user_id}' for _, user_id, status_id in group_members[group_id]
+                    if status_id != statuses['pending']]})
+
+        start = time.monotonic()
+        copy_rows(cur, 'groups', ('id', 'name', 'creator_id'),
+                ((group_id, f'bench group {group_id}', group[0][1]) for group_id, group in group_members.items()), batch_size)
+        copy_rows(cur, 'users_groups', ('id', 'user_id', 'group_id', 'status_id'),
+                ((id, user_id, group_id, status_id) for group_id, group in group_members.items()
+                        for id, user_id, status_id in group), batch_size)
+        print(f'groups: {groups}, memberships: {membership_id - first_membership} ({time.monotonic() - start:.1f}s)')
+
+        def active(group_id: int) -> List[Tuple[int, int, int]]:
+            return [member for member in group_members[group_id] if member[2] != statuses['pending']]
+
+        def generate_operations() -> Iterator[tuple]:
+            id = first_operation
+            for group_id in group_members:
+                group_active = active(group_id)
+                for _ in range(operations):
+                    type_id = income if rnd.random() < 0.4 else spending
+                    yield (id, rnd.choice(group_active)[1], group_id, type_id, round(rnd.uniform(1, 500), 2),
+                            rnd.choice(operation_names), '' if rnd.random() < 0.5 else 'synthetic operation',
+                            random_time(rnd, since, days))
+                    id += 1
+        start = time.monotonic()
+        count = copy_rows(cur, 'operations', ('id', 'user_id', 'group_id', 'type_id', 'amount', 'name', 'description', 'date'),
+                generate_operations(), batch_size)
+        print(f'operations: {count} ({time.monotonic() - start:.1f}s)')
+
+        def generate_messages() -> Iterator[tuple]:
+            id = first_message
+            for group_id in group_members:
+                group_active = active(group_id)
+                for _ in range(messages):
+                    yield (id, rnd.choice(group_active)[0], group_id, random_time(rnd, since, days),
+                            ' '.join(rnd.choices(message_words, k=rnd.randint(2, 12))))
+                    id += 1
+        start = time.monotonic()
+        count = copy_rows(cur, 'messages', ('id', 'user_group_id', 'group_id', 'time', 'message'), generate_messages(), batch_size)
+        print(f'messages: {count} ({time.monotonic() - start:.1f}s)')
+
+        start = time.monotonic()
+        for table in ('users', 'groups', 'users_groups', 'operations', 'messages'):
+            cur.execute(f'SELECT setval(pg_get_serial_sequence(\'{table}\', \'id\'), (SELECT max(id) FROM {table}))')
+        cur.execute('UPDATE groups g SET balance = o.balance FROM ('
+                '   SELECT group_id, sum(CASE WHEN type_id = %s THEN amount ELSE -amount END) AS balance FROM operations'
+                '       WHERE group_id >= %s GROUP BY group_id'
+                ') o WHERE g.id = o.group_id', (income, first_group))
+        cur.execute('INSERT INTO operation_stats (group_id, user_id, type_id, month, total, count)'
+                '   SELECT group_id, user_id, type_id, date_trunc(\'month\', date)::date, sum(amount), count(*) FROM operations'
+                '   WHERE group_id >= %s GROUP BY group_id, user_id, type_id, date_trunc(\'month\', date)', (first_group,))
+        cur.execute(queries.create_checkpoints, {'income': income, 'until': routes.checkpoint_month()})
+        cur.execute('ANALYZE')
+        print(f'balances, statistics, checkpoints and sequences ({time.monotonic() - start:.1f}s)')
+    conn.commit()
+    return manifest
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fills finances app database with synthetic data for benchmarks')
+    parser.add_argument('-H', '--db_addr', action='store', dest='db_addr',
+                        help=f'postgres host address', type=str, default='localhost')
+    parser.add_argument('-P', '--db_port', action='store', dest='db_port',
+                        help=f'postgres port number', type=int, default=5432)
+    parser.add_argument('-d', '--db_name', action='store', dest='db_name',
+                        help=f'postgres database name', type=str, default='finances')
+    parser.add_argument('-U', '--db_user', action='store', dest='db_user',
+                        help=f'postgres user name', type=str, default='postgres')
+    parser.add_argument('-W', '--db_pass', action='store', dest='db_pass',
+                        help=f'database user password', type=str, default='postgres')
+    parser.add_argument('-u', '--users', action='store', dest='users',
+                        help=f'number of users', type=int, default=1000)
+    parser.add_argument('-g', '--groups', action='store', dest='groups',
+                        help=f'number of groups', type=int, default=200)
+    parser.add_argument('-m', '--members', action='store', dest='members',
+                        help=f'number of members of each group (including creator)', type=int, default=8)
+    parser.add_argument('-o', '--operations', action='store', dest='operations',
+                        help=f'number of operations of each group', type=int, default=2000)
+    parser.add_argument('-c', '--messages', action='store', dest='messages',
+                        help=f'number of chat messages of each group', type=int, default=500)
+    parser.add_argument('-D', '--days', action='store', dest='days',
+                        help=f'operations and messages are spread over this number of last days', type=int, default=365)
+    parser.add_argument('-b', '--batch_size', action='store', dest='batch_size',
+                        help=f'number of rows sent with one COPY', type=int, default=50000)
+    parser.add_argument('-s', '--seed', action='store', dest='seed',
+                        help=f'random seed, so that the same data is generated every time', type=int, default=2020)
+    parser.add_argument('-f', '--manifest', action='store', dest='manifest',
+                        help=f'file to write seeded groups and their members to', type=str, default='seed.json')
+    args = parser.parse_args()
+
+    if args.members < 1 or args.members > args.users:
+        parser.error('members must be between 1 and the number of users')
+    conn = psycopg2.connect(f'host={args.db_addr} port={args.db_port} dbname={args.db_name}'
+            f' user={args.db_user} password={args.db_pass}')
+    try:
+        for migration in schema.migrate(conn):
+            print(f'Applied database migration {migration}')
+        # rows are spread over the month partitions instead of going to the history one
+        today = datetime.date.today()
+        created = partitions.create_partitions(conn, today - datetime.timedelta(days=args.days), today)
+        if len(created) != 0:
+            print(f'Created {len(created)} partitions')
+        groups = seed(conn, args.users, args.groups, args.members, args.operations, args.messages, args.days, args.batch_size,
+                random.Random(args.seed))
+    finally:
+        conn.close()
+    with open(args.manifest, 'w') as file:
+        json.dump({'groups': groups}, file)
+    print(f'Seeded groups are written to {args.manifest}')
@@ -0,0 +1,80 @@
+import requests
+import threading
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from typing import Callable, Optional, Tuple, Union
+from urllib3.util.retry import Retry
+
+class ApiClient:
+    '''Finances API client sharing keep-alive connections between requests.
+
+    Idempotent requests are retried on connection errors and 502-504 responses. Successful GET responses with ETag
+        are kept (up to `cache_size` of them) and revalidated with If-None-Match, so that unchanged data is not
+        generated and sent again. Requests carry `Authorization: Bearer` header with the session token returned
+        by `token` (if it returns one). `X-Last-Write` header of the responses to writes is passed to `wrote` and
+        the value returned by `last_write` is sent back with the next requests, so that the API server with read
+        replicas serves reads of the user who has just changed data by the primary.
+    '''
+    def __init__(self, api_addr: str, timeout: Union[float, Tuple[float, float]] = (3.05, 10), retries: int = 2,
+            pool_size: int = 20, cache_size: int = 1000,
+            token: Optional[Callable[[], Optional[str]]] = None, last_write: Optional[Callable[[], Optional[str]]] = None,
+            wrote: Optional[Callable[[str], None]] = None):
+        self.api_addr = api_addr.rstrip('/')
+        self.token = token
+        self.last_write = last_write
+        self.wrote = wrote
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=Retry(total=retries, backoff_factor=0.1,
+                status_forcelist=(502, 503, 504), allowed_methods=frozenset(('GET', 'PUT', 'DELETE', 'HEAD')), raise_on_status=False))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[str, requests.Response]' = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+
+    def request(self, method: str, path: str, token: Optional[str] = None, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        if token is None and self.token is not None:
+            token = self.token()
+        if token is not None:
+            kwargs['headers'] = {**(kwargs.get('headers') or {}), 'Authorization': f'Bearer {token}'}
+        last_write = self.last_write() if self.last_write is not None else None
+        if last_write is not None:
+            kwargs['headers'] = {**(kwargs.get('headers') or {}), 'X-Last-Write': last_write}
+        response = self.session.request(method, self.api_addr + path, **kwargs)
+        if self.wrote is not None and 'X-Last-Write' in response.headers:
+            self.wrote(response.headers['X-Last-Write'])
+        return response
+
+    def get(self, path: str, token: Optional[str] = None, **kwargs) -> requests.Response:
+        if self.cache_size <= 0 or len(kwargs) != 0:
+            return self.request('GET', path, token, **kwargs)
+        with self._cache_lock:
+            cached = self._cache.get(path)
+        response = self.request('GET', path, token,
+                headers={'If-None-Match': cached.headers['ETag']} if cached is not None else None)
+        with self._cache_lock:
+            if response.status_code == 304 and cached is not None:
+                self._cache.move_to_end(path)
+                self.cache_hits += 1
+                return cached
+            if response.status_code == 200 and 'ETag' in response.headers:
+                response.content # read the body, so that it could be used again
+                self._cache[path] = response
+                self._cache.move_to_end(path)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.pop(path, None)
+        return response
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request('PUT', path, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
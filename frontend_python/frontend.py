@@ -1,16 +1,33 @@
-from flask import Flask, request, redirect, Response, make_response, render_template, session
+from flask import Flask, request, redirect, Response, make_response, render_template, session, has_request_context
 import argparse
-import requests
 from typing import Optional
 import os
 import traceback, itertools
 
+from api_client import ApiClient
+
 _version = '2021-01-30'
 
+def session_token() -> Optional[str]:
+    '''Returns API token of the logged in user of the current request.'''
+    return session.get('token') if has_request_context() else None
+
+def session_last_write() -> Optional[str]:
+    '''Returns time of the last change of data by the user of the current request, as told by the API server.'''
+    return session.get('last_write') if has_request_context() else None
+
+def session_wrote(last_write: str) -> None:
+    if has_request_context():
+        session['last_write'] = last_write
+
 class Properties:
-    def __init__(self, api_addr):
+    def __init__(self, api_addr: str, api_timeout: float = 10.0, api_retries: int = 2, api_pool_size: int = 20,
+            api_cache_size: int = 1000):
         self.api_addr = api_addr
-    
+        self.api = ApiClient(api_addr, (min(api_timeout, 3.05), api_timeout), api_retries, api_pool_size,
+                cache_size=api_cache_size, token=session_token,
+                last_write=session_last_write, wrote=session_wrote)
+
 app = Flask(__name__)
 properties: Properties
 
@@ -19,7 +36,7 @@ must_login_error = '/?error=You must log in to see this page'
 @app.route('/', methods = ['GET'])
 def main_page() -> Response:
     if 'user' in session:
-        result = requests.get(properties.api_addr + f'/user/{session["user"]}/groups/')
+        result = properties.api.get(f'/user/{session["user"]}/groups/')
         j = result.json()
         return make_response(render_template('index_user.html', user=session['user'], groups=(j['groups'] if 'groups' in j else list()), error_message=request.args.get('error')))
     else:
@@ -43,9 +60,10 @@ def login() -> Response:
         return make_response(redirect('/login?error="username" or "pasword" is missing'))
     username = request.form.get('username')
     password = request.form.get('password')
-    result = requests.post(properties.api_addr + '/login/', json={'username': username, 'password': password})
+    result = properties.api.post('/login/', json={'username': username, 'password': password})
     if result.status_code == 200 and result.json()['result'] == 'ok':
         session['user'] = username
+        session['token'] = result.json().get('token')
         return make_response(redirect('/'))
     else:
         return make_response(redirect('/login?error=wrong login or password'))
@@ -59,7 +77,7 @@ def registration() -> Response:
     password2 = request.form.get('password2')
     if password1 != password2:
         return make_response(redirect('/registration?error=passwords do not match'))
-    result = requests.post(properties.api_addr + '/user/', json={'username': username, 'password': password1})
+    result = properties.api.post('/user/', json={'username': username, 'password': password1})
     j = result.json()
     if result.status_code == 200 and 'result' in j:
         return make_response(redirect('/'))
@@ -69,22 +87,23 @@ def registration() -> Response:
 @app.route('/logout/', methods = ['POST'])
 def logout() -> Response:
     del session['user']
+    session.pop('token', None)
+    session.pop('last_write', None)
     return make_response(redirect('/'))
 
 @app.route('/group/<int:group_id>/', methods = ['GET'])
 def group_page(group_id: int) -> Response:
     if not 'user' in session:
         return make_response(redirect(must_login_error))
-    result_group = requests.get(properties.api_addr + f'/group/{group_id}/?user={session["user"]}')
-    result_operations = requests.get(properties.api_addr + f'/group/{group_id}/operations/?user={session["user"]}')
-    result_chat = requests.get(properties.api_addr + f'/group/{group_id}/chat/?user={session["user"]}')
-    if result_group.status_code != 200 or result_operations.status_code != 200 or result_chat.status_code != 200:
+    result = properties.api.get(f'/group/{group_id}/page?user={session["user"]}')
+    if result.status_code != 200:
         return make_response(redirect('/'))
-    j_group, j_operations, j_chat = result_group.json()['group'], result_operations.json(), result_chat.json()
+    page = result.json()
+    j_group = page['group']
     users_statuses = dict(map(lambda x: (x['username'], x['status']), j_group['users']))
     return make_response(render_template('group.html', id = group_id, name = j_group['name'], user = session['user'],
             role = users_statuses[session['user']], balance = j_group['balance'],
-            operations = j_operations['operations'], chat = j_chat['messages']))
+            operations = page['operations'], chat = page['messages']))
 
 @app.route('/group/new/', methods = ['GET'])
 def create_group_page() -> Response:
@@ -98,7 +117,7 @@ def create_group() -> Response:
         return make_response(redirect(must_login_error))
     if not 'name' in request.form or request.form['name'] == '':
         return make_response(redirect('/group/new/?errror=You must fill group name'))
-    requests.post(properties.api_addr + '/group/', json={
+    properties.api.post('/group/', json={
         'user': session['user'],
         'name': request.form['name']
     })
@@ -117,7 +136,7 @@ def join_group() -> Response:
     if not 'id' in request.form:
         return make_response(redirect('/'))
     group_id = request.form['id']
-    res = requests.post(properties.api_addr + f'/group/{group_id}/join/?user={session["user"]}').json()
+    res = properties.api.post(f'/group/{group_id}/join/?user={session["user"]}').json()
     if not 'result' in res:
         return make_response(redirect('/group/join/?error=Something went wrong, try again'))
     if res['result'] != 'ok':
@@ -128,7 +147,7 @@ def join_group() -> Response:
 def group_manage_page(group_id: int) -> Response:
     if not 'user' in session:
         return make_response(redirect(must_login_error))
-    group = requests.get(properties.api_addr + f'/group/{group_id}/').json()['group']
+    group = properties.api.get(f'/group/{group_id}/?user={session["user"]}').json()['group']
     users_statuses_name = dict(map(lambda x: (x['username'], x['status']), group['users']))
     if users_statuses_name[session['user']] not in ('admin', 'creator'):
         return make_response(redirect(f'/group/{group_id}/'))
@@ -138,7 +157,7 @@ def group_manage_page(group_id: int) -> Response:
 def change_user_status(group_id: int, user_id: int) -> Response:
     if not 'user' in session:
         return make_response(redirect(must_login_error))
-    res = requests.get(properties.api_addr + f'/group/{group_id}/').json()['group']
+    res = properties.api.get(f'/group/{group_id}/?user={session["user"]}').json()['group']
     users_statuses_name = dict(map(lambda x: (x['username'], x['status']), res['users']))
     users_statuses_id = dict(map(lambda x: (x['id'], x['status']), res['users']))
     if users_statuses_name[session['user']] in ('admin', 'creator') and 'status' in request.args:
@@ -148,7 +167,7 @@ def change_user_status(group_id: int, user_id: int) -> Response:
         if role in ('admin', 'creator') and oldrole != 'creator' and \
                 oldrole in ('pending', 'blocked', 'user') and newrole in ('blocked', 'user') or \
                 (oldrole == 'admin' or newrole == 'admin') and role == 'creator':
-            requests.put(properties.api_addr + f'/group/{group_id}/status/{user_id}?status={newrole}&user={session["user"]}')
+            properties.api.put(f'/group/{group_id}/status/{user_id}/?status={newrole}&user={session["user"]}')
     return make_response(redirect(f'/group/{group_id}/manage'))
 
 @app.route('/group/<int:group_id>/operation/', methods = ['POST'])
@@ -157,7 +176,7 @@ def create_operation(group_id: int) -> Response:
         return make_response(redirect(must_login_error))
     if not ('amount' in request.form and 'type' in request.form and 'name' in request.form and 'description' in request.form):
         return make_response(redirect(f'/group/{group_id}/'))
-    requests.post(properties.api_addr + f'/group/{group_id}/operation/', json={'user': session['user'],
+    properties.api.post(f'/group/{group_id}/operation/', json={'user': session['user'],
             'amount': request.form['amount'], 'type': request.form['type'], 'name': request.form['name'], 'description': request.form['description']})
     return make_response(redirect(f'/group/{group_id}/'))
 
@@ -188,16 +207,45 @@ if __name__ == '__main__':
                         help=f'finances app frontend port', type=int, default=8080)
     parser.add_argument('-a', '--api_addr', action='store', dest='api_addr',
                         help=f'finances app API server address', type=str, default='http://127.0.0.1:3001')
+    parser.add_argument('-t', '--api_timeout', action='store', dest='api_timeout',
+                        help=f'seconds to wait for API server response', type=float, default=10.0)
+    parser.add_argument('-r', '--api_retries', action='store', dest='api_retries',
+                        help=f'number of retries of failed idempotent API requests', type=int, default=2)
+    parser.add_argument('-s', '--api_pool_size', action='store', dest='api_pool_size',
+                        help=f'number of keep-alive connections to API server', type=int, default=20)
+    parser.add_argument('-c', '--api_cache_size', action='store', dest='api_cache_size',
+                        help=f'number of API responses kept for revalidation with ETag, 0 to disable', type=int, default=1000)
+    parser.add_argument('-k', '--secret_key', action='store', dest='secret_key',
+                        help=f'key signing session cookies, random one (sessions are lost on restart) by default', type=str, default=None)
+    parser.add_argument('-w', '--workers', action='store', dest='workers',
+                        help=f'number of pre-forked worker processes, 0 to serve in one process', type=int, default=0)
+    parser.add_argument('--threads', action='store', dest='threads',
+                        help=f'number of request threads of each worker process', type=int, default=32)
+    parser.add_argument('--max_requests', action='store', dest='max_requests',
+                        help=f'number of requests after which a worker process is replaced, 0 to keep workers', type=int, default=10000)
+    parser.add_argument('--graceful_timeout', action='store', dest='graceful_timeout',
+                        help=f'seconds workers finish requests in progress for on shutdown', type=int, default=30)
     args = parser.parse_args()
 
-    properties = Properties(args.api_addr)
+    properties = Properties(args.api_addr, args.api_timeout, args.api_retries, args.api_pool_size, args.api_cache_size)
 
-    print(f'Starting finances frontend (version {_version}) server at port {args.port}')
+    print(f'Starting finances frontend (version {_version}) server at port {args.port}'
+            f'{f" with {args.workers} workers" if args.workers != 0 else ""}')
     try:
-        api_version = requests.get(properties.api_addr + '/api/').json()['version']
+        api_version = properties.api.get('/api/').json()['version']
         print(f'Api version {api_version} is available at {properties.api_addr}')
     except Exception as ex:
         print(f'Could not get version of api at {properties.api_addr}: error {ex}')
 
-    app.secret_key = os.urandom(24)
-    app.run(host='0.0.0.0', port=args.port)
\ No newline at end of file
+    # the key is set before fork, so that all of the workers accept the same session cookies
+    app.secret_key = args.secret_key if args.secret_key is not None else os.urandom(24)
+    if args.workers != 0:
+        def init_worker() -> None:
+            global properties
+            properties = Properties(args.api_addr, args.api_timeout, args.api_retries, args.api_pool_size,
+                    args.api_cache_size) # keep-alive connections of the parent process can not be shared
+        import prefork
+        prefork.run(app, args.port, args.workers, args.threads, args.max_requests, args.graceful_timeout,
+                init_worker=init_worker)
+    else:
+        app.run(host='0.0.0.0', port=args.port)
\ No newline at end of file